@@ -1,7 +1,11 @@
-from flask import Flask
+from flask import Flask, request
 from flask_cors import CORS
 import os
 from app.models.session import SessionManager
+from app.utils.job_queue import job_queue
+from app.utils.similar_ideas import similar_ideas
+from app.utils.tenant_quota import resolve_tenant, set_tenant, tenant_quotas
+from app.utils.token_usage import set_endpoint, token_usage
 
 
 def create_app():
@@ -13,12 +17,47 @@ def create_app():
     # 启用 CORS
     CORS(app)
 
-    # 初始化数据库
+    # 初始化数据库（建表只在启动时执行一次，请求路径上不再重复执行）
     SessionManager.init_db()
     SessionManager.init_token_usage()
+    SessionManager.init_question_cache()
+    SessionManager.init_tenant_quota()
+    SessionManager.init_jobs()
+
+    # 迁移旧版 JSON 列存储的数据（已完成时只做一次查询）
+    SessionManager.migrate_legacy_storage()
+
+    # 载入当日已有的 token 用量细分（之后的记账只访问内存）
+    token_usage.load()
+
+    # 载入租户配额计数（未启用时不做任何事）
+    tenant_quotas.load()
+
+    # 在后台建立相似想法索引（未启用时不做任何事）
+    similar_ideas.load()
+
+    # 模型调用的 token 用量按接口分别统计，按租户计入配额
+    @app.before_request
+    def tag_request_context():
+        set_endpoint(request.url_rule.rule if request.url_rule else request.path)
+        tenant_header = os.getenv('TENANT_HEADER')
+        set_tenant(resolve_tenant(request.headers.get(tenant_header) if tenant_header else None,
+                                  request.headers.get('X-Forwarded-For'), request.remote_addr))
+
+    # 429 和 503 响应带上 Retry-After 头
+    @app.after_request
+    def add_retry_after(response):
+        if response.status_code in (429, 503) and response.is_json:
+            retry_after = (response.get_json(silent=True) or {}).get('retry_after')
+            if retry_after:
+                response.headers['Retry-After'] = str(retry_after)
+        return response
 
     # 注册蓝图
     from app.routes.main import bp as main_bp
     app.register_blueprint(main_bp)
 
+    # 启动后台任务的工作线程（处理函数随蓝图注册），同时接手重启前未完成的任务
+    job_queue.start()
+
     return app
@@ -0,0 +1,150 @@
+"""
+ASGI 入口：LLM 相关的非流式接口走异步实现（app/routes/async_main.py），
+等待模型返回时不占用线程，一个进程可以同时挂起数百个模型调用；
+其余接口（包括流式接口）原样交给 Flask 应用，在 WSGI 线程池中执行。
+客户端在响应之前断开时取消处理请求的任务，模型调用随之断开（见 app/utils/disconnects.py）
+
+启动：uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import json
+import os
+from urllib.parse import parse_qs
+from a2wsgi import WSGIMiddleware
+from app import create_app
+from app.models.database import run_db, shutdown_executor
+from app.routes.async_main import PREFIX_ROUTES, ROUTES
+from app.utils.disconnects import disconnects
+from app.utils.job_queue import job_queue
+from app.utils.prefetch import question_prefetcher
+from app.utils.qwen_api import async_http_client
+from app.utils.tenant_quota import resolve_tenant, set_tenant, tenant_quotas
+from app.utils.token_usage import set_endpoint, token_usage
+
+# 请求体上限，与常见反向代理的默认值一致
+MAX_BODY_BYTES = 1024 * 1024
+
+
+class ASGIApp:
+    def __init__(self, flask_app, routes, prefix_routes=None):
+        self.flask_app = flask_app
+        self.routes = routes
+        # (方法, 路径前缀) -> 处理函数，路径的剩余部分作为参数，例如 /api/jobs/<job_id>
+        self.prefix_routes = prefix_routes or {}
+        # 流式接口在这些线程中执行，会一直占用线程直到流结束
+        self.wsgi = WSGIMiddleware(flask_app, workers=int(os.getenv('WSGI_WORKERS', '32')))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+
+        if scope['type'] == 'http':
+            handler = self.routes.get((scope['method'], scope['path']))
+            if handler is not None:
+                await self._handle(handler, scope, receive, send)
+                return
+            for (method, prefix), handler in self.prefix_routes.items():
+                if scope['method'] == method and scope['path'].startswith(prefix):
+                    param = scope['path'][len(prefix):]
+                    if param and '/' not in param:
+                        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+                        result, status = await handler(param, query)
+                        await self._send_json(send, result, status)
+                        return
+
+        await self.wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await async_http_client.aclose()
+                await run_db(token_usage.close)
+                await run_db(tenant_quotas.close)
+                await run_db(job_queue.close)
+                question_prefetcher.close()
+                shutdown_executor()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _handle(self, handler, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if len(body) > MAX_BODY_BYTES:
+                await self._send_json(send, {'error': '请求体过大'}, 413)
+                return
+            if not message.get('more_body'):
+                break
+
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            data = None
+
+        if not isinstance(data, dict):
+            await self._send_json(send, {'error': '请求数据必须是 JSON 对象'}, 400)
+            return
+
+        # 每个请求在独立的任务中处理，设置的值只对本请求可见
+        set_endpoint(scope['path'])
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        tenant_header = os.getenv('TENANT_HEADER')
+        client = scope.get('client')
+        set_tenant(resolve_tenant(headers.get(tenant_header.lower()) if tenant_header else None,
+                                  headers.get('x-forwarded-for'), client[0] if client else None))
+
+        task = asyncio.ensure_future(handler(data))
+        disconnected = asyncio.ensure_future(self._wait_disconnect(receive))
+        try:
+            await asyncio.wait((task, disconnected), return_when=asyncio.FIRST_COMPLETED)
+            if not task.done():
+                # 客户端已断开：取消处理任务并等它释放预留的额度和并发名额；
+                # keep_on_disconnect 时等它照常完成并保存结果
+                keep = bool(data.get('keep_on_disconnect'))
+                disconnects.record_abandoned(scope['path'], kept=keep)
+                if not keep:
+                    task.cancel()
+                await asyncio.wait((task,))
+                return
+        except asyncio.CancelledError:
+            # 服务关闭等原因取消本请求时同样取消处理任务
+            task.cancel()
+            raise
+        finally:
+            disconnected.cancel()
+
+        result, status = task.result()
+        await self._send_json(send, result, status)
+
+    async def _wait_disconnect(self, receive):
+        """请求体读取完之后，下一条消息只会是 http.disconnect"""
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def _send_json(self, send, data, status):
+        payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        headers = [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(payload)).encode()),
+            # 与 Flask 应用中 flask-cors 的默认配置一致；预检请求（OPTIONS）仍由 Flask 处理
+            (b'access-control-allow-origin', b'*'),
+        ]
+        if status in (429, 503) and data.get('retry_after'):
+            headers.append((b'retry-after', str(data['retry_after']).encode()))
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': headers
+        })
+        await send({'type': 'http.response.body', 'body': payload})
+
+
+def create_asgi_app():
+    return ASGIApp(create_app(), ROUTES, PREFIX_ROUTES)
@@ -0,0 +1,213 @@
+import asyncio
+import collections
+import functools
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+# 连接池配置
+POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', '8'))
+BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', '8192'))
+# 每个连接缓存的预编译语句数量
+STATEMENT_CACHE_SIZE = 256
+# 异步路径访问数据库的线程数，默认与连接池大小一致（线程再多也只会排队等连接）
+EXECUTOR_WORKERS = int(os.getenv('SQLITE_EXECUTOR_WORKERS', str(POOL_SIZE)))
+
+
+def _open_connection(db_path):
+    """打开一个长连接并设置性能相关的 PRAGMA"""
+    conn = sqlite3.connect(
+        db_path,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,  # 连接会在线程间复用，由连接池保证同一时刻只有一个线程使用
+        cached_statements=STATEMENT_CACHE_SIZE
+    )
+    # WAL 模式下读写互不阻塞，只有写与写之间需要排队
+    conn.execute("PRAGMA journal_mode=WAL")
+    # WAL 模式下 NORMAL 已能保证数据库不损坏，只在掉电时可能丢失最后几个事务
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    # 负数表示以 KiB 为单位
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+class _FifoLock:
+    """
+    先到先得的锁：释放时直接把锁交给等待最久的线程，
+    避免高并发写入时个别线程反复抢不到锁造成长尾延迟
+    """
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._waiters = collections.deque()
+        self._locked = False
+
+    def acquire(self):
+        with self._mutex:
+            if not self._locked:
+                self._locked = True
+                return
+            waiter = threading.Lock()
+            waiter.acquire()
+            self._waiters.append(waiter)
+        waiter.acquire()
+
+    def release(self):
+        with self._mutex:
+            if self._waiters:
+                self._waiters.popleft().release()
+            else:
+                self._locked = False
+
+
+class ConnectionPool:
+    """SQLite 连接池，连接长期保持打开，按需借出和归还"""
+
+    def __init__(self, db_path, max_size=POOL_SIZE):
+        self.db_path = db_path
+        self.max_size = max_size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        # 本进程内的写事务先在这里排队：SQLite 的 busy handler 以递增的间隔休眠重试，
+        # 同进程内的写者按到达顺序直接交接更快，busy_timeout 只用于跨进程的竞争
+        self._write_lock = _FifoLock()
+
+    def _acquire(self):
+        # 优先复用空闲连接（LIFO，最近用过的连接缓存更热）
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.max_size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            try:
+                return _open_connection(self.db_path)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        # 连接已用满，等待其他线程归还
+        return self._idle.get()
+
+    def _release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self, immediate=False):
+        """
+        借出一个连接，正常退出时提交事务，出现异常时回滚
+
+        immediate=True 时以 BEGIN IMMEDIATE 开启事务，一开始就持有写锁，
+        避免「先读后写」的事务在升级写锁时与其他写事务冲突
+        """
+        # 先排队拿写锁再借连接，排队中的写者不占用连接
+        if immediate:
+            self._write_lock.acquire()
+        try:
+            conn = self._acquire()
+        except BaseException:
+            if immediate:
+                self._write_lock.release()
+            raise
+
+        try:
+            if immediate:
+                conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            if immediate:
+                self._write_lock.release()
+            self._release(conn)
+
+    def close(self):
+        """关闭所有空闲连接"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path):
+    """获取指定数据库文件对应的连接池"""
+    pool = _pools.get(db_path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(db_path)
+            if pool is None:
+                pool = ConnectionPool(db_path)
+                _pools[db_path] = pool
+    return pool
+
+
+def close_all():
+    """关闭所有连接池中的空闲连接"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """异步路径专用的数据库线程池（首次使用时创建）"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix='sqlite')
+    return _executor
+
+
+async def run_db(func, *args, **kwargs):
+    """
+    在专用线程池中执行阻塞的数据库调用并等待结果
+
+    sqlite3 没有异步接口，直接在事件循环中调用会阻塞所有其他请求
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def shutdown_executor():
+    """关闭异步路径的数据库线程池，等待已提交的调用完成"""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
@@ -0,0 +1,165 @@
+"""
+数据迁移：把 sessions 表中的 JSON 数组列（questions / answers / reports）
+以及旧的 rounds 表迁移到按条存储的 question_sets / answers / reports 表
+
+迁移按 rowid 分批进行，每批一个事务，进度保存在 schema_migrations 表中，
+中途中断后再次运行会从上次的位置继续。
+
+用法：python -m app.models.migrations [数据库路径] [每批会话数]
+"""
+import json
+import sys
+from datetime import datetime
+from app.models.database import get_pool
+
+MIGRATION_NAME = 'normalize_session_blobs'
+DEFAULT_BATCH_SIZE = 500
+
+
+def _ensure_migrations_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            name TEXT PRIMARY KEY,
+            cursor INTEGER NOT NULL DEFAULT 0,
+            completed_at TEXT
+        )
+    """)
+
+
+def _has_legacy_rounds(conn):
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rounds'"
+    ).fetchone()
+    return row is not None
+
+
+def _migrate_session(conn, session_id, questions_json, answers_json, reports_json,
+                     created_at, updated_at, legacy_rounds):
+    """迁移单个会话（插入语句均为 INSERT OR IGNORE，重复执行不会产生重复数据）"""
+    current_questions = json.loads(questions_json or '[]')
+    all_answers = json.loads(answers_json or '[]')
+    all_reports = json.loads(reports_json or '[]')
+
+    set_number = 0
+    last_questions = None
+
+    def add_question_set(questions, at):
+        nonlocal set_number, last_questions
+        set_number += 1
+        last_questions = questions
+        conn.execute("""
+            INSERT OR IGNORE INTO question_sets (session_id, set_number, questions, created_at)
+            VALUES (?, ?, ?, ?)
+        """, (session_id, set_number, json.dumps(questions), at))
+
+    def add_round(round_number, answers, report, at):
+        conn.executemany("""
+            INSERT OR IGNORE INTO answers (session_id, round_number, position, answer)
+            VALUES (?, ?, ?, ?)
+        """, [(session_id, round_number, i, json.dumps(a)) for i, a in enumerate(answers)])
+        conn.execute("""
+            INSERT OR IGNORE INTO reports (session_id, round_number, question_set, report, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (session_id, round_number, set_number or None, report, at))
+
+    if legacy_rounds:
+        # rounds 表中保存了每轮的问题快照，问题变化时记为新的问题集
+        for round_number, questions, answers, report, round_created_at in legacy_rounds:
+            questions = json.loads(questions)
+            if questions != last_questions:
+                add_question_set(questions, round_created_at)
+            add_round(round_number, json.loads(answers), report, round_created_at)
+    else:
+        # 没有轮次记录的早期数据无法区分每轮的答案，全部归入第 1 轮
+        if current_questions:
+            add_question_set(current_questions, created_at)
+        round_count = max(len(all_reports), 1 if all_answers else 0)
+        for i in range(round_count):
+            add_round(i + 1,
+                      all_answers if i == 0 else [],
+                      all_reports[i] if i < len(all_reports) else None,
+                      updated_at)
+
+    # 当前问题（继续细化后尚未回答的问题）作为最新的问题集
+    if current_questions and current_questions != last_questions:
+        add_question_set(current_questions, updated_at)
+
+    # 旧数据已完整写入新表，清空 JSON 列以回收空间
+    conn.execute("""
+        UPDATE sessions
+        SET questions = '[]', answers = '[]', reports = '[]'
+        WHERE id = ?
+    """, (session_id,))
+
+
+def migrate_session_blobs(db_path, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    分批迁移旧的 JSON 列数据，返回本次迁移的会话数
+    """
+    pool = get_pool(db_path)
+
+    with pool.connection() as conn:
+        _ensure_migrations_table(conn)
+        conn.execute("INSERT OR IGNORE INTO schema_migrations (name) VALUES (?)", (MIGRATION_NAME,))
+        cursor, completed_at = conn.execute(
+            "SELECT cursor, completed_at FROM schema_migrations WHERE name = ?", (MIGRATION_NAME,)
+        ).fetchone()
+
+    if completed_at:
+        return 0
+
+    migrated = 0
+    while True:
+        with pool.connection() as conn:
+            has_legacy_rounds = _has_legacy_rounds(conn)
+            rows = conn.execute("""
+                SELECT rowid, id, questions, answers, reports, created_at, updated_at
+                FROM sessions
+                WHERE rowid > ?
+                ORDER BY rowid
+                LIMIT ?
+            """, (cursor, batch_size)).fetchall()
+
+            if not rows:
+                conn.execute("""
+                    UPDATE schema_migrations SET completed_at = ? WHERE name = ?
+                """, (datetime.now().isoformat(), MIGRATION_NAME))
+                break
+
+            for rowid, session_id, questions, answers, reports, created_at, updated_at in rows:
+                legacy_rounds = []
+                if has_legacy_rounds:
+                    legacy_rounds = conn.execute("""
+                        SELECT round_number, questions, answers, report, created_at
+                        FROM rounds
+                        WHERE session_id = ?
+                        ORDER BY round_number ASC
+                    """, (session_id,)).fetchall()
+
+                _migrate_session(conn, session_id, questions, answers, reports,
+                                 created_at, updated_at, legacy_rounds)
+
+                if legacy_rounds:
+                    conn.execute("DELETE FROM rounds WHERE session_id = ?", (session_id,))
+
+            # 进度与本批数据在同一事务中提交
+            cursor = rows[-1][0]
+            conn.execute("UPDATE schema_migrations SET cursor = ? WHERE name = ?",
+                         (cursor, MIGRATION_NAME))
+
+        migrated += len(rows)
+        print(f"已迁移 {migrated} 个会话（rowid <= {cursor}）")
+
+    return migrated
+
+
+if __name__ == '__main__':
+    from app.models.session import SessionManager
+
+    path = sys.argv[1] if len(sys.argv) > 1 else SessionManager.DB_PATH
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_BATCH_SIZE
+
+    SessionManager.DB_PATH = path
+    SessionManager.init_db()
+    total = migrate_session_blobs(path, size)
+    print(f"迁移完成，共迁移 {total} 个会话")
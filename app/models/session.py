@@ -1,323 +1,906 @@
 import uuid
 import json
 import os
-import sqlite3
+import time
 from datetime import datetime
-from app.utils.markdown_generator import generate_markdown
+from app.models.database import get_pool
+from app.utils.lru_cache import LRUCache
+from app.utils.markdown_generator import DOCUMENT_VERSION, iter_document, render_round_qa, render_round_report
+from app.utils.similar_ideas import similar_ideas
 
 
 class SessionManager:
     DB_PATH = "clarity_ai.db"
-    
+
+    # 已解析会话对象的进程内缓存，所有写操作都会使对应条目失效
+    # （多进程部署时其他进程的写入不会通知本进程，依靠 TTL 限制数据的陈旧程度）
+    _session_cache = LRUCache(
+        max_entries=int(os.getenv('SESSION_CACHE_SIZE', '1024')),
+        max_bytes=int(os.getenv('SESSION_CACHE_MAX_BYTES', str(64 * 1024 * 1024))),
+        ttl=float(os.getenv('SESSION_CACHE_TTL', '300'))
+    )
+
+    @classmethod
+    def _connection(cls, immediate=False):
+        """从连接池借出一个连接（with 块正常结束时自动提交并归还）"""
+        return get_pool(cls.DB_PATH).connection(immediate)
+
     @classmethod
     def init_db(cls):
-        """初始化数据库"""
-        conn = sqlite3.connect(cls.DB_PATH)
-        cursor = conn.cursor()
-        
-        # 创建会话表
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS sessions (
-                id TEXT PRIMARY KEY,
-                idea TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                questions TEXT DEFAULT '[]',
-                answers TEXT DEFAULT '[]',
-                reports TEXT DEFAULT '[]',
-                final_doc_path TEXT,
-                updated_at TEXT NOT NULL
-            )
-        """)
-        
-        # 创建轮次表，用于存储每轮的问答对应关系
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS rounds (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id TEXT NOT NULL,
-                round_number INTEGER NOT NULL,
-                questions TEXT NOT NULL,
-                answers TEXT NOT NULL,
-                report TEXT,
-                created_at TEXT NOT NULL,
-                FOREIGN KEY (session_id) REFERENCES sessions (id) ON DELETE CASCADE,
-                UNIQUE (session_id, round_number)
-            )
-        """)
-        
-        conn.commit()
-        conn.close()
-    
-    @classmethod
-    def create_session(cls, idea):
-        """创建新会话"""
-        cls.init_db()  # 确保数据库已初始化
-        
+        """初始化数据库（只在应用启动时调用一次）"""
+        with cls._connection() as conn:
+            cursor = conn.cursor()
+
+            # 创建会话表
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY,
+                    idea TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    questions TEXT DEFAULT '[]',
+                    answers TEXT DEFAULT '[]',
+                    reports TEXT DEFAULT '[]',
+                    final_doc_path TEXT,
+                    updated_at TEXT NOT NULL
+                )
+            """)
+
+            # 问题集表：每次生成/替换问题都追加一条记录，最新的一条即当前问题
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS question_sets (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    set_number INTEGER NOT NULL,
+                    questions TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    UNIQUE (session_id, set_number)
+                )
+            """)
+
+            # 答案表：每个答案一行，按轮次和题目顺序排列
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS answers (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    round_number INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    answer TEXT NOT NULL,
+                    UNIQUE (session_id, round_number, position)
+                )
+            """)
+
+            # 报告表：每轮一行，同时记录该轮回答的是哪个问题集（保持问答对应关系），
+            # 以及该轮在需求文档中的问答片段（首次生成文档时渲染，fragment_version 不同时重新渲染）
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS reports (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    round_number INTEGER NOT NULL,
+                    question_set INTEGER,
+                    report TEXT,
+                    created_at TEXT NOT NULL,
+                    qa_fragment TEXT,
+                    fragment_version INTEGER,
+                    UNIQUE (session_id, round_number)
+                )
+            """)
+
+            # 早期版本的报告表没有文档片段列
+            columns = {row[1] for row in cursor.execute("PRAGMA table_info(reports)")}
+            for column, column_type in (('qa_fragment', 'TEXT'), ('fragment_version', 'INTEGER')):
+                if column not in columns:
+                    cursor.execute(f"ALTER TABLE reports ADD COLUMN {column} {column_type}")
+
+    @classmethod
+    def migrate_legacy_storage(cls):
+        """把旧版 JSON 列中的数据迁移到按条存储的表中（可中断、可重复执行）"""
+        from app.models.migrations import migrate_session_blobs
+        return migrate_session_blobs(cls.DB_PATH)
+
+    @classmethod
+    def create_session(cls, idea, questions=None):
+        """创建新会话；questions 不为空时在同一事务中保存首轮问题"""
         session_id = str(uuid.uuid4())
         created_at = datetime.now().isoformat()
-        
-        conn = sqlite3.connect(cls.DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO sessions (id, idea, created_at, updated_at)
-            VALUES (?, ?, ?, ?)
-        """, (session_id, idea, created_at, created_at))
-        
-        conn.commit()
-        conn.close()
-        
+
+        with cls._connection() as conn:
+            conn.execute("""
+                INSERT INTO sessions (id, idea, created_at, updated_at)
+                VALUES (?, ?, ?, ?)
+            """, (session_id, idea, created_at, created_at))
+            if questions is not None:
+                cls._append_question_set(conn, session_id, questions)
+
+        similar_ideas.add([(session_id, idea)])
         return session_id
-    
+
+    @classmethod
+    def create_sessions(cls, ideas):
+        """在一个事务中批量创建会话，返回与 ideas 一一对应的会话 ID"""
+        created_at = datetime.now().isoformat()
+        session_ids = [str(uuid.uuid4()) for _ in ideas]
+
+        with cls._connection(immediate=True) as conn:
+            conn.executemany("""
+                INSERT INTO sessions (id, idea, created_at, updated_at)
+                VALUES (?, ?, ?, ?)
+            """, [(session_id, idea, created_at, created_at) for session_id, idea in zip(session_ids, ideas)])
+
+        similar_ideas.add(list(zip(session_ids, ideas)))
+        return session_ids
+
+    @classmethod
+    def iter_session_ideas(cls, batch_size):
+        """按创建顺序分批读出全部会话的 [(会话 ID, 想法)]，用于建立相似想法索引"""
+        last_rowid = 0
+        while True:
+            with cls._connection() as conn:
+                rows = conn.execute("""
+                    SELECT rowid, id, idea FROM sessions WHERE rowid > ? ORDER BY rowid LIMIT ?
+                """, (last_rowid, batch_size)).fetchall()
+            if not rows:
+                return
+            last_rowid = rows[-1][0]
+            yield [(session_id, idea) for _, session_id, idea in rows]
+
+    @classmethod
+    def get_answered_first_questions(cls, session_ids):
+        """返回 {会话 ID: 第 1 轮回答的问题列表}，没有提交过答案的会话不在其中"""
+        if not session_ids:
+            return {}
+        placeholders = ','.join('?' * len(session_ids))
+        with cls._connection() as conn:
+            rows = conn.execute(f"""
+                SELECT r.session_id, q.questions
+                FROM reports r
+                JOIN question_sets q ON q.session_id = r.session_id AND q.set_number = r.question_set
+                WHERE r.round_number = 1 AND r.session_id IN ({placeholders})
+            """, session_ids).fetchall()
+        return {session_id: json.loads(questions) for session_id, questions in rows}
+
     @classmethod
     def get_session(cls, session_id):
-        """获取会话信息"""
-        conn = sqlite3.connect(cls.DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT * FROM sessions WHERE id = ?", (session_id,))
-        row = cursor.fetchone()
-        
-        if row:
-            # 解析JSON字段
-            session = {
-                'id': row[0],
-                'idea': row[1],
-                'created_at': row[2],
-                'questions': json.loads(row[3]),
-                'answers': json.loads(row[4]),
-                'reports': json.loads(row[5]),
-                'final_doc': row[6]
-            }
-            conn.close()
-            return session
-        else:
-            conn.close()
-            return None
-    
+        """
+        获取会话信息
+
+        结果来自进程内缓存时，其中的列表与缓存共享，调用方不要原地修改
+        """
+        cached = cls._session_cache.get(session_id)
+        if cached is not None:
+            return dict(cached)
+
+        # 在查询前记下缓存版本，查询期间若有写入则不缓存本次结果
+        cache_version = cls._session_cache.version
+
+        with cls._connection() as conn:
+            row = conn.execute("""
+                SELECT id, idea, created_at, final_doc_path FROM sessions WHERE id = ?
+            """, (session_id,)).fetchone()
+
+            if not row:
+                return None
+
+            # 当前问题为最新的问题集
+            questions_row = conn.execute("""
+                SELECT questions FROM question_sets
+                WHERE session_id = ?
+                ORDER BY set_number DESC
+                LIMIT 1
+            """, (session_id,)).fetchone()
+
+            answer_rows = conn.execute("""
+                SELECT answer FROM answers
+                WHERE session_id = ?
+                ORDER BY round_number ASC, position ASC
+            """, (session_id,)).fetchall()
+
+            report_rows = conn.execute("""
+                SELECT report FROM reports
+                WHERE session_id = ?
+                ORDER BY round_number ASC
+            """, (session_id,)).fetchall()
+
+        session = {
+            'id': row[0],
+            'idea': row[1],
+            'created_at': row[2],
+            'questions': json.loads(questions_row[0]) if questions_row else [],
+            'answers': [json.loads(r[0]) for r in answer_rows],
+            'reports': [r[0] for r in report_rows],
+            'final_doc': row[3]
+        }
+
+        # 按原始文本长度估算占用的内存
+        size = (len(row[1]) + (len(questions_row[0]) if questions_row else 0) +
+                sum(len(r[0]) for r in answer_rows) + sum(len(r[0] or '') for r in report_rows))
+        cls._session_cache.set(session_id, session, size=size, version=cache_version)
+
+        return dict(session)
+
+    @classmethod
+    def get_session_version(cls, session_id):
+        """
+        会话的 updated_at（每次写入都会更新），会话不存在时返回 None
+
+        只读 sessions 表的一行，不经过会话缓存（多进程部署时也能看到其他进程的写入）
+        """
+        with cls._connection() as conn:
+            row = conn.execute("SELECT updated_at FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return row[0] if row else None
+
+    @classmethod
+    def session_cache_stats(cls):
+        """会话缓存的命中、未命中、淘汰等统计"""
+        return cls._session_cache.stats()
+
+    @classmethod
+    def _append_question_set(cls, conn, session_id, questions):
+        """追加一个新的问题集，成为会话的当前问题"""
+        now = datetime.now().isoformat()
+        conn.execute("""
+            INSERT INTO question_sets (session_id, set_number, questions, created_at)
+            SELECT ?, COALESCE(MAX(set_number), 0) + 1, ?, ?
+            FROM question_sets WHERE session_id = ?
+        """, (session_id, json.dumps(questions), now, session_id))
+        conn.execute("UPDATE sessions SET updated_at = ? WHERE id = ?", (now, session_id))
+
     @classmethod
     def save_questions(cls, session_id, questions):
         """保存问题到会话"""
-        conn = sqlite3.connect(cls.DB_PATH)
-        cursor = conn.cursor()
-        
-        questions_json = json.dumps(questions)
-        updated_at = datetime.now().isoformat()
-        
-        cursor.execute("""
-            UPDATE sessions
-            SET questions = ?, updated_at = ?
-            WHERE id = ?
-        """, (questions_json, updated_at, session_id))
-        
-        conn.commit()
-        conn.close()
-    
-    @classmethod
-    def update_session_with_answers(cls, session_id, answers, report):
-        """更新会话中的答案和报告"""
-        conn = sqlite3.connect(cls.DB_PATH)
-        cursor = conn.cursor()
-        
-        # 获取当前答案和报告
-        cursor.execute("SELECT answers, reports FROM sessions WHERE id = ?", (session_id,))
-        row = cursor.fetchone()
-        
-        if row:
-            current_answers = json.loads(row[0])
-            current_reports = json.loads(row[1])
-            
-            # 添加新答案和报告
-            current_answers.extend(answers)
-            current_reports.append(report)
-            
-            # 更新数据库
-            answers_json = json.dumps(current_answers)
-            reports_json = json.dumps(current_reports)
-            updated_at = datetime.now().isoformat()
-            
+        with cls._connection() as conn:
+            cls._append_question_set(conn, session_id, questions)
+
+        cls._session_cache.invalidate(session_id)
+
+    @classmethod
+    def update_session_with_answers(cls, session_id, answers, report, job_id=None):
+        """
+        更新会话中的答案和报告（只追加本轮数据，不重写历史）
+
+        轮次号的计算和本轮数据的写入在同一个写事务中完成，
+        同一会话的并发提交会依次获得连续的轮次号。返回本轮轮次号，会话不存在时返回 None
+
+        job_id 不为空时在同一事务中把后台任务标记为完成；任务已经完成过（重试）时不再写入，
+        直接返回当时的轮次号，任务重复执行不会产生重复的轮次
+
+        本轮的问答片段（需求文档中的一段）在同一事务中渲染并保存，下载文档时不需要再写入
+        """
+        created_at = datetime.now().isoformat()
+        # 序列化放在事务外，缩短持有写锁的时间
+        answer_rows = [(i, json.dumps(a)) for i, a in enumerate(answers)]
+
+        with cls._connection(immediate=True) as conn:
+            cursor = conn.cursor()
+
+            if job_id is not None:
+                row = cursor.execute("SELECT status, round_number FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                if row and row[0] == 'succeeded':
+                    return row[1]
+
+            # 保存轮次数据（保持问答对应关系）：轮次号为当前最大轮次 + 1，
+            # 本轮回答的是当前（最新的）问题集
+            row = cursor.execute("""
+                SELECT (SELECT COALESCE(MAX(round_number), 0) + 1 FROM reports WHERE session_id = s.id),
+                       q.set_number, q.questions
+                FROM sessions s
+                LEFT JOIN question_sets q ON q.session_id = s.id
+                    AND q.set_number = (SELECT MAX(set_number) FROM question_sets WHERE session_id = s.id)
+                WHERE s.id = ?
+            """, (session_id,)).fetchone()
+            if row is None:
+                return None
+
+            round_number, question_set, questions = row
+            qa_fragment = render_round_qa(round_number, json.loads(questions) if questions else [], answers)
             cursor.execute("""
-                UPDATE sessions
-                SET answers = ?, reports = ?, updated_at = ?
-                WHERE id = ?
-            """, (answers_json, reports_json, updated_at, session_id))
-            
-            # 获取当前轮次号
-            cursor.execute("SELECT MAX(round_number) FROM rounds WHERE session_id = ?", (session_id,))
-            max_round = cursor.fetchone()[0]
-            next_round = (max_round or 0) + 1
-            
-            # 获取当前问题
-            cursor.execute("SELECT questions FROM sessions WHERE id = ?", (session_id,))
-            current_questions = json.loads(cursor.fetchone()[0])
-            
-            # 保存轮次数据（保持问答对应关系）
+                INSERT INTO reports (session_id, round_number, question_set, report, qa_fragment,
+                                     fragment_version, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (session_id, round_number, question_set, report, qa_fragment, DOCUMENT_VERSION, created_at))
+
             # 注意：answers 参数是当前轮次的答案，不是累积的
-            created_at = datetime.now().isoformat()
-            cursor.execute("""
-                INSERT OR REPLACE INTO rounds (session_id, round_number, questions, answers, report, created_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (session_id, next_round, 
-                  json.dumps(current_questions), 
-                  json.dumps(answers),  # 使用当前轮次的答案，而不是累积答案
-                  report, created_at))
-            
-            conn.commit()
-        conn.close()
-    
+            cursor.executemany("""
+                INSERT INTO answers (session_id, round_number, position, answer)
+                VALUES (?, ?, ?, ?)
+            """, [(session_id, round_number, i, answer) for i, answer in answer_rows])
+
+            cursor.execute("UPDATE sessions SET updated_at = ? WHERE id = ?", (created_at, session_id))
+
+            if job_id is not None:
+                cursor.execute("""
+                    UPDATE jobs SET status = 'succeeded', round_number = ?, error = NULL,
+                                    lease_until = NULL, updated_at = ?
+                    WHERE id = ?
+                """, (round_number, time.time(), job_id))
+
+        cls._session_cache.invalidate(session_id)
+        return round_number
+
     @classmethod
     def add_follow_up_questions(cls, session_id, new_questions):
         """添加后续问题"""
-        conn = sqlite3.connect(cls.DB_PATH)
-        cursor = conn.cursor()
-        
-        # 获取当前问题
-        cursor.execute("SELECT questions FROM sessions WHERE id = ?", (session_id,))
-        row = cursor.fetchone()
-        
-        if row:
-            current_questions = json.loads(row[0])
-            
+        with cls._connection() as conn:
+            # 获取当前问题
+            row = conn.execute("""
+                SELECT questions FROM question_sets
+                WHERE session_id = ?
+                ORDER BY set_number DESC
+                LIMIT 1
+            """, (session_id,)).fetchone()
+
+            current_questions = json.loads(row[0]) if row else []
+
             # 添加新问题
             current_questions.extend(new_questions)
-            
-            # 更新数据库
-            questions_json = json.dumps(current_questions)
-            updated_at = datetime.now().isoformat()
-            
-            cursor.execute("""
-                UPDATE sessions
-                SET questions = ?, updated_at = ?
-                WHERE id = ?
-            """, (questions_json, updated_at, session_id))
-            
-            conn.commit()
-        conn.close()
+
+            cls._append_question_set(conn, session_id, current_questions)
+
+        cls._session_cache.invalidate(session_id)
 
     @classmethod
     def replace_questions(cls, session_id, new_questions):
         """替换会话中的问题（用于继续细化需求场景）"""
-        conn = sqlite3.connect(cls.DB_PATH)
-        cursor = conn.cursor()
+        # 旧问题集保留在历史中，用于还原各轮的问答对应关系
+        with cls._connection() as conn:
+            cls._append_question_set(conn, session_id, new_questions)
+
+        cls._session_cache.invalidate(session_id)
+
+    @classmethod
+    def adopt_questions(cls, session_id, job_id):
+        """
+        用后台任务生成的问题替换首轮的模板问题，返回 (问题列表, None)，不能替换时返回 (None, 原因)：
+        'missing' 任务不存在，'pending' 任务还没有成功，'stale' 会话已经不在首轮；
+        已经替换过时返回 (问题列表, 'adopted')
 
-        # 更新问题列表
-        questions_json = json.dumps(new_questions)
+        只在会话仍处于首轮（只有一个问题集、还没有提交过答案）时替换
+        """
+        with cls._connection(immediate=True) as conn:
+            row = conn.execute("""
+                SELECT status, result FROM jobs WHERE id = ? AND session_id = ? AND kind = 'refine-questions'
+            """, (job_id, session_id)).fetchone()
+            if not row:
+                return None, 'missing'
+            if row[0] != 'succeeded':
+                return None, 'pending'
+            questions = json.loads(row[1])['questions']
+
+            sets = conn.execute("""
+                SELECT set_number, questions FROM question_sets
+                WHERE session_id = ?
+                ORDER BY set_number DESC
+                LIMIT 2
+            """, (session_id,)).fetchall()
+            if len(sets) == 2 and json.loads(sets[0][1]) == questions:
+                return questions, 'adopted'
+            has_rounds = conn.execute("SELECT 1 FROM reports WHERE session_id = ? LIMIT 1", (session_id,)).fetchone()
+            if len(sets) != 1 or has_rounds:
+                return None, 'stale'
+
+            cls._append_question_set(conn, session_id, questions)
+
+        cls._session_cache.invalidate(session_id)
+        return questions, None
+
+    @classmethod
+    def update_final_doc_path(cls, session_id, filepath):
+        """在数据库中记录最终文档路径"""
         updated_at = datetime.now().isoformat()
 
-        cursor.execute("""
-            UPDATE sessions
-            SET questions = ?, updated_at = ?
-            WHERE id = ?
-        """, (questions_json, updated_at, session_id))
+        with cls._connection() as conn:
+            conn.execute("""
+                UPDATE sessions
+                SET final_doc_path = ?, updated_at = ?
+                WHERE id = ?
+            """, (filepath, updated_at, session_id))
 
-        conn.commit()
-        conn.close()
+        cls._session_cache.invalidate(session_id)
 
     @classmethod
     def delete_session(cls, session_id):
         """删除会话"""
-        conn = sqlite3.connect(cls.DB_PATH)
-        cursor = conn.cursor()
-
-        cursor.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+        with cls._connection() as conn:
+            conn.execute("DELETE FROM answers WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM reports WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM question_sets WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
 
-        conn.commit()
-        conn.close()
+        cls._session_cache.invalidate(session_id)
+        similar_ideas.remove(session_id)
 
     @classmethod
     def init_token_usage(cls):
         """初始化 token 使用记录表"""
-        conn = sqlite3.connect(cls.DB_PATH)
-        cursor = conn.cursor()
-
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS token_usage (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                date TEXT NOT NULL UNIQUE,
-                total_tokens INTEGER DEFAULT 0,
-                updated_at TEXT NOT NULL
-            )
-        """)
-
-        conn.commit()
-        conn.close()
+        with cls._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS token_usage (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    date TEXT NOT NULL UNIQUE,
+                    total_tokens INTEGER DEFAULT 0,
+                    updated_at TEXT NOT NULL
+                )
+            """)
+            # 按模型和接口细分的用量，token_usage 中的每日总量保持不变
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS token_usage_breakdown (
+                    date TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    endpoint TEXT NOT NULL,
+                    total_tokens INTEGER DEFAULT 0,
+                    calls INTEGER DEFAULT 0,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (date, model, endpoint)
+                )
+            """)
 
     @classmethod
     def get_today_token_usage(cls):
         """获取今日 token 使用量"""
-        conn = sqlite3.connect(cls.DB_PATH)
-        cursor = conn.cursor()
-
         today = datetime.now().strftime('%Y-%m-%d')
-        cursor.execute("SELECT total_tokens FROM token_usage WHERE date = ?", (today,))
-        row = cursor.fetchone()
 
-        conn.close()
+        with cls._connection() as conn:
+            row = conn.execute("SELECT total_tokens FROM token_usage WHERE date = ?", (today,)).fetchone()
+
         return row[0] if row else 0
 
     @classmethod
     def add_token_usage(cls, tokens):
         """增加 token 使用量"""
-        conn = sqlite3.connect(cls.DB_PATH)
-        cursor = conn.cursor()
-
         today = datetime.now().strftime('%Y-%m-%d')
         updated_at = datetime.now().isoformat()
 
-        # 检查今日记录是否存在
-        cursor.execute("SELECT total_tokens FROM token_usage WHERE date = ?", (today,))
-        row = cursor.fetchone()
+        # 单条语句完成「不存在则插入、存在则累加」，并发调用不会丢失更新
+        with cls._connection() as conn:
+            conn.execute("""
+                INSERT INTO token_usage (date, total_tokens, updated_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT (date) DO UPDATE SET
+                    total_tokens = total_tokens + excluded.total_tokens,
+                    updated_at = excluded.updated_at
+            """, (today, tokens, updated_at))
 
-        if row:
-            # 更新现有记录
-            new_total = row[0] + tokens
-            cursor.execute("""
-                UPDATE token_usage
-                SET total_tokens = ?, updated_at = ?
+    @classmethod
+    def get_token_usage_breakdown(cls, date):
+        """获取某日按模型和接口细分的用量，返回 [(模型, 接口, token 数, 调用次数)]"""
+        with cls._connection() as conn:
+            rows = conn.execute("""
+                SELECT model, endpoint, total_tokens, calls FROM token_usage_breakdown
                 WHERE date = ?
-            """, (new_total, updated_at, today))
-        else:
-            # 插入新记录
-            cursor.execute("""
+            """, (date,)).fetchall()
+
+        return [tuple(row) for row in rows]
+
+    @classmethod
+    def flush_token_usage(cls, deltas):
+        """
+        批量写入 token 用量增量（app/utils/token_usage.py 定期调用）
+
+        deltas 为 [(日期, 模型, 接口, token 数, 调用次数)]，在一个事务中累加到每日总量和细分表
+        """
+        updated_at = datetime.now().isoformat()
+
+        daily = {}
+        for date, _, _, tokens, _ in deltas:
+            daily[date] = daily.get(date, 0) + tokens
+
+        with cls._connection(immediate=True) as conn:
+            conn.executemany("""
                 INSERT INTO token_usage (date, total_tokens, updated_at)
                 VALUES (?, ?, ?)
-            """, (today, tokens, updated_at))
+                ON CONFLICT (date) DO UPDATE SET
+                    total_tokens = total_tokens + excluded.total_tokens,
+                    updated_at = excluded.updated_at
+            """, [(date, tokens, updated_at) for date, tokens in daily.items()])
+            conn.executemany("""
+                INSERT INTO token_usage_breakdown (date, model, endpoint, total_tokens, calls, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (date, model, endpoint) DO UPDATE SET
+                    total_tokens = total_tokens + excluded.total_tokens,
+                    calls = calls + excluded.calls,
+                    updated_at = excluded.updated_at
+            """, [delta + (updated_at,) for delta in deltas])
+
+    @classmethod
+    def init_tenant_quota(cls):
+        """初始化租户配额计数表"""
+        with cls._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS tenant_quota (
+                    tenant TEXT PRIMARY KEY,
+                    window_index INTEGER NOT NULL,
+                    prev_tokens INTEGER DEFAULT 0,
+                    cur_tokens INTEGER DEFAULT 0,
+                    prev_requests INTEGER DEFAULT 0,
+                    cur_requests INTEGER DEFAULT 0,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_tenant_quota_updated ON tenant_quota (updated_at)")
+
+    @classmethod
+    def load_tenant_quotas(cls, min_window, limit):
+        """
+        读取窗口编号不早于 min_window 的租户计数，最近更新的在前，最多 limit 条
+
+        返回 [(租户, 窗口编号, 上一窗口 token, 当前窗口 token, 上一窗口请求数, 当前窗口请求数)]
+        """
+        with cls._connection() as conn:
+            rows = conn.execute("""
+                SELECT tenant, window_index, prev_tokens, cur_tokens, prev_requests, cur_requests
+                FROM tenant_quota
+                WHERE window_index >= ?
+                ORDER BY updated_at DESC
+                LIMIT ?
+            """, (min_window, limit)).fetchall()
 
-        conn.commit()
-        conn.close()
+        return [tuple(row) for row in rows]
+
+    @classmethod
+    def save_tenant_quotas(cls, rows, min_window):
+        """写入租户计数（格式同 load_tenant_quotas），同时删除已滑出窗口的记录"""
+        updated_at = time.time()
+        with cls._connection(immediate=True) as conn:
+            conn.executemany("""
+                INSERT OR REPLACE INTO tenant_quota
+                    (tenant, window_index, prev_tokens, cur_tokens, prev_requests, cur_requests, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, [tuple(row) + (updated_at,) for row in rows])
+            conn.execute("DELETE FROM tenant_quota WHERE window_index < ?", (min_window,))
+
+    @classmethod
+    def init_jobs(cls):
+        """初始化后台任务表"""
+        with cls._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    session_id TEXT NOT NULL,
+                    dedupe_key TEXT,
+                    tenant TEXT,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER DEFAULT 0,
+                    round_number INTEGER,
+                    result TEXT,
+                    error TEXT,
+                    owner TEXT,
+                    run_after REAL NOT NULL,
+                    lease_until REAL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            # 早期版本的任务表没有 result、owner 列
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if 'result' not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN result TEXT")
+            if 'owner' not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            # 各进程任务队列的心跳：带密钥的任务只有提交它的进程能执行，该进程存活时其他进程不领取
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS job_workers (
+                    instance TEXT PRIMARY KEY,
+                    heartbeat_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, run_after)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_dedupe ON jobs (dedupe_key, status)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_updated ON jobs (updated_at)")
+
+    @classmethod
+    def create_job(cls, kind, session_id, payload, dedupe_key=None, tenant=None, owner=None):
+        """
+        创建排队中的任务，返回 (任务 ID, 是否新建)
+
+        dedupe_key 相同的任务还在排队或执行时直接返回该任务，重复提交不会重复执行。
+        owner 为只能由提交它的进程执行的任务（密钥只在该进程内存中）所属的任务队列实例，
+        同时刷新该实例的心跳
+        """
+        now = time.time()
+        payload_json = json.dumps(payload, ensure_ascii=False)
+
+        with cls._connection(immediate=True) as conn:
+            if dedupe_key is not None:
+                row = conn.execute("""
+                    SELECT id FROM jobs
+                    WHERE dedupe_key = ? AND status IN ('queued', 'running')
+                    LIMIT 1
+                """, (dedupe_key,)).fetchone()
+                if row:
+                    return row[0], False
+
+            job_id = str(uuid.uuid4())
+            conn.execute("""
+                INSERT INTO jobs (id, kind, session_id, dedupe_key, tenant, payload, status, owner,
+                                  run_after, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?, ?, ?)
+            """, (job_id, kind, session_id, dedupe_key, tenant, payload_json, owner, now, now, now))
+            if owner is not None:
+                conn.execute("INSERT OR REPLACE INTO job_workers (instance, heartbeat_at) VALUES (?, ?)",
+                             (owner, now))
+
+        return job_id, True
+
+    # 可以领取的任务：排队中且已到执行时间，或执行中但租约已过期；
+    # 有 owner 的任务只由 owner 领取，owner 的心跳超时（进程已退出）后其他进程才能领取（随后标记为失败）
+    _CLAIMABLE = """
+        ((status = 'queued' AND run_after <= :now) OR (status = 'running' AND lease_until < :now))
+        AND (owner IS NULL OR owner = :instance
+             OR owner NOT IN (SELECT instance FROM job_workers WHERE heartbeat_at >= :alive_after))
+    """
+
+    @classmethod
+    def claim_job(cls, job_id, lease_seconds, instance=None, owner_timeout=30.0):
+        """
+        领取一个可以执行的任务（见 _CLAIMABLE），尝试次数加一；instance 为领取方的任务队列实例
+
+        返回任务字典，任务不存在或已被其他线程、进程领取时返回 None
+        """
+        now = time.time()
+        params = {'now': now, 'instance': instance, 'alive_after': now - owner_timeout,
+                  'lease_until': now + lease_seconds, 'job_id': job_id}
+        with cls._connection(immediate=True) as conn:
+            cursor = conn.execute(f"""
+                UPDATE jobs SET status = 'running', attempts = attempts + 1,
+                                lease_until = :lease_until, updated_at = :now
+                WHERE id = :job_id AND {cls._CLAIMABLE}
+            """, params)
+            if cursor.rowcount == 0:
+                return None
+
+            row = conn.execute("""
+                SELECT id, kind, session_id, tenant, payload, attempts, owner FROM jobs WHERE id = ?
+            """, (job_id,)).fetchone()
+
+        return {
+            'id': row[0],
+            'kind': row[1],
+            'session_id': row[2],
+            'tenant': row[3],
+            'payload': json.loads(row[4]),
+            'attempts': row[5],
+            'owner': row[6]
+        }
+
+    @classmethod
+    def claimable_jobs(cls, limit, instance=None, owner_timeout=30.0):
+        """可以由 instance 领取的任务 ID（包括进程退出时未完成、租约已过期的任务），按创建时间排序"""
+        now = time.time()
+        with cls._connection() as conn:
+            rows = conn.execute(f"""
+                SELECT id FROM jobs
+                WHERE {cls._CLAIMABLE}
+                ORDER BY created_at
+                LIMIT :limit
+            """, {'now': now, 'instance': instance, 'alive_after': now - owner_timeout, 'limit': limit}).fetchall()
+
+        return [row[0] for row in rows]
+
+    @classmethod
+    def heartbeat_job_worker(cls, instance):
+        """刷新任务队列实例的心跳"""
+        with cls._connection(immediate=True) as conn:
+            conn.execute("INSERT OR REPLACE INTO job_workers (instance, heartbeat_at) VALUES (?, ?)",
+                         (instance, time.time()))
+
+    @classmethod
+    def remove_job_worker(cls, instance):
+        """任务队列关闭时删除心跳，它提交的带密钥的任务随即可以由其他进程领取（并标记为失败）"""
+        with cls._connection(immediate=True) as conn:
+            conn.execute("DELETE FROM job_workers WHERE instance = ?", (instance,))
+
+    @classmethod
+    def finish_job(cls, job_id, status, error=None, run_after=None):
+        """
+        结束一次执行：status 为 queued（稍后重试，run_after 为重试时间）或 failed
+
+        成功的任务由 update_session_with_answers 在写入轮次的同一事务中标记，
+        或由 complete_job 连同结果一起标记
+        """
+        now = time.time()
+        with cls._connection(immediate=True) as conn:
+            conn.execute("""
+                UPDATE jobs SET status = ?, error = ?, run_after = COALESCE(?, run_after),
+                                lease_until = NULL, updated_at = ?
+                WHERE id = ? AND status = 'running'
+            """, (status, json.dumps(error, ensure_ascii=False) if error else None, run_after, now, job_id))
+
+    @classmethod
+    def complete_job(cls, job_id, result):
+        """把任务标记为成功并保存结果（可以 JSON 序列化）；任务已经完成过时不覆盖"""
+        now = time.time()
+        with cls._connection(immediate=True) as conn:
+            conn.execute("""
+                UPDATE jobs SET status = 'succeeded', result = ?, error = NULL, lease_until = NULL, updated_at = ?
+                WHERE id = ? AND status = 'running'
+            """, (json.dumps(result, ensure_ascii=False), now, job_id))
+
+    @classmethod
+    def get_job(cls, job_id):
+        """
+        获取任务状态，已完成的任务带上结果（提交答案的任务为对应轮次的报告）；任务不存在时返回 None
+        """
+        with cls._connection() as conn:
+            row = conn.execute("""
+                SELECT j.id, j.kind, j.session_id, j.status, j.attempts, j.round_number, j.error,
+                       j.created_at, j.updated_at, r.report, j.result
+                FROM jobs j
+                LEFT JOIN reports r ON r.session_id = j.session_id AND r.round_number = j.round_number
+                WHERE j.id = ?
+            """, (job_id,)).fetchone()
+
+        if not row:
+            return None
+
+        job = {
+            'job_id': row[0],
+            'kind': row[1],
+            'session_id': row[2],
+            'status': row[3],
+            'attempts': row[4],
+            'created_at': row[7],
+            'updated_at': row[8]
+        }
+        if row[3] == 'succeeded':
+            if row[5] is not None:
+                job['round'] = row[5]
+                job['report'] = row[9]
+            if row[10]:
+                job['result'] = json.loads(row[10])
+        elif row[6]:
+            job['error'] = json.loads(row[6])
+        return job
+
+    @classmethod
+    def purge_jobs(cls, before):
+        """删除 before 之前已结束（成功或失败）的任务，以及之前就停止心跳的任务队列实例"""
+        with cls._connection(immediate=True) as conn:
+            cursor = conn.execute("""
+                DELETE FROM jobs WHERE status IN ('succeeded', 'failed') AND updated_at < ?
+            """, (before,))
+            conn.execute("DELETE FROM job_workers WHERE heartbeat_at < ?", (before,))
+            return cursor.rowcount
+
+    @classmethod
+    def init_question_cache(cls):
+        """初始化首轮问题缓存表"""
+        with cls._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS question_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    idea TEXT NOT NULL,
+                    questions TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_question_cache_created ON question_cache (created_at)")
+
+    @classmethod
+    def get_cached_questions(cls, cache_key, min_created_at):
+        """读取未过期的缓存问题，返回 (问题 JSON, 写入时间)，不存在时返回 None"""
+        with cls._connection() as conn:
+            row = conn.execute("""
+                SELECT questions, created_at FROM question_cache
+                WHERE cache_key = ? AND created_at > ?
+            """, (cache_key, min_created_at)).fetchone()
+
+        return tuple(row) if row else None
+
+    @classmethod
+    def save_cached_questions(cls, cache_key, model, idea, questions_json, created_at, max_entries, min_created_at):
+        """写入缓存问题，同时删除已过期的条目和超出数量上限的最旧条目"""
+        with cls._connection(immediate=True) as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO question_cache (cache_key, model, idea, questions, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (cache_key, model, idea, questions_json, created_at))
+            conn.execute("DELETE FROM question_cache WHERE created_at <= ?", (min_created_at,))
+            conn.execute("""
+                DELETE FROM question_cache WHERE cache_key IN (
+                    SELECT cache_key FROM question_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (max_entries,))
 
     @classmethod
     def get_rounds(cls, session_id):
         """获取所有轮次的数据（保持问答对应关系）"""
-        conn = sqlite3.connect(cls.DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT round_number, questions, answers, report, created_at 
-            FROM rounds 
-            WHERE session_id = ? 
-            ORDER BY round_number ASC
-        """, (session_id,))
-        
-        rows = cursor.fetchall()
-        conn.close()
-        
+        with cls._connection() as conn:
+            rows = conn.execute("""
+                SELECT r.round_number, q.questions, r.report, r.created_at
+                FROM reports r
+                LEFT JOIN question_sets q
+                    ON q.session_id = r.session_id AND q.set_number = r.question_set
+                WHERE r.session_id = ?
+                ORDER BY r.round_number ASC
+            """, (session_id,)).fetchall()
+
+            answer_rows = conn.execute("""
+                SELECT round_number, answer FROM answers
+                WHERE session_id = ?
+                ORDER BY round_number ASC, position ASC
+            """, (session_id,)).fetchall()
+
+        answers_by_round = {}
+        for round_number, answer in answer_rows:
+            answers_by_round.setdefault(round_number, []).append(json.loads(answer))
+
         rounds = []
         for row in rows:
             rounds.append({
                 'round_number': row[0],
-                'questions': json.loads(row[1]),
-                'answers': json.loads(row[2]),
-                'report': row[3],
-                'created_at': row[4]
+                'questions': json.loads(row[1]) if row[1] else [],
+                'answers': answers_by_round.get(row[0], []),
+                'report': row[2],
+                'created_at': row[3]
             })
-        
+
         return rounds
 
+    @classmethod
+    def get_document(cls, session_id):
+        """
+        获取生成需求文档所需的数据：{'idea', 'updated_at', 'rounds': [(问答片段, 报告片段)]}，会话不存在时返回 None
+
+        问答片段在提交答案时已经保存（见 update_session_with_answers），这里直接使用；
+        只有旧版本保存的片段（fragment_version 过期或为空）在这里重新渲染并写回。
+        报告片段只是在报告前加一行标题，不另外保存（避免每轮的报告在表中存两份）
+        """
+        with cls._connection() as conn:
+            # 先读 updated_at：读取片段期间有新的轮次写入时，ETag 偏旧，下次请求会重新下载，而不会把新 ETag 配上旧内容
+            row = conn.execute("SELECT idea, updated_at FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if not row:
+                return None
+
+            rows = conn.execute("""
+                SELECT r.round_number, r.report, r.qa_fragment, r.fragment_version, q.questions
+                FROM reports r
+                LEFT JOIN question_sets q
+                    ON q.session_id = r.session_id AND q.set_number = r.question_set
+                    AND (r.fragment_version IS NULL OR r.fragment_version != ?)
+                WHERE r.session_id = ?
+                ORDER BY r.round_number ASC
+            """, (DOCUMENT_VERSION, session_id)).fetchall()
+
+            stale = [r[0] for r in rows if r[3] != DOCUMENT_VERSION]
+            answers_by_round = {}
+            if stale:
+                answer_rows = conn.execute(f"""
+                    SELECT round_number, answer FROM answers
+                    WHERE session_id = ? AND round_number IN ({','.join('?' * len(stale))})
+                    ORDER BY round_number ASC, position ASC
+                """, [session_id] + stale).fetchall()
+                for round_number, answer in answer_rows:
+                    answers_by_round.setdefault(round_number, []).append(json.loads(answer))
+
+        fragments = []
+        rendered = []
+        for round_number, report, qa, version, questions in rows:
+            if version != DOCUMENT_VERSION:
+                qa = render_round_qa(round_number, json.loads(questions) if questions else [],
+                                     answers_by_round.get(round_number, []))
+                rendered.append((qa, DOCUMENT_VERSION, session_id, round_number))
+            fragments.append((qa, render_round_report(round_number, report)))
+
+        if rendered:
+            try:
+                with cls._connection(immediate=True) as conn:
+                    conn.executemany("""
+                        UPDATE reports SET qa_fragment = ?, fragment_version = ?
+                        WHERE session_id = ? AND round_number = ?
+                    """, rendered)
+            except Exception as e:
+                # 片段只是缓存，写入失败时下次重新渲染
+                print(f"Error saving document fragments: {str(e)}")
+
+        return {'idea': row[0], 'updated_at': row[1], 'rounds': fragments}
+
     @classmethod
     def generate_pdf_report(cls, session_id):
         """生成Markdown报告（原方法名保持不变以避免修改其他地方）"""
-        session = cls.get_session(session_id)
-        if not session:
+        document = cls.get_document(session_id)
+        if not document:
             return None
 
         # 创建输出目录
@@ -329,20 +912,10 @@ class SessionManager:
         filename = f"requirement_document_{session_id[:8]}.md"
         filepath = os.path.join(output_dir, filename)
 
-        generate_markdown(session, filepath)
+        with open(filepath, 'w', encoding='utf-8') as f:
+            f.writelines(iter_document(document))
 
         # 在数据库中记录文件路径
-        conn = sqlite3.connect(cls.DB_PATH)
-        cursor = conn.cursor()
-
-        updated_at = datetime.now().isoformat()
-        cursor.execute("""
-            UPDATE sessions
-            SET final_doc_path = ?, updated_at = ?
-            WHERE id = ?
-        """, (filepath, updated_at, session_id))
-
-        conn.commit()
-        conn.close()
+        cls.update_final_doc_path(session_id, filepath)
 
-        return filepath
\ No newline at end of file
+        return filepath
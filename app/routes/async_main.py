@@ -0,0 +1,206 @@
+"""
+LLM 相关接口的异步实现，由 app/asgi.py 挂载
+
+逻辑与 app/routes/main.py 中的同名接口一致：模型调用使用 AsyncOpenAI，
+SQLite 读写通过 run_db 放到专用线程池，等待期间不占用任何线程。
+每个处理函数接收请求的 JSON 数据，返回 (响应数据, 状态码)
+"""
+import time
+from app.models.database import run_db
+from app.models.session import SessionManager
+from app.routes.main import JOB_LONG_POLL_MAX, enqueue_submit_answers, start_instant_questions
+from app.utils.job_queue import job_queue
+from app.utils.metrics import get_recorder
+from app.utils.prefetch import is_trivial_feedback, question_prefetcher
+from app.utils.qwen_api import agenerate_questions, aprocess_answers_to_doc, latest_report, REPORT_ERROR_PREFIX
+from app.utils.singleflight import llm_requests, request_key
+from app.utils.tenant_quota import current_tenant
+from app.utils.token_limit import TokenLimitExceeded, token_limit_error
+
+
+def _custom_api(data):
+    """获取自定义 API 配置 (api_key, base_url, model)"""
+    custom_config = data.get('custom_api') or {}
+    return custom_config.get('api_key'), custom_config.get('base_url'), custom_config.get('model')
+
+
+async def api_generate_questions(data):
+    """
+    根据用户输入的想法生成问题
+    """
+    try:
+        idea = data.get('idea', '')
+        custom_api_key, custom_base_url, custom_model = _custom_api(data)
+
+        if not idea:
+            return {'error': '想法不能为空'}, 400
+
+        # 先返回模板问题，模型生成的问题在后台生成
+        if data.get('instant'):
+            return await run_db(start_instant_questions, data, current_tenant())
+
+        # 调用 Qwen API 生成问题（先于创建会话：客户端在生成期间断开时不留下空会话）
+        questions = await agenerate_questions(idea, custom_api_key=custom_api_key,
+                                              custom_base_url=custom_base_url,
+                                              custom_model=custom_model)
+
+        # 生成唯一会话 ID，保存问题到会话
+        session_id = await run_db(SessionManager.create_session, idea)
+        await run_db(SessionManager.save_questions, session_id, questions)
+
+        return {
+            'session_id': session_id,
+            'questions': questions
+        }, 200
+    except TokenLimitExceeded as e:
+        return e.to_dict(), 429
+    except Exception as e:
+        return {'error': str(e)}, 500
+
+
+async def api_submit_answers(data):
+    """
+    提交问题答案，生成阶段性报告
+    """
+    started = time.perf_counter()
+    try:
+        session_id = data.get('session_id', '')
+        answers = data.get('answers', [])
+        custom_api_key, custom_base_url, custom_model = _custom_api(data)
+
+        if not session_id or not answers:
+            return {'error': '会话 ID 和答案不能为空'}, 400
+
+        # 异步模式：放入后台任务队列，立即返回任务 ID
+        if data.get('async'):
+            return await run_db(enqueue_submit_answers, data, current_tenant())
+
+        async def submit():
+            # 获取会话信息
+            session_data = await run_db(SessionManager.get_session, session_id)
+            if not session_data:
+                return {'error': '无效的会话 ID'}, 400
+
+            # 只完整发送本轮问答，之前的轮次以上一轮报告（已综合更早的问答）的摘要带入
+            previous_report = latest_report(session_data['reports'])
+
+            # 生成阶段性报告
+            report = await aprocess_answers_to_doc(session_data['idea'], session_data['questions'], answers,
+                                                   custom_api_key=custom_api_key,
+                                                   custom_base_url=custom_base_url,
+                                                   custom_model=custom_model,
+                                                   previous_report=previous_report)
+
+            # 更新会话数据
+            await run_db(SessionManager.update_session_with_answers, session_id, answers, report)
+
+            # 预取下一轮问题（只对服务端 API 配置，未开启时不做任何事）
+            if not custom_api_key and not report.startswith(REPORT_ERROR_PREFIX):
+                question_prefetcher.schedule(session_id)
+
+            return {
+                'session_id': session_id,
+                'report': report
+            }, 200
+
+        # 重复提交与进行中的相同请求共用一次模型调用和一轮记录
+        result, status = await llm_requests.ado(request_key(session_id, 'submit-answers', data), submit)
+        if status == 200:
+            get_recorder('submit_answers.total').record((time.perf_counter() - started) * 1000)
+
+        return result, status
+    except TokenLimitExceeded as e:
+        return e.to_dict(), 429
+    except Exception as e:
+        return {'error': str(e)}, 500
+
+
+async def api_continue_with_feedback(data):
+    """
+    用户提供反馈后继续生成新问题
+    """
+    try:
+        session_id = data.get('session_id', '')
+        feedback = data.get('feedback', '')
+        custom_api_key, custom_base_url, custom_model = _custom_api(data)
+
+        if not session_id or not feedback:
+            return {'error': '会话 ID 和反馈不能为空'}, 400
+
+        async def continue_with_feedback():
+            # 获取会话信息
+            session_data = await run_db(SessionManager.get_session, session_id)
+            if not session_data:
+                return {'error': '无效的会话 ID'}, 400
+
+            # 反馈没有实质内容时优先使用预取的问题，否则放弃预取
+            new_questions = None
+            if not custom_api_key and is_trivial_feedback(feedback):
+                new_questions = await question_prefetcher.atake(session_id, session_data, current_tenant())
+            else:
+                question_prefetcher.cancel(session_id)
+
+            # 基于原始想法、已有问答和用户反馈生成新问题
+            if new_questions is None:
+                new_questions = await agenerate_questions(session_data['idea'], session_data['questions'],
+                                                          session_data['answers'], feedback,
+                                                          custom_api_key=custom_api_key,
+                                                          custom_base_url=custom_base_url,
+                                                          custom_model=custom_model)
+
+            # 替换会话中的问题（而不是追加）
+            await run_db(SessionManager.replace_questions, session_id, new_questions)
+
+            return {
+                'session_id': session_id,
+                'questions': new_questions
+            }, 200
+
+        return await llm_requests.ado(request_key(session_id, 'continue-with-feedback', data),
+                                      continue_with_feedback)
+    except TokenLimitExceeded as e:
+        return e.to_dict(), 429
+    except Exception as e:
+        return {'error': str(e)}, 500
+
+
+async def api_get_job(job_id, query):
+    """
+    查询后台任务，?wait=秒数 时长轮询，等待期间不占用线程
+    """
+    try:
+        try:
+            wait = float(query.get('wait', ['0'])[0])
+        except ValueError:
+            wait = 0
+        wait = min(max(wait, 0), JOB_LONG_POLL_MAX)
+        job = await job_queue.await_job(job_id, wait) if wait else await run_db(job_queue.get, job_id)
+        if job is None:
+            return {'error': '任务不存在'}, 404
+        return job, 200
+    except Exception as e:
+        return {'error': str(e)}, 500
+
+
+def with_token_limit(handler):
+    """异步版本的 check_token_limit：已达单日限额或超出租户配额时返回 429"""
+    async def decorated(data):
+        # 租户在协程中取出：线程池中的任务看不到当前请求的上下文变量
+        error = await run_db(token_limit_error, data, current_tenant())
+        if error:
+            return error, 429
+        return await handler(data)
+    return decorated
+
+
+# (方法, 路径) -> 处理函数
+ROUTES = {
+    ('POST', '/api/generate-questions'): with_token_limit(api_generate_questions),
+    ('POST', '/api/submit-answers'): with_token_limit(api_submit_answers),
+    ('POST', '/api/continue-with-feedback'): with_token_limit(api_continue_with_feedback),
+}
+
+# (方法, 路径前缀) -> 处理函数(路径参数, 查询参数)
+PREFIX_ROUTES = {
+    ('GET', '/api/jobs/'): api_get_job,
+}
@@ -1,15 +1,137 @@
-from flask import jsonify, request
+import contextvars
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Response, jsonify, request, stream_with_context
 from app.routes import bp
-from app.utils.qwen_api import generate_questions, process_answers_to_doc
-from app.utils.token_limit import check_token_limit
+from app.utils.qwen_api import (generate_questions, process_answers_to_doc, stream_answers_to_doc,
+                                stream_questions, client_cache_stats, async_client_cache_stats,
+                                question_cache_stats, question_parse_stats, call_policy_stats,
+                                is_default_questions, latest_report, REPORT_ERROR_PREFIX)
+from app.utils.concurrency import set_bulk_priority
+from app.utils.context import count_tokens
+from app.utils.disconnects import disconnects
+from app.utils.markdown_generator import DOCUMENT_VERSION, iter_document
+from app.utils.job_queue import JobError, QueueFull, job_queue
+from app.utils.prefetch import is_trivial_feedback, question_prefetcher
+from app.utils.question_templates import template_questions, template_stats
+from app.utils.similar_ideas import similar_ideas
+from app.utils.token_limit import TokenLimitExceeded, check_token_limit, token_budget
+from app.utils.tenant_quota import QuotaExceeded, current_tenant, tenant_quotas
+from app.utils.token_usage import token_usage
+from app.utils.metrics import get_recorder, latency_summary
+from app.utils.singleflight import llm_requests, request_key
 from app.models.session import SessionManager
 
+# 长轮询的最长等待时间（秒），应小于前置代理的读超时
+JOB_LONG_POLL_MAX = float(os.getenv('JOB_LONG_POLL_MAX', '30'))
+
+# 批量生成问题：单次请求的想法数上限和同时进行的模型调用数
+BATCH_MAX_IDEAS = int(os.getenv('BATCH_MAX_IDEAS', '500'))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '8'))
+
+
+def _sse(event, data):
+    """格式化一条 Server-Sent Events 消息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _sse_response(events):
+    return Response(stream_with_context(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def _question_events(session_id, questions_iter, persist, started, metric, keep=False, on_disconnect=None,
+                     session_event=False):
+    """
+    把逐个生成的问题转换为 SSE 事件，全部生成后调用 persist 保存完整的问题列表
+
+    事件：session（session_event 为 True 时最先发送）、question（单个问题）、done（完整问题列表，此时已保存）、error
+
+    客户端中途断开时关闭上游的流，不保存（随后调用 on_disconnect(session_id)）；
+    keep 为 True 时读完剩余的问题，照常保存。被取消的模型调用由 questions_iter 记录（见 _cancelled_questions）
+    """
+    questions = []
+    try:
+        if session_event:
+            yield _sse('session', {'session_id': session_id})
+        for question in questions_iter:
+            if not questions:
+                get_recorder(f'{metric}.ttfb').record((time.perf_counter() - started) * 1000)
+            questions.append(question)
+            yield _sse('question', {'question': question})
+
+        persist(session_id, questions)
+    except GeneratorExit:
+        if keep:
+            _finish_after_disconnect(lambda: persist(session_id, questions + list(questions_iter)))
+        else:
+            questions_iter.close()
+            if on_disconnect is not None:
+                on_disconnect(session_id)
+        disconnects.record_abandoned(request.path, kept=keep)
+        raise
+    except TokenLimitExceeded as e:
+        yield _sse('error', e.to_dict())
+        return
+    except Exception as e:
+        print(f"Error streaming questions: {str(e)}")
+        yield _sse('error', {'error': str(e)})
+        return
+
+    get_recorder(f'{metric}.total').record((time.perf_counter() - started) * 1000)
+
+    yield _sse('done', {
+        'session_id': session_id,
+        'questions': questions
+    })
+
+
+def _cancelled_questions(generated_tokens):
+    """stream_questions 的 on_cancel：客户端断开导致生成问题的流式调用被取消"""
+    disconnects.record_cancelled('questions', generated_tokens)
+
+
+def _finish_after_disconnect(finish):
+    """keep_on_disconnect：客户端已断开，在当前线程中完成剩余的生成并保存（不能再向客户端输出）"""
+    try:
+        finish()
+    except Exception as e:
+        print(f"Error finishing request after disconnect: {str(e)}")
+
 
 @bp.route('/api/health', methods=['GET'])
 def health_check():
     return jsonify({'status': 'healthy'})
 
 
+@bp.route('/api/metrics', methods=['GET'])
+def api_metrics():
+    """
+    运行指标（进程内统计，用于调整缓存大小等参数）
+    """
+    return jsonify({
+        'session_cache': SessionManager.session_cache_stats(),
+        'client_cache': client_cache_stats(),
+        'async_client_cache': async_client_cache_stats(),
+        'question_cache': question_cache_stats(),
+        'similar_ideas': similar_ideas.stats(),
+        'question_parsing': question_parse_stats(),
+        'singleflight': llm_requests.stats(),
+        'token_budget': token_budget.stats(),
+        'token_usage': token_usage.stats(),
+        'tenant_quota': tenant_quotas.stats(),
+        'call_policy': call_policy_stats(),
+        'jobs': job_queue.stats(),
+        'prefetch': question_prefetcher.stats(),
+        'disconnects': disconnects.stats(),
+        'instant_questions': template_stats.stats(),
+        'latency': latency_summary()
+    })
+
+
 @bp.route('/api/generate-questions', methods=['POST'])
 @check_token_limit
 def api_generate_questions():
@@ -29,6 +151,11 @@ def api_generate_questions():
         if not idea:
             return jsonify({'error': '想法不能为空'}), 400
 
+        # 先返回模板问题，模型生成的问题在后台生成
+        if data.get('instant'):
+            result, status = start_instant_questions(data, current_tenant())
+            return jsonify(result), status
+
         # 生成唯一会话 ID
         session_id = SessionManager.create_session(idea)
 
@@ -44,16 +171,399 @@ def api_generate_questions():
             'session_id': session_id,
             'questions': questions
         })
+    except TokenLimitExceeded as e:
+        return jsonify(e.to_dict()), 429
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def start_instant_questions(data, tenant):
+    """
+    instant 模式：按想法的交付物类型立即返回模板问题，同时提交后台任务调用模型生成问题，返回 (响应数据, 状态码)
+
+    前端轮询任务，完成后调用 /api/session/<id>/adopt-questions 替换首轮问题；
+    任务队列已满时只返回模板问题（refinement 为 null）
+    """
+    started = time.perf_counter()
+    idea = data['idea']
+    kind, confidence, questions = template_questions(idea)
+    session_id = SessionManager.create_session(idea, questions)
+
+    custom_config = data.get('custom_api') or {}
+    custom_api_key = custom_config.get('api_key')
+    payload = {
+        'custom_base_url': custom_config.get('base_url'),
+        'custom_model': custom_config.get('model'),
+        'has_secrets': bool(custom_api_key)
+    }
+    try:
+        job_id, _ = job_queue.submit('refine-questions', session_id, payload, tenant=tenant,
+                                     secrets={'custom_api_key': custom_api_key} if custom_api_key else None)
+        refinement = {'job_id': job_id, 'status_url': f'/api/jobs/{job_id}'}
+    except QueueFull:
+        refinement = None
+
+    get_recorder('generate_questions_instant.total').record((time.perf_counter() - started) * 1000)
+    return {
+        'session_id': session_id,
+        'questions': questions,
+        'source': 'template',
+        'deliverable_type': kind,
+        'confidence': confidence,
+        'refinement': refinement
+    }, 200
+
+
+def run_refine_questions_job(job_id, session_id, payload, secrets):
+    """后台任务：调用模型生成首轮问题，结果保存在任务中，由前端决定是否替换模板问题"""
+    session_data = SessionManager.get_session(session_id)
+    if not session_data:
+        raise JobError('无效的会话 ID')
+
+    questions = generate_questions(session_data['idea'], custom_api_key=secrets.get('custom_api_key'),
+                                   custom_base_url=payload.get('custom_base_url'),
+                                   custom_model=payload.get('custom_model'))
+
+    # 模型调用失败时交给任务队列重试，模板问题仍然可用
+    if is_default_questions(questions):
+        raise RuntimeError('生成问题失败')
+
+    SessionManager.complete_job(job_id, {'questions': questions})
+
+
+job_queue.register('refine-questions', run_refine_questions_job, endpoint='/api/generate-questions')
+
+
+@bp.route('/api/session/<session_id>/adopt-questions', methods=['POST'])
+def api_adopt_questions(session_id):
+    """
+    用后台生成的问题替换首轮的模板问题（instant 模式），只能在提交首轮答案之前替换
+    """
+    try:
+        data = request.get_json() or {}
+        job_id = data.get('job_id')
+        if not job_id:
+            return jsonify({'error': '缺少 job_id'}), 400
+
+        questions, reason = SessionManager.adopt_questions(session_id, job_id)
+        if reason == 'missing':
+            return jsonify({'error': '任务不存在'}), 404
+        if reason == 'pending':
+            return jsonify({'error': '问题还在生成中'}), 409
+        if reason == 'stale':
+            return jsonify({'error': '已经提交过答案，不能再替换首轮问题'}), 409
+
+        # 重复请求（例如前端重试）不重复计数
+        if reason is None:
+            template_stats.record_adopted()
+        return jsonify({
+            'session_id': session_id,
+            'questions': questions
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@bp.route('/api/generate-questions/stream', methods=['POST'])
+@check_token_limit
+def api_generate_questions_stream():
+    """
+    根据用户想法生成问题，以 Server-Sent Events 逐个推送
+
+    事件：session（新会话 ID）、question、done、error
+    """
+    started = time.perf_counter()
+    try:
+        data = request.get_json()
+        idea = data.get('idea', '')
+
+        # 获取自定义 API 配置
+        custom_config = data.get('custom_api') or {}
+        custom_api_key = custom_config.get('api_key')
+        custom_base_url = custom_config.get('base_url')
+        custom_model = custom_config.get('model')
+
+        if not idea:
+            return jsonify({'error': '想法不能为空'}), 400
+
+        # 生成唯一会话 ID
+        session_id = SessionManager.create_session(idea)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    keep = bool(data.get('keep_on_disconnect'))
+
+    questions_iter = stream_questions(idea, custom_api_key=custom_api_key,
+                                      custom_base_url=custom_base_url,
+                                      custom_model=custom_model,
+                                      on_cancel=_cancelled_questions)
+    # 客户端中途断开（包括在 session 事件时断开）时删除刚创建的空会话
+    return _sse_response(_question_events(session_id, questions_iter, SessionManager.save_questions,
+                                          started, 'generate_questions_stream', keep=keep,
+                                          on_disconnect=SessionManager.delete_session, session_event=True))
+
+
+@bp.route('/api/generate-questions/batch', methods=['POST'])
+@check_token_limit
+def api_generate_questions_batch():
+    """
+    批量导入想法：在一个事务中创建全部会话，并发生成问题，以 NDJSON 逐行返回
+
+    每个想法完成时输出一行 {"index", "session_id", "questions"}（失败时为 {"index", "error"}，
+    预先创建的会话随即删除），完成顺序不一定与输入顺序一致；
+    最后一行为 {"done": true, "total", "succeeded", "failed"}
+    """
+    try:
+        data = request.get_json()
+        ideas = data.get('ideas')
+
+        # 获取自定义 API 配置
+        custom_config = data.get('custom_api') or {}
+        custom_api_key = custom_config.get('api_key')
+        custom_base_url = custom_config.get('base_url')
+        custom_model = custom_config.get('model')
+
+        if not isinstance(ideas, list) or not ideas:
+            return jsonify({'error': '想法列表不能为空'}), 400
+        if len(ideas) > BATCH_MAX_IDEAS:
+            return jsonify({'error': f'单次最多导入 {BATCH_MAX_IDEAS} 个想法'}), 400
+        if not all(isinstance(idea, str) and idea.strip() for idea in ideas):
+            return jsonify({'error': '想法不能为空'}), 400
+
+        # 调用方可以要求更低的并发，不能超过服务端上限
+        try:
+            concurrency = int(data.get('concurrency') or BATCH_CONCURRENCY)
+        except (TypeError, ValueError):
+            concurrency = 0
+        if concurrency < 1:
+            return jsonify({'error': '并发数必须是正整数'}), 400
+        concurrency = min(concurrency, BATCH_CONCURRENCY, len(ideas))
+
+        session_ids = SessionManager.create_sessions(ideas)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    tenant = current_tenant()
+
+    def generate_one(index):
+        # 在复制的上下文中执行：批量导入的模型调用排在交互式请求之后（见 app/utils/concurrency.py）
+        set_bulk_priority()
+        # 准入检查时已计入一次请求，其余每个想法各计一次
+        if index > 0:
+            tenant_quotas.admit(tenant, count_tokens=not custom_api_key)
+        questions = generate_questions(ideas[index], custom_api_key=custom_api_key,
+                                       custom_base_url=custom_base_url,
+                                       custom_model=custom_model)
+        # 模型调用失败时返回的是默认问题，不保存，计为失败
+        if is_default_questions(questions):
+            raise RuntimeError('生成问题失败')
+        SessionManager.save_questions(session_ids[index], questions)
+        return questions
+
+    def discard(index):
+        """删除失败或未执行的想法预先创建的空会话"""
+        try:
+            SessionManager.delete_session(session_ids[index])
+        except Exception as e:
+            print(f"Error deleting batch session: {str(e)}")
+
+    def generate():
+        started = time.perf_counter()
+        failed = 0
+        futures = {}
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch')
+        try:
+            # 每个任务在请求上下文的副本中执行，用量计入本接口和当前租户
+            futures = {
+                executor.submit(contextvars.copy_context().run, generate_one, index): index
+                for index in range(len(ideas))
+            }
+            for future in as_completed(futures):
+                index = futures[future]
+                line = {'index': index}
+                try:
+                    line['questions'] = future.result()
+                    line['session_id'] = session_ids[index]
+                except (TokenLimitExceeded, QuotaExceeded) as e:
+                    line.update(e.to_dict())
+                    failed += 1
+                    discard(index)
+                except Exception as e:
+                    print(f"Error generating questions in batch: {str(e)}")
+                    line['error'] = str(e)
+                    failed += 1
+                    discard(index)
+                yield json.dumps(line, ensure_ascii=False) + '\n'
+        finally:
+            # 客户端断开时不再开始尚未执行的调用，删除这些想法的空会话
+            executor.shutdown(wait=False, cancel_futures=True)
+            for future, index in futures.items():
+                if future.cancelled():
+                    discard(index)
+
+        get_recorder('generate_questions_batch.total').record((time.perf_counter() - started) * 1000)
+        yield json.dumps({
+            'done': True,
+            'total': len(ideas),
+            'succeeded': len(ideas) - failed,
+            'failed': failed
+        }) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @bp.route('/api/submit-answers', methods=['POST'])
 @check_token_limit
 def api_submit_answers():
     """
     提交问题答案，生成阶段性报告
     """
+    started = time.perf_counter()
+    try:
+        data = request.get_json()
+        session_id = data.get('session_id', '')
+        answers = data.get('answers', [])
+
+        # 获取自定义 API 配置
+        custom_config = data.get('custom_api') or {}
+        custom_api_key = custom_config.get('api_key')
+        custom_base_url = custom_config.get('base_url')
+        custom_model = custom_config.get('model')
+
+        if not session_id or not answers:
+            return jsonify({'error': '会话 ID 和答案不能为空'}), 400
+
+        # 异步模式：放入后台任务队列，立即返回任务 ID
+        if data.get('async'):
+            result, status = enqueue_submit_answers(data, current_tenant())
+            return jsonify(result), status
+
+        def submit():
+            # 获取会话信息
+            session_data = SessionManager.get_session(session_id)
+            if not session_data:
+                return {'error': '无效的会话 ID'}, 400
+
+            # 只完整发送本轮问答，之前的轮次以上一轮报告（已综合更早的问答）的摘要带入
+            previous_report = latest_report(session_data['reports'])
+
+            # 生成阶段性报告
+            report = process_answers_to_doc(session_data['idea'], session_data['questions'], answers,
+                                           custom_api_key=custom_api_key,
+                                           custom_base_url=custom_base_url,
+                                           custom_model=custom_model,
+                                           previous_report=previous_report)
+
+            # 更新会话数据
+            SessionManager.update_session_with_answers(session_id, answers, report)
+
+            # 预取下一轮问题（只对服务端 API 配置，未开启时不做任何事）
+            if not custom_api_key and not report.startswith(REPORT_ERROR_PREFIX):
+                question_prefetcher.schedule(session_id)
+
+            return {
+                'session_id': session_id,
+                'report': report
+            }, 200
+
+        # 重复提交（双击、前端重试）与进行中的相同请求共用一次模型调用和一轮记录
+        result, status = llm_requests.do(request_key(session_id, 'submit-answers', data), submit)
+        if status == 200:
+            get_recorder('submit_answers.total').record((time.perf_counter() - started) * 1000)
+
+        return jsonify(result), status
+    except TokenLimitExceeded as e:
+        return jsonify(e.to_dict()), 429
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+def enqueue_submit_answers(data, tenant):
+    """
+    把提交答案放入后台任务队列，返回 (响应数据, 状态码)
+
+    相同的提交还在排队或执行时返回同一个任务；自定义 API 的密钥不写入任务表
+    """
+    session_id = data['session_id']
+    if not SessionManager.get_session(session_id):
+        return {'error': '无效的会话 ID'}, 400
+
+    custom_config = data.get('custom_api') or {}
+    custom_api_key = custom_config.get('api_key')
+    payload = {
+        'answers': data['answers'],
+        'custom_base_url': custom_config.get('base_url'),
+        'custom_model': custom_config.get('model'),
+        'has_secrets': bool(custom_api_key)
+    }
+
+    try:
+        job_id, _ = job_queue.submit('submit-answers', session_id, payload,
+                                     dedupe_key=request_key(session_id, 'submit-answers', data),
+                                     tenant=tenant,
+                                     secrets={'custom_api_key': custom_api_key} if custom_api_key else None)
+    except QueueFull as e:
+        return e.to_dict(), 503
+
+    return {
+        'job_id': job_id,
+        'session_id': session_id,
+        'status_url': f'/api/jobs/{job_id}'
+    }, 202
+
+
+def run_submit_answers_job(job_id, session_id, payload, secrets):
+    """后台任务：生成阶段性报告，写入本轮数据的同时把任务标记为完成"""
+    session_data = SessionManager.get_session(session_id)
+    if not session_data:
+        raise JobError('无效的会话 ID')
+
+    answers = payload['answers']
+    report = process_answers_to_doc(session_data['idea'], session_data['questions'], answers,
+                                    custom_api_key=secrets.get('custom_api_key'),
+                                    custom_base_url=payload.get('custom_base_url'),
+                                    custom_model=payload.get('custom_model'),
+                                    previous_report=latest_report(session_data['reports']))
+
+    # 模型调用失败时不保存本轮数据，交给任务队列重试
+    if report.startswith(REPORT_ERROR_PREFIX):
+        raise RuntimeError(report[len(REPORT_ERROR_PREFIX):])
+
+    if SessionManager.update_session_with_answers(session_id, answers, report, job_id=job_id) is None:
+        raise JobError('无效的会话 ID')
+
+    if not payload.get('has_secrets'):
+        question_prefetcher.schedule(session_id)
+
+
+job_queue.register('submit-answers', run_submit_answers_job, endpoint='/api/submit-answers')
+
+
+@bp.route('/api/jobs/<job_id>', methods=['GET'])
+def api_get_job(job_id):
+    """
+    查询后台任务，?wait=秒数 时长轮询：任务结束或超时后返回
+    """
+    try:
+        wait = min(max(request.args.get('wait', 0, type=float), 0), JOB_LONG_POLL_MAX)
+        job = job_queue.wait(job_id, wait) if wait else job_queue.get(job_id)
+        if job is None:
+            return jsonify({'error': '任务不存在'}), 404
+        return jsonify(job)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@bp.route('/api/submit-answers/stream', methods=['POST'])
+@check_token_limit
+def api_submit_answers_stream():
+    """
+    提交问题答案，以 Server-Sent Events 流式返回阶段性报告
+
+    事件：chunk（报告片段）、done（完整报告和轮次号，此时已保存）、error
+    """
+    started = time.perf_counter()
     try:
         data = request.get_json()
         session_id = data.get('session_id', '')
@@ -73,31 +583,69 @@ def api_submit_answers():
         if not session_data:
             return jsonify({'error': '无效的会话 ID'}), 400
 
-        # 使用所有历史问题和答案（包括之前轮次的）
-        all_questions = session_data['questions']
-        all_answers = session_data['answers'] + answers  # 合并历史答案和新答案
-
-        # 生成阶段性报告（基于所有历史问答）
-        report = process_answers_to_doc(session_data['idea'], all_questions, all_answers,
-                                       custom_api_key=custom_api_key,
-                                       custom_base_url=custom_base_url,
-                                       custom_model=custom_model)
-
-        # 更新会话数据
-        SessionManager.update_session_with_answers(session_id, answers, report)
+        # 只完整发送本轮问答，之前的轮次以上一轮报告（已综合更早的问答）的摘要带入
+        previous_report = latest_report(session_data['reports'])
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        return jsonify({
+    keep = bool(data.get('keep_on_disconnect'))
+
+    def save(report):
+        round_number = SessionManager.update_session_with_answers(session_id, answers, report)
+        # 预取下一轮问题（只对服务端 API 配置，未开启时不做任何事）
+        if not custom_api_key:
+            question_prefetcher.schedule(session_id)
+        return round_number
+
+    def generate():
+        chunks = []
+        contents = stream_answers_to_doc(session_data['idea'], session_data['questions'], answers,
+                                         custom_api_key=custom_api_key,
+                                         custom_base_url=custom_base_url,
+                                         custom_model=custom_model,
+                                         previous_report=previous_report)
+        try:
+            for content in contents:
+                if not chunks:
+                    get_recorder('submit_answers_stream.ttfb').record((time.perf_counter() - started) * 1000)
+                chunks.append(content)
+                yield _sse('chunk', {'content': content})
+
+            # 报告完整生成后才保存本轮数据
+            report = ''.join(chunks).strip()
+            round_number = save(report)
+        except GeneratorExit:
+            # 客户端中途断开：关闭上游的流，本轮不保存（keep_on_disconnect 时生成完照常保存）
+            if keep:
+                _finish_after_disconnect(lambda: save(''.join(chunks + list(contents)).strip()))
+            else:
+                contents.close()
+                disconnects.record_cancelled('report', count_tokens(''.join(chunks)))
+            disconnects.record_abandoned(request.path, kept=keep)
+            raise
+        except TokenLimitExceeded as e:
+            yield _sse('error', e.to_dict())
+            return
+        except Exception as e:
+            print(f"Error streaming report: {str(e)}")
+            yield _sse('error', {'error': str(e)})
+            return
+
+        get_recorder('submit_answers_stream.total').record((time.perf_counter() - started) * 1000)
+
+        yield _sse('done', {
             'session_id': session_id,
+            'round': round_number,
             'report': report
         })
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+
+    return _sse_response(generate())
 
 
 @bp.route('/api/generate-pdf', methods=['POST'])
 def api_generate_pdf():
     """
-    生成最终 PDF 文档
+    生成最终文档：返回下载地址，文档在下载时按会话当前的数据生成
     """
     try:
         data = request.get_json()
@@ -106,14 +654,9 @@ def api_generate_pdf():
         if not session_id:
             return jsonify({'error': '会话 ID 不能为空'}), 400
 
-        # 获取会话信息
-        session_data = SessionManager.get_session(session_id)
-        if not session_data:
+        if SessionManager.get_session_version(session_id) is None:
             return jsonify({'error': '无效的会话 ID'}), 400
 
-        # 生成 PDF 文档
-        pdf_path = SessionManager.generate_pdf_report(session_id)
-
         return jsonify({
             'session_id': session_id,
             'pdf_url': f'/api/download-pdf/{session_id}'
@@ -183,6 +726,67 @@ def api_continue_with_feedback():
         custom_base_url = custom_config.get('base_url')
         custom_model = custom_config.get('model')
 
+        if not session_id or not feedback:
+            return jsonify({'error': '会话 ID 和反馈不能为空'}), 400
+
+        def continue_with_feedback():
+            # 获取会话信息
+            session_data = SessionManager.get_session(session_id)
+            if not session_data:
+                return {'error': '无效的会话 ID'}, 400
+
+            # 反馈没有实质内容时优先使用预取的问题，否则放弃预取
+            new_questions = None
+            if not custom_api_key and is_trivial_feedback(feedback):
+                new_questions = question_prefetcher.take(session_id, session_data, current_tenant())
+            else:
+                question_prefetcher.cancel(session_id)
+
+            # 基于原始想法、已有问答和用户反馈生成新问题
+            if new_questions is None:
+                new_questions = generate_questions(session_data['idea'], session_data['questions'],
+                                                  session_data['answers'], feedback,
+                                                  custom_api_key=custom_api_key,
+                                                  custom_base_url=custom_base_url,
+                                                  custom_model=custom_model)
+
+            # 替换会话中的问题（而不是追加）
+            SessionManager.replace_questions(session_id, new_questions)
+
+            return {
+                'session_id': session_id,
+                'questions': new_questions
+            }, 200
+
+        result, status = llm_requests.do(request_key(session_id, 'continue-with-feedback', data),
+                                         continue_with_feedback)
+        return jsonify(result), status
+    except TokenLimitExceeded as e:
+        return jsonify(e.to_dict()), 429
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@bp.route('/api/continue-with-feedback/stream', methods=['POST'])
+@check_token_limit
+def api_continue_with_feedback_stream():
+    """
+    用户提供反馈后继续生成新问题，以 Server-Sent Events 逐个推送
+
+    事件：question、done（此时新问题已替换会话中的问题）、error
+    """
+    started = time.perf_counter()
+    try:
+        data = request.get_json()
+        session_id = data.get('session_id', '')
+        feedback = data.get('feedback', '')
+
+        # 获取自定义 API 配置
+        custom_config = data.get('custom_api') or {}
+        custom_api_key = custom_config.get('api_key')
+        custom_base_url = custom_config.get('base_url')
+        custom_model = custom_config.get('model')
+
         if not session_id or not feedback:
             return jsonify({'error': '会话 ID 和反馈不能为空'}), 400
 
@@ -190,80 +794,70 @@ def api_continue_with_feedback():
         session_data = SessionManager.get_session(session_id)
         if not session_data:
             return jsonify({'error': '无效的会话 ID'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        # 基于原始想法、已有问答和用户反馈生成新问题
-        new_questions = generate_questions(session_data['idea'], session_data['questions'],
-                                          session_data['answers'], feedback,
-                                          custom_api_key=custom_api_key,
-                                          custom_base_url=custom_base_url,
-                                          custom_model=custom_model)
+    tenant = current_tenant()
 
-        # 替换会话中的问题（而不是追加）
-        SessionManager.replace_questions(session_id, new_questions)
+    def questions_iter():
+        # 反馈没有实质内容时优先使用预取的问题（在流中等待，不阻塞响应开始），否则放弃预取
+        if not custom_api_key and is_trivial_feedback(feedback):
+            prefetched = question_prefetcher.take(session_id, session_data, tenant)
+            if prefetched is not None:
+                yield from prefetched
+                return
+        else:
+            question_prefetcher.cancel(session_id)
 
-        return jsonify({
-            'session_id': session_id,
-            'questions': new_questions
-        })
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        yield from stream_questions(session_data['idea'], session_data['questions'],
+                                    session_data['answers'], feedback,
+                                    custom_api_key=custom_api_key,
+                                    custom_base_url=custom_base_url,
+                                    custom_model=custom_model,
+                                    on_cancel=_cancelled_questions)
+
+    return _sse_response(_question_events(session_id, questions_iter(), SessionManager.replace_questions,
+                                          started, 'continue_with_feedback_stream',
+                                          keep=bool(data.get('keep_on_disconnect'))))
+
+
+def _document_etag(session_id, updated_at):
+    """需求文档的强 ETag：会话的每次写入都会更新 updated_at，文档格式变化时 DOCUMENT_VERSION 递增"""
+    raw = f'{DOCUMENT_VERSION}:{session_id}:{updated_at}'
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
 
 
 @bp.route('/api/download-pdf/<session_id>', methods=['GET'])
 def api_download_pdf(session_id):
     """
-    下载报告（现在是 Markdown 格式）
+    下载需求文档（Markdown 格式）
+
+    按会话当前的数据直接生成到响应中，不写入文件；请求带 If-None-Match 且与当前 ETag 相同时返回 304，
+    此时只读取会话的 updated_at
     """
     try:
-        # 获取会话信息
-        session_data = SessionManager.get_session(session_id)
-        if not session_data:
+        version = SessionManager.get_session_version(session_id)
+        if version is None:
             return "未找到会话", 404
 
-        # 如果没有文档，生成一个
-        if not session_data.get('final_doc'):
-            from flask import send_file
-            import os
-            # 创建输出目录
-            output_dir = "output"
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-
-            # 生成 Markdown 文件
-            filename = f"requirement_document_{session_id[:8]}.md"
-            filepath = os.path.join(output_dir, filename)
-
-            from app.utils.markdown_generator import generate_markdown
-            generate_markdown(session_data, filepath)
-
-            # 在数据库中记录文件路径
-            import sqlite3
-            conn = sqlite3.connect(SessionManager.DB_PATH)
-            cursor = conn.cursor()
-
-            from datetime import datetime
-            updated_at = datetime.now().isoformat()
-            cursor.execute("""
-                UPDATE sessions
-                SET final_doc_path = ?, updated_at = ?
-                WHERE id = ?
-            """, (filepath, updated_at, session_id))
-
-            conn.commit()
-            conn.close()
+        etag = _document_etag(session_id, version)
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
         else:
-            filepath = session_data['final_doc']
-
-        from flask import send_file
-        import os
-        if not os.path.exists(filepath):
-            return "文件不存在", 404
-
-        # 确定正确的文件扩展名
-        file_ext = os.path.splitext(filepath)[1]
-        download_name = f"requirement_document_{session_id[:8]}{file_ext}"
-
-        return send_file(filepath, as_attachment=True, download_name=download_name)
+            document = SessionManager.get_document(session_id)
+            if not document:
+                return "未找到会话", 404
+
+            # 读取期间会话可能又有写入，ETag 以实际生成文档的数据为准
+            etag = _document_etag(session_id, document['updated_at'])
+            response = Response(iter_document(document), mimetype='text/markdown')
+            response.headers['Content-Disposition'] = (
+                f'attachment; filename=requirement_document_{session_id[:8]}.md')
+
+        response.set_etag(etag)
+        # 浏览器可以缓存，但每次使用前都要用 ETag 向服务端确认
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
     except Exception as e:
         return str(e), 500
 
@@ -281,6 +875,7 @@ def api_delete_session(session_id):
 
         # 删除会话
         SessionManager.delete_session(session_id)
+        question_prefetcher.cancel(session_id)
 
         return jsonify({
             'message': '删除成功'
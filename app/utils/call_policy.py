@@ -0,0 +1,469 @@
+"""
+模型调用的超时、重试、对冲请求和熔断
+
+- 截止时间：每个接口有总的截止时间（LLM_<接口>_DEADLINE），每次尝试的超时为剩余时间
+- 重试：连接错误、超时、限流和 5xx 按指数退避加随机抖动重试，最多 LLM_MAX_RETRIES 次，不超过截止时间
+- 对冲：LLM_HEDGE=1 时，调用耗时超过该 (base_url, 模型) 近期 p95 仍未返回，就再发一个相同的请求
+  （LLM_<接口>_HEDGE_MODEL 可以指定更快的模型），先返回的结果生效。异步路径取消落后的请求（关闭连接）；
+  同步路径无法中断另一个线程中的请求，落后的请求结束后丢弃结果并记录用量
+- 熔断：每个 (base_url, 模型) 连续失败 LLM_BREAKER_FAILURES 次后熔断 LLM_BREAKER_COOLDOWN 秒，
+  期间直接失败（设置了对冲模型时改用对冲模型），冷却结束后放行请求试探，成功即恢复；
+  限流（429）只降低并发上限，不计入熔断
+- 并发：每次请求先从该 (base_url, 模型) 的自适应并发限制（app/utils/concurrency.py）获取名额，
+  排队时间计入截止时间；流式请求持有名额直到流关闭；对冲请求只在有空闲名额时发出
+"""
+import asyncio
+import contextvars
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import openai
+
+from app.utils.concurrency import LimiterRejected, LimiterTimeout, get_limiter
+from app.utils.metrics import LatencyRecorder, get_recorder
+
+# 可以重试的错误：连接失败、超时、限流和服务端错误
+TRANSIENT_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+# 说明上游过载的错误：并发上限随之减小
+OVERLOAD_ERRORS = (openai.RateLimitError, openai.APITimeoutError)
+
+# 重试退避的上限（秒）
+MAX_BACKOFF = 8.0
+
+
+class DeadlineExceeded(TimeoutError):
+    """超过接口的截止时间仍没有成功的响应"""
+
+
+class CircuitOpen(Exception):
+    """(base_url, 模型) 处于熔断状态"""
+
+
+class CircuitBreaker:
+    """单个 (base_url, 模型) 的熔断状态，同时记录近期成功调用的耗时，用于计算对冲时机"""
+
+    def __init__(self, failure_threshold=5, cooldown=30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.latency = LatencyRecorder(window=200)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at < self.cooldown:
+                return 'open'
+            return 'half_open'
+
+    def allow(self):
+        """熔断期间返回 False；冷却结束后（半开）放行，由下一次结果决定恢复还是重新熔断"""
+        return self.state != 'open'
+
+    def record_success(self, elapsed_ms):
+        self.latency.record(elapsed_ms)
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            # 半开状态下试探失败立即重新熔断
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+# (base_url, 模型) -> CircuitBreaker，按最近使用淘汰（自定义 API 配置的地址数量不受控制）
+_breakers = OrderedDict()
+_breakers_lock = threading.Lock()
+MAX_BREAKERS = 256
+
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+
+def get_breaker(base_url, model):
+    key = (str(base_url), model)
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(int(os.getenv('LLM_BREAKER_FAILURES', '5')),
+                                     float(os.getenv('LLM_BREAKER_COOLDOWN', '30')))
+            _breakers[key] = breaker
+            while len(_breakers) > MAX_BREAKERS:
+                _breakers.popitem(last=False)
+        else:
+            _breakers.move_to_end(key)
+        return breaker
+
+
+def breaker_stats():
+    """各状态的熔断器数量（不列出 base_url，其中可能有用户自定义的地址）"""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    counts = {'closed': 0, 'open': 0, 'half_open': 0}
+    for breaker in breakers:
+        counts[breaker.state] += 1
+    return counts
+
+
+class _HeldStream:
+    """流式响应的代理：流关闭时才归还并发名额（调用方在 finally 中关闭流）"""
+
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            self._done()
+
+    def _done(self):
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+
+    def __del__(self):
+        # 调用方没有关闭流时兜底归还
+        self._done()
+
+
+def _get_hedge_executor():
+    """同步路径对冲时执行请求的线程池（只在启用对冲时创建）"""
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _hedge_executor_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(
+                    max_workers=int(os.getenv('LLM_MAX_CONNECTIONS', '100')),
+                    thread_name_prefix='llm-hedge'
+                )
+    return _hedge_executor
+
+
+class CallPolicy:
+    """
+    一类模型调用（生成问题、生成报告）的调用策略
+
+    call / acall / open_stream 接收 fn(model, timeout)，由 fn 发出实际的请求，
+    返回 (响应, 实际使用的模型)
+    """
+
+    def __init__(self, name, deadline, max_retries=2, backoff=0.5, hedge=False, hedge_model=None,
+                 hedge_percentile=0.95, hedge_min_samples=20):
+        self.name = name
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.hedge = hedge
+        self.hedge_model = hedge_model or None
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.recorder = get_recorder(f'llm.{name}')
+        self._lock = threading.Lock()
+        self.counters = {'calls': 0, 'retries': 0, 'hedged': 0, 'hedge_wins': 0,
+                         'deadline_exceeded': 0, 'circuit_open': 0, 'fallback_model': 0,
+                         'queue_timeout': 0, 'queue_rejected': 0}
+
+    @classmethod
+    def from_env(cls, name, default_deadline):
+        prefix = f'LLM_{name.upper()}_'
+        return cls(
+            name,
+            deadline=float(os.getenv(prefix + 'DEADLINE', str(default_deadline))),
+            max_retries=int(os.getenv('LLM_MAX_RETRIES', '2')),
+            backoff=float(os.getenv('LLM_RETRY_BACKOFF', '0.5')),
+            hedge=os.getenv('LLM_HEDGE', '0') == '1',
+            hedge_model=os.getenv(prefix + 'HEDGE_MODEL'),
+            hedge_percentile=float(os.getenv('LLM_HEDGE_PERCENTILE', '0.95')),
+            hedge_min_samples=int(os.getenv('LLM_HEDGE_MIN_SAMPLES', '20'))
+        )
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _choose_model(self, base_url, model, allow_fallback):
+        """主模型熔断时改用对冲模型，都不可用时抛出 CircuitOpen"""
+        if get_breaker(base_url, model).allow():
+            return model
+        if allow_fallback and self.hedge_model and self.hedge_model != model \
+                and get_breaker(base_url, self.hedge_model).allow():
+            self._count('fallback_model')
+            return self.hedge_model
+        self._count('circuit_open')
+        raise CircuitOpen(f"模型 {model} 暂时不可用（连续调用失败，已熔断）")
+
+    def _hedge_delay(self, breaker):
+        """开始对冲前等待的秒数，近期样本不足时返回 None（不对冲）"""
+        if breaker.latency.count < self.hedge_min_samples:
+            return None
+        return breaker.latency.percentile(self.hedge_percentile) / 1000
+
+    def _backoff(self, attempt, remaining):
+        """指数退避加全随机抖动，不超过剩余时间"""
+        return min(remaining, random.uniform(0, min(MAX_BACKOFF, self.backoff * (2 ** attempt))))
+
+    def _record(self, breaker, started):
+        """记录成功调用的耗时，返回耗时（秒）"""
+        elapsed = time.perf_counter() - started
+        breaker.record_success(elapsed * 1000)
+        self.recorder.record(elapsed * 1000)
+        return elapsed
+
+    def _attempt(self, base_url, model, fn, timeout, hold=False):
+        """
+        执行一次请求：先获取并发名额（排队时间从 timeout 中扣除），结束后按结果归还
+
+        hold=True 时（流式请求）返回的流在关闭时才归还名额
+        """
+        breaker = get_breaker(base_url, model)
+        limiter = get_limiter(base_url, model)
+        queued_at = time.monotonic()
+        self._acquire(limiter.acquire, timeout)
+        timeout -= time.monotonic() - queued_at
+
+        started = time.perf_counter()
+        try:
+            response = fn(model, max(timeout, 0.001))
+        except TRANSIENT_ERRORS as e:
+            # 429 说明服务端在工作、只是需要降低并发：交给并发限制处理，不计入熔断
+            if not isinstance(e, openai.RateLimitError):
+                breaker.record_failure()
+            limiter.release(overloaded=isinstance(e, OVERLOAD_ERRORS))
+            raise
+        except BaseException:
+            limiter.release()
+            raise
+        elapsed = self._record(breaker, started)
+        if hold:
+            return _HeldStream(response, lambda: limiter.release(elapsed))
+        limiter.release(elapsed)
+        return response
+
+    async def _aattempt(self, base_url, model, fn, timeout):
+        breaker = get_breaker(base_url, model)
+        limiter = get_limiter(base_url, model)
+        queued_at = time.monotonic()
+        await self._aacquire(limiter, timeout)
+        timeout -= time.monotonic() - queued_at
+
+        started = time.perf_counter()
+        try:
+            response = await fn(model, max(timeout, 0.001))
+        except TRANSIENT_ERRORS as e:
+            # 429 说明服务端在工作、只是需要降低并发：交给并发限制处理，不计入熔断
+            if not isinstance(e, openai.RateLimitError):
+                breaker.record_failure()
+            limiter.release(overloaded=isinstance(e, OVERLOAD_ERRORS))
+            raise
+        except BaseException:
+            # 包括对冲中被取消的落后请求
+            limiter.release()
+            raise
+        limiter.release(self._record(breaker, started))
+        return response
+
+    def _acquire(self, acquire, timeout):
+        try:
+            acquire(timeout)
+        except LimiterTimeout:
+            self._count('queue_timeout')
+            raise
+        except LimiterRejected:
+            self._count('queue_rejected')
+            raise
+
+    async def _aacquire(self, limiter, timeout):
+        try:
+            await limiter.aacquire(timeout)
+        except LimiterTimeout:
+            self._count('queue_timeout')
+            raise
+        except LimiterRejected:
+            self._count('queue_rejected')
+            raise
+
+    def _retrying(self, attempt_fn, base_url, model, allow_fallback):
+        """
+        同步重试循环，attempt_fn(model, timeout) 执行一次（可能对冲的）尝试，返回 (响应, 模型)
+        """
+        self._count('calls')
+        deadline_at = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                self._count('deadline_exceeded')
+                raise DeadlineExceeded(f"模型调用超过 {self.deadline:g} 秒仍未完成")
+            chosen = self._choose_model(base_url, model, allow_fallback)
+            try:
+                return attempt_fn(chosen, remaining)
+            except TRANSIENT_ERRORS as e:
+                remaining = deadline_at - time.monotonic()
+                if attempt >= self.max_retries or remaining <= 0:
+                    if remaining <= 0:
+                        self._count('deadline_exceeded')
+                    raise
+                print(f"Retrying {self.name} call after error: {str(e)}")
+                self._count('retries')
+                time.sleep(self._backoff(attempt, remaining))
+                attempt += 1
+
+    def call(self, base_url, model, fn, hedge=True, on_discard=None):
+        """
+        同步调用。hedge=False（例如使用自定义 API 配置时）不对冲也不改用对冲模型；
+        on_discard(response) 在对冲中落后但成功返回的响应上调用（用于记录其用量）
+        """
+        def attempt_fn(chosen, timeout):
+            return self._hedged(base_url, chosen, fn, timeout, on_discard) if hedge and self.hedge \
+                else (self._attempt(base_url, chosen, fn, timeout), chosen)
+
+        return self._retrying(attempt_fn, base_url, model, hedge)
+
+    def _hedged(self, base_url, model, fn, timeout, on_discard):
+        delay = self._hedge_delay(get_breaker(base_url, model))
+        if delay is None or delay >= timeout:
+            return self._attempt(base_url, model, fn, timeout), model
+
+        # 线程池中的请求在当前请求上下文的副本中执行（租户、调度类别）
+        executor = _get_hedge_executor()
+        primary = executor.submit(contextvars.copy_context().run, self._attempt, base_url, model, fn, timeout)
+        if wait([primary], timeout=delay).done:
+            return primary.result(), model
+
+        # 对冲请求不排队：没有空闲名额时只等主请求
+        hedge_model = self.hedge_model or model
+        if not get_breaker(base_url, hedge_model).allow() or not get_limiter(base_url, hedge_model).has_capacity():
+            return primary.result(), model
+
+        self._count('hedged')
+        secondary = executor.submit(contextvars.copy_context().run, self._attempt, base_url, hedge_model, fn,
+                                    timeout - delay)
+        models = {primary: model, secondary: hedge_model}
+        # 落后的请求在线程池中结束后，在当前请求的上下文（接口、租户）中记录用量
+        context = contextvars.copy_context()
+
+        def discard(future):
+            if on_discard is not None and not future.cancelled() and future.exception() is None:
+                context.run(on_discard, future.result())
+
+        pending = set(models)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.add_done_callback(discard)
+                    if future is secondary:
+                        self._count('hedge_wins')
+                    return future.result(), models[future]
+                error = future.exception()
+        raise error
+
+    async def acall(self, base_url, model, fn, hedge=True, on_discard=None):
+        """
+        异步调用，fn(model, timeout) 返回协程；对冲时取消落后的请求，
+        on_discard(response) 在与胜出者同时成功返回、结果被丢弃的响应上调用
+        """
+        self._count('calls')
+        deadline_at = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                self._count('deadline_exceeded')
+                raise DeadlineExceeded(f"模型调用超过 {self.deadline:g} 秒仍未完成")
+            chosen = self._choose_model(base_url, model, hedge)
+            try:
+                if hedge and self.hedge:
+                    return await self._ahedged(base_url, chosen, fn, remaining, on_discard)
+                return await self._aattempt(base_url, chosen, fn, remaining), chosen
+            except TRANSIENT_ERRORS as e:
+                remaining = deadline_at - time.monotonic()
+                if attempt >= self.max_retries or remaining <= 0:
+                    if remaining <= 0:
+                        self._count('deadline_exceeded')
+                    raise
+                print(f"Retrying {self.name} call after error: {str(e)}")
+                self._count('retries')
+                await asyncio.sleep(self._backoff(attempt, remaining))
+                attempt += 1
+
+    async def _ahedged(self, base_url, model, fn, timeout, on_discard):
+        delay = self._hedge_delay(get_breaker(base_url, model))
+        if delay is None or delay >= timeout:
+            return await self._aattempt(base_url, model, fn, timeout), model
+
+        primary = asyncio.ensure_future(self._aattempt(base_url, model, fn, timeout))
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            hedge_model = self.hedge_model or model
+            if done or not get_breaker(base_url, hedge_model).allow() \
+                    or not get_limiter(base_url, hedge_model).has_capacity():
+                return await primary, model
+
+            self._count('hedged')
+            secondary = asyncio.ensure_future(self._aattempt(base_url, hedge_model, fn, timeout - delay))
+            models = {primary: model, secondary: hedge_model}
+            pending = set(models)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # 两个请求同时结束时优先采用主请求
+                done = sorted(done, key=lambda task: task is not primary)
+                for task in done:
+                    if task.exception() is None:
+                        # 同时成功返回的另一个响应已经产生用量，不能取消
+                        for other in done:
+                            if other is not task and other.exception() is None and on_discard is not None:
+                                on_discard(other.result())
+                        if task is secondary:
+                            self._count('hedge_wins')
+                        return task.result(), models[task]
+                    error = task.exception()
+            raise error
+        finally:
+            # 取消落后（或调用方已不再等待）的请求，httpx 随之关闭连接，上游停止生成
+            for task in pending:
+                task.cancel()
+
+    def open_stream(self, base_url, model, fn, hedge=True):
+        """
+        建立流式请求，收到响应头之前的错误按同样的规则重试，不对冲；
+        timeout 作用于建立连接和每次读取，流本身的总时长不受截止时间限制。
+        返回的流持有并发名额，调用方必须关闭
+        """
+        return self._retrying(
+            lambda chosen, timeout: (self._attempt(base_url, chosen, fn, timeout, hold=True), chosen),
+            base_url, model, hedge)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats.update({
+            'deadline': self.deadline,
+            'max_retries': self.max_retries,
+            'hedge': self.hedge,
+            'hedge_model': self.hedge_model
+        })
+        return stats
@@ -0,0 +1,315 @@
+"""
+模型调用的自适应并发限制和公平调度
+
+每个 (base_url, 模型) 有一个并发上限，按 AIMD 调整：
+- 成功且耗时正常时加性增加（上限被用满时每次 +1/上限，约每个往返 +1）；
+  从未过载之前每次 +1（慢启动），尽快找到服务端能承受的并发
+- 收到 429 或超时、或耗时超过基线的 LLM_CONCURRENCY_LATENCY_TOLERANCE 倍时乘性减少
+  （乘以 LLM_CONCURRENCY_BACKOFF，一个基线耗时内最多减少一次，同一波请求的多个 429 只算一次）
+
+超出上限的调用排队等待，等待不超过调用的剩余截止时间。排队按类别和租户公平调度：
+交互式请求优先，批量请求（批量导入、预取）至少获得 1/LLM_BULK_SHARE 的名额，不会被饿死；
+同一类别内按租户轮转，一个租户的大量请求不会挡住其他租户
+"""
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from app.utils.metrics import get_recorder
+from app.utils.tenant_quota import current_tenant
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+# 当前调用的类别，由批量导入和预取设置为 BULK
+_priority = contextvars.ContextVar('llm_priority', default=INTERACTIVE)
+
+# 排队等待名额的耗时（毫秒），出现在 /api/metrics 的 latency 中
+_queue_wait = get_recorder('llm.queue_wait')
+
+
+def set_bulk_priority():
+    """把当前上下文（例如后台线程）的模型调用标记为批量请求"""
+    _priority.set(BULK)
+
+
+class LimiterTimeout(TimeoutError):
+    """在截止时间内没有等到调用名额"""
+
+
+class LimiterRejected(Exception):
+    """排队的调用过多"""
+
+
+class _Waiter:
+    __slots__ = ('granted', 'event', 'loop', 'future', 'enqueued_at')
+
+    def __init__(self, loop=None):
+        self.granted = False
+        self.enqueued_at = time.perf_counter()
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+            self.future = None
+        else:
+            self.event = None
+            self.future = loop.create_future()
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class AdaptiveLimiter:
+    """单个 (base_url, 模型) 的并发上限和等待队列"""
+
+    def __init__(self, initial=64, min_limit=1, max_limit=1000, backoff=0.5, latency_tolerance=4.0,
+                 bulk_share=4, max_waiting=1000):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.bulk_share = bulk_share
+        self.max_waiting = max_waiting
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        # 类别 -> OrderedDict(租户 -> deque(等待者))，租户按轮转顺序排列
+        self._queues = {INTERACTIVE: OrderedDict(), BULK: OrderedDict()}
+        self._waiting = {INTERACTIVE: 0, BULK: 0}
+        self._grants = 0
+        # 无负载时的耗时基线（秒）：新的更低样本立即采用，否则缓慢上移，避免一次偶然的快速响应长期压低基线
+        self._baseline = None
+        self._last_decrease = 0.0
+        self._slow_start = True
+        self.acquired = 0
+        self.queued = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.increases = 0
+        self.decreases = 0
+
+    @property
+    def waiting(self):
+        return self._waiting[INTERACTIVE] + self._waiting[BULK]
+
+    def has_capacity(self):
+        """当前是否有空闲名额且没有排队的调用（对冲请求只在有空闲名额时发出，不排队）"""
+        with self._lock:
+            return self.in_flight < int(self.limit) and not self.waiting
+
+    def _try_acquire(self, loop=None):
+        """有空闲名额时直接占用并返回 None，否则返回已入队的等待者（调用方持有锁）"""
+        if self.in_flight < int(self.limit) and not self.waiting:
+            self.in_flight += 1
+            self.acquired += 1
+            return None
+        if self.waiting >= self.max_waiting:
+            self.rejected += 1
+            raise LimiterRejected('等待调用模型的请求过多，请稍后再试')
+
+        waiter = _Waiter(loop)
+        priority = _priority.get()
+        self._queues[priority].setdefault(current_tenant() or 'anonymous', deque()).append(waiter)
+        self._waiting[priority] += 1
+        self.queued += 1
+        return waiter
+
+    def _remove(self, waiter):
+        """移除超时或被取消的等待者（调用方持有锁）"""
+        for priority, queues in self._queues.items():
+            for tenant, waiters in queues.items():
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del queues[tenant]
+                    self._waiting[priority] -= 1
+                    return
+
+    def _next_waiter(self):
+        """按类别和租户选出下一个等待者（调用方持有锁）"""
+        interactive, bulk = self._waiting[INTERACTIVE], self._waiting[BULK]
+        # 交互式优先，但每 bulk_share 次至少有一次给批量请求
+        if bulk and (not interactive or self._grants % self.bulk_share == self.bulk_share - 1):
+            priority = BULK
+        else:
+            priority = INTERACTIVE
+        queues = self._queues[priority]
+        tenant, waiters = next(iter(queues.items()))
+        waiter = waiters.popleft()
+        # 取出后该租户排到队尾
+        del queues[tenant]
+        if waiters:
+            queues[tenant] = waiters
+        self._waiting[priority] -= 1
+        self._grants += 1
+        return waiter
+
+    def _dispatch(self):
+        """把空出的名额交给等待者（调用方持有锁）"""
+        while self.waiting and self.in_flight < int(self.limit):
+            waiter = self._next_waiter()
+            waiter.granted = True
+            self.in_flight += 1
+            self.acquired += 1
+            waiter.wake()
+
+    def acquire(self, timeout):
+        """同步获取名额，timeout 秒内没有等到时抛出 LimiterTimeout"""
+        with self._lock:
+            waiter = self._try_acquire()
+        if waiter is None:
+            _queue_wait.record(0)
+            return
+
+        waiter.event.wait(max(timeout, 0))
+        with self._lock:
+            if not waiter.granted:
+                self._remove(waiter)
+                self.timeouts += 1
+                raise LimiterTimeout(f"等待调用模型的名额超过 {timeout:.1f} 秒")
+        _queue_wait.record((time.perf_counter() - waiter.enqueued_at) * 1000)
+
+    async def aacquire(self, timeout):
+        """异步获取名额，等待期间不占用线程"""
+        with self._lock:
+            waiter = self._try_acquire(asyncio.get_running_loop())
+        if waiter is None:
+            _queue_wait.record(0)
+            return
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), max(timeout, 0))
+        except asyncio.TimeoutError:
+            with self._lock:
+                if not waiter.granted:
+                    self._remove(waiter)
+                    self.timeouts += 1
+                    raise LimiterTimeout(f"等待调用模型的名额超过 {timeout:.1f} 秒")
+            # 超时的同时拿到了名额，照常使用
+        except BaseException:
+            # 调用方被取消：名额已经分配时归还
+            with self._lock:
+                granted = waiter.granted
+                if not granted:
+                    self._remove(waiter)
+            if granted:
+                self.release()
+            raise
+        _queue_wait.record((time.perf_counter() - waiter.enqueued_at) * 1000)
+
+    def release(self, elapsed=None, overloaded=False):
+        """
+        归还名额并按结果调整上限
+
+        elapsed 为成功调用的耗时（秒）；overloaded 为 True 表示收到 429 或超时；两者都没有时（其他错误）只归还
+        """
+        with self._lock:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            now = time.monotonic()
+            if overloaded:
+                self._decrease(now)
+            elif elapsed is not None:
+                if self._baseline is None or elapsed < self._baseline:
+                    self._baseline = elapsed
+                else:
+                    self._baseline += (elapsed - self._baseline) * 0.01
+                if self.latency_tolerance and elapsed > self._baseline * self.latency_tolerance:
+                    self._decrease(now)
+                elif saturated or self.waiting:
+                    # 只在上限确实限制了并发时增加，空闲时上限不会无限增长
+                    step = 1.0 if self._slow_start else 1.0 / self.limit
+                    self.limit = min(self.max_limit, self.limit + step)
+                    self.increases += 1
+            self._dispatch()
+
+    def _decrease(self, now):
+        # 同一波请求的多个过载信号只减少一次
+        if now - self._last_decrease < (self._baseline or 1.0):
+            return
+        self._last_decrease = now
+        self._slow_start = False
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+        self.decreases += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'limit': round(self.limit, 2),
+                'in_flight': self.in_flight,
+                'waiting': self._waiting[INTERACTIVE] + self._waiting[BULK],
+                'waiting_bulk': self._waiting[BULK],
+                'baseline_ms': round(self._baseline * 1000, 1) if self._baseline is not None else None,
+                'slow_start': self._slow_start,
+                'acquired': self.acquired,
+                'queued': self.queued,
+                'timeouts': self.timeouts,
+                'rejected': self.rejected,
+                'increases': self.increases,
+                'decreases': self.decreases
+            }
+
+
+# (base_url, 模型) -> AdaptiveLimiter，按最近使用淘汰，有调用进行中或排队的不淘汰
+_limiters = OrderedDict()
+_limiters_lock = threading.Lock()
+MAX_LIMITERS = 256
+
+
+def _new_limiter():
+    return AdaptiveLimiter(
+        initial=int(os.getenv('LLM_CONCURRENCY_INITIAL', '64')),
+        min_limit=int(os.getenv('LLM_CONCURRENCY_MIN', '1')),
+        max_limit=int(os.getenv('LLM_CONCURRENCY_MAX', '1000')),
+        backoff=float(os.getenv('LLM_CONCURRENCY_BACKOFF', '0.5')),
+        latency_tolerance=float(os.getenv('LLM_CONCURRENCY_LATENCY_TOLERANCE', '4')),
+        bulk_share=int(os.getenv('LLM_BULK_SHARE', '4')),
+        max_waiting=int(os.getenv('LLM_MAX_WAITING', '1000'))
+    )
+
+
+def get_limiter(base_url, model):
+    key = (str(base_url), model)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _new_limiter()
+            _limiters[key] = limiter
+            if len(_limiters) > MAX_LIMITERS:
+                for old_key, old in list(_limiters.items()):
+                    if old.in_flight == 0 and old.waiting == 0:
+                        del _limiters[old_key]
+                        break
+        else:
+            _limiters.move_to_end(key)
+        return limiter
+
+
+def limiter_stats():
+    """按模型汇总（不列出 base_url，其中可能有用户自定义的地址）"""
+    with _limiters_lock:
+        items = list(_limiters.items())
+    by_model = {}
+    for (_, model), limiter in items:
+        stats = limiter.stats()
+        entry = by_model.setdefault(model, {'limiters': 0, 'limit': 0, 'in_flight': 0, 'waiting': 0,
+                                            'waiting_bulk': 0, 'timeouts': 0, 'rejected': 0, 'decreases': 0})
+        entry['limiters'] += 1
+        for name in ('limit', 'in_flight', 'waiting', 'waiting_bulk', 'timeouts', 'rejected', 'decreases'):
+            entry[name] += stats[name]
+    return {
+        'queue_depth': sum(entry['waiting'] for entry in by_model.values()),
+        'in_flight': sum(entry['in_flight'] for entry in by_model.values()),
+        'by_model': by_model,
+        'queue_wait': _queue_wait.summary()
+    }
@@ -0,0 +1,172 @@
+"""
+多轮报告生成的上下文压缩
+
+每轮只完整发送本轮的问答，之前的轮次以上一轮报告的压缩摘要代替（上一轮报告本身已综合了更早的问答），
+提示词长度不再随轮次增长。token 数用 tiktoken 计算；编码文件无法加载时（离线环境且没有设置
+TIKTOKEN_CACHE_DIR）按字符估算
+"""
+import math
+import os
+import re
+import threading
+
+# 提示词（不含模型输出）的 token 预算
+REPORT_CONTEXT_BUDGET = int(os.getenv('REPORT_CONTEXT_BUDGET', '6000'))
+# 上一轮报告摘要的 token 上限
+REPORT_SUMMARY_TOKENS = int(os.getenv('REPORT_SUMMARY_TOKENS', '1500'))
+TIKTOKEN_ENCODING = os.getenv('TIKTOKEN_ENCODING', 'cl100k_base')
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+_CJK_RE = re.compile(r'[⺀-鿿가-힯豈-﫿＀-￯]')
+
+
+def _get_encoding():
+    """加载 tiktoken 编码（只尝试一次，失败后一直使用估算）"""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+                except Exception as e:
+                    print(f"tiktoken encoding unavailable, falling back to estimation: {str(e)}")
+                    _encoding = None
+                _encoding_loaded = True
+    return _encoding
+
+
+def estimate_tokens(text):
+    """按字符估算 token 数：中日韩字符约 1 个 token，其余约 4 个字符 1 个 token"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text, max_tokens):
+    """截断文本使其不超过 max_tokens，截断时在末尾加省略号"""
+    if max_tokens <= 0:
+        return ''
+    if count_tokens(text) <= max_tokens:
+        return text
+
+    encoding = _get_encoding()
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens - 1]) + '…'
+
+    # 估算模式下二分查找能放下的最长前缀
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) <= max_tokens - 1:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + '…'
+
+
+def summarize_report(report, max_tokens=REPORT_SUMMARY_TOKENS):
+    """
+    把报告压缩到 max_tokens 以内（抽取式，不调用模型）
+
+    按标题切分章节，先保留所有标题，再依次加入每个章节的第 1 行、第 2 行……，
+    预算用完为止，输出时保持原文顺序。这样预算不足时每个章节都能保留开头的要点，
+    而不是只留下报告前半部分
+    """
+    if not report or max_tokens <= 0:
+        return ''
+
+    lines = []
+    for raw in report.splitlines():
+        line = re.sub(r'\s+', ' ', raw.replace('**', '')).strip()
+        if line and not re.fullmatch(r'[-*_=#\s]+', line):
+            lines.append(line)
+    if not lines:
+        return ''
+
+    full = '\n'.join(lines)
+    if count_tokens(full) <= max_tokens:
+        return full
+
+    # sections: [[标题行下标（第一个标题之前的内容为 None）, [正文行下标...]]]
+    sections = []
+    for index, line in enumerate(lines):
+        if line.startswith('#'):
+            sections.append([index, []])
+        else:
+            if not sections:
+                sections.append([None, []])
+            sections[-1][1].append(index)
+
+    # 每行单独计数再求和会略多于整体计数，作为预算的保守估计
+    costs = [count_tokens(line) + 1 for line in lines]
+    selected = set()
+    used = 0
+
+    candidates = [heading for heading, _ in sections if heading is not None]
+    depth = 0
+    while True:
+        for index in candidates:
+            if used + costs[index] <= max_tokens:
+                selected.add(index)
+                used += costs[index]
+        candidates = [body[depth] for _, body in sections if depth < len(body)]
+        if not candidates or used >= max_tokens:
+            break
+        depth += 1
+
+    return '\n'.join(lines[index] for index in sorted(selected))
+
+
+# 每个问答对在提示词中的格式开销（「问题：… | 答案：…」和换行）
+_QA_OVERHEAD = 8
+
+
+def _qa_tokens(pair):
+    return count_tokens(pair['question']) + count_tokens(pair['answer']) + _QA_OVERHEAD
+
+
+def fit_report_context(template_tokens, previous_report, qa_pairs, budget=REPORT_CONTEXT_BUDGET):
+    """
+    在预算内分配上一轮报告摘要和本轮问答
+
+    template_tokens 为提示词模板本身（不含摘要和问答）的 token 数。本轮问答优先完整保留，
+    剩余预算留给摘要（不超过 REPORT_SUMMARY_TOKENS）；问答本身超出预算时按比例截断过长的答案。
+    返回 (摘要, 问答对, 统计)
+    """
+    available = max(0, budget - template_tokens)
+    qa_tokens = sum(_qa_tokens(pair) for pair in qa_pairs)
+
+    if qa_tokens > available and qa_pairs:
+        # 问题保留原文，答案平分剩余预算（短答案用不完的额度留给长答案）
+        answer_budget = available - sum(count_tokens(pair['question']) + _QA_OVERHEAD for pair in qa_pairs)
+        remaining = sorted(range(len(qa_pairs)), key=lambda i: count_tokens(qa_pairs[i]['answer']))
+        trimmed = [dict(pair) for pair in qa_pairs]
+        for position, i in enumerate(remaining):
+            share = max(0, answer_budget) // (len(remaining) - position)
+            trimmed[i]['answer'] = truncate_to_tokens(qa_pairs[i]['answer'], share)
+            answer_budget -= count_tokens(trimmed[i]['answer'])
+        qa_pairs = trimmed
+        qa_tokens = sum(_qa_tokens(pair) for pair in qa_pairs)
+
+    summary = summarize_report(previous_report, min(REPORT_SUMMARY_TOKENS, available - qa_tokens))
+    summary_tokens = count_tokens(summary)
+
+    return summary, qa_pairs, {
+        'template_tokens': template_tokens,
+        'summary_tokens': summary_tokens,
+        'qa_tokens': qa_tokens,
+        'prompt_tokens': template_tokens + summary_tokens + qa_tokens,
+        'budget': budget
+    }
@@ -0,0 +1,65 @@
+"""
+客户端断开时取消模型调用的统计
+
+- 异步部署（app/asgi.py）：等待响应期间监听 http.disconnect，客户端断开时取消处理请求的任务，
+  正在进行的模型调用随之断开连接（上游停止生成），之后的保存步骤不再执行；
+  合并的相同请求（singleflight）在所有等待方都断开后才取消
+- 流式接口：客户端断开时 WSGI 服务器关闭响应的生成器，上游的流随之关闭，报告或问题不保存
+- 请求中带 keep_on_disconnect: true 时不取消：调用照常完成并保存结果，之后可以通过会话接口读取
+
+同步部署的非流式接口在阻塞等待模型返回时无法发现客户端断开，不在此列。
+节省的 token 数是估算值：按同类调用的平均输出 token 数，减去断开前已经生成的部分；
+非流式调用无法知道断开时已生成多少，按 0 计，因此是上限
+"""
+import threading
+
+
+class DisconnectStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 接口 -> 客户端在响应完成前断开的请求数
+        self.abandoned = {}
+        self.kept = 0
+        # 调用类别（questions / report）-> 被取消的模型调用数
+        self.cancelled = {}
+        self.tokens_saved = 0
+        # 调用类别 -> [完成的调用数, 输出 token 总数]，用于估算被取消的调用本来会生成多少
+        self._completions = {}
+
+    def observe(self, kind, usage):
+        """记录一次完成的调用的输出 token 数（usage 为响应中的用量，可能为空）"""
+        if not usage or not getattr(usage, 'completion_tokens', None):
+            return
+        with self._lock:
+            entry = self._completions.setdefault(kind, [0, 0])
+            entry[0] += 1
+            entry[1] += usage.completion_tokens
+
+    def _average(self, kind):
+        count, tokens = self._completions.get(kind, (0, 0))
+        return tokens / count if count else 0
+
+    def record_abandoned(self, endpoint, kept=False):
+        """客户端在响应完成前断开；kept 为 True 表示按请求继续完成并保存结果"""
+        with self._lock:
+            self.abandoned[endpoint] = self.abandoned.get(endpoint, 0) + 1
+            self.kept += kept
+
+    def record_cancelled(self, kind, generated_tokens=0):
+        """客户端断开导致一次模型调用被取消，generated_tokens 为断开前已经生成的 token 数"""
+        with self._lock:
+            self.cancelled[kind] = self.cancelled.get(kind, 0) + 1
+            self.tokens_saved += max(0, int(self._average(kind) - generated_tokens))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'abandoned': dict(self.abandoned),
+                'kept': self.kept,
+                'cancelled_calls': dict(self.cancelled),
+                'tokens_saved_estimate': self.tokens_saved,
+                'avg_completion_tokens': {kind: round(self._average(kind), 1) for kind in self._completions}
+            }
+
+
+disconnects = DisconnectStats()
@@ -0,0 +1,347 @@
+"""
+后台任务队列：耗时的模型调用在固定数量的工作线程中执行，接口立即返回任务 ID
+
+- 任务保存在 SQLite 的 jobs 表中，进程重启后未完成的任务（排队中，或执行中但租约已过期）会被重新领取
+- 工作线程数（JOB_WORKERS）固定，请求的并发不再决定模型调用的并发；
+  本进程排队和执行中的任务超过 JOB_QUEUE_SIZE 时拒绝新任务
+- 任务失败后按指数退避重试，最多执行 JOB_MAX_ATTEMPTS 次；处理函数在写入结果的同一事务中
+  标记任务完成，重复执行不会产生重复的结果
+- 调用方可以阻塞（线程）或 await（事件循环）等待任务结束，用于长轮询
+
+自定义 API 的密钥只保存在进程内存中，不写入数据库。这类任务记录提交它的任务队列实例（owner），
+各实例定期在 job_workers 表中写入心跳：owner 存活时其他进程不领取它的任务（包括等待重试的），
+owner 的心跳超过 JOB_OWNER_TIMEOUT 秒（进程已退出）后，任务由其他进程领取并标记为失败
+"""
+import asyncio
+import atexit
+import os
+import queue
+import threading
+import time
+import uuid
+
+from app.utils.tenant_quota import set_tenant
+from app.utils.token_limit import TokenLimitExceeded
+from app.utils.token_usage import set_endpoint
+
+FINISHED = ('succeeded', 'failed')
+
+
+class QueueFull(Exception):
+    """本进程排队和执行中的任务已达上限"""
+
+    def __init__(self, retry_after):
+        super().__init__('任务队列已满，请稍后再试')
+        self.retry_after = retry_after
+
+    def to_dict(self):
+        return {'error': str(self), 'retry_after': self.retry_after}
+
+
+class JobError(Exception):
+    """不需要重试的任务错误（例如会话不存在），任务直接标记为失败"""
+
+
+class JobQueue:
+    def __init__(self, workers=4, max_pending=100, max_attempts=3, retry_backoff=5.0,
+                 lease=300.0, poll_interval=2.0, retention=86400.0, owner_timeout=30.0):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        # 任务执行的租约：超过这个时间仍未结束的任务视为执行它的进程已退出，可以被重新领取
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.retention = retention
+        # 本实例的 ID（带密钥的任务的 owner）；心跳超过 owner_timeout 秒视为实例已退出
+        self.instance = f'{os.getpid()}-{uuid.uuid4().hex[:12]}'
+        self.owner_timeout = owner_timeout
+        self._last_heartbeat = 0.0
+        # kind -> (处理函数, 接口名)
+        self._handlers = {}
+        self._queue = queue.Queue()
+        # 本进程排队或执行中的任务 ID
+        self._pending = set()
+        # 任务 ID -> 自定义 API 的密钥等不落盘的数据
+        self._secrets = {}
+        # 任务 ID -> 任务结束时调用的回调（长轮询的等待方）
+        self._watchers = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._stop = threading.Event()
+        self._last_purge = 0.0
+        self.submitted = 0
+        self.deduplicated = 0
+        self.rejected = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+        # 轮询时从数据库领取的任务（到期的重试和重启前留下的任务）
+        self.picked_up = 0
+
+    def register(self, kind, handler, endpoint=None):
+        """
+        注册任务处理函数 handler(job_id, session_id, payload, secrets)
+
+        处理函数需要在写入结果的事务中把任务标记为成功（见 SessionManager.update_session_with_answers），
+        抛出 JobError 或 TokenLimitExceeded 时不重试；endpoint 为 token 用量统计使用的接口名
+        """
+        self._handlers[kind] = (handler, endpoint or kind)
+
+    def start(self):
+        """启动工作线程和轮询线程（重复调用无效）"""
+        with self._lock:
+            if self._threads:
+                return
+            self._stop.clear()
+            self._heartbeat()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            thread = threading.Thread(target=self._poll, name='job-poller', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self, timeout=5.0):
+        """停止领取新任务，等待执行中的任务结束（超时后未完成的任务在下次启动时重新执行）"""
+        self._stop.set()
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        if threads:
+            from app.models.session import SessionManager
+            try:
+                SessionManager.remove_job_worker(self.instance)
+            except Exception as e:
+                print(f"Error removing job worker heartbeat: {str(e)}")
+
+    def submit(self, kind, session_id, payload, dedupe_key=None, tenant=None, secrets=None):
+        """
+        提交任务，返回 (任务 ID, 是否新建)
+
+        相同 dedupe_key 的任务还未结束时返回该任务；队列已满时抛出 QueueFull
+        """
+        from app.models.session import SessionManager
+
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self.rejected += 1
+                raise QueueFull(max(1, int(self.poll_interval * 2)))
+
+        # 密钥只在本进程内存中，任务只能由本实例执行
+        owner = self.instance if secrets else None
+        job_id, created = SessionManager.create_job(kind, session_id, payload, dedupe_key, tenant, owner)
+        with self._lock:
+            if not created:
+                self.deduplicated += 1
+                return job_id, False
+            self.submitted += 1
+            if secrets:
+                self._secrets[job_id] = secrets
+            self._pending.add(job_id)
+        self._queue.put(job_id)
+        return job_id, True
+
+    def get(self, job_id):
+        from app.models.session import SessionManager
+        return SessionManager.get_job(job_id)
+
+    def wait(self, job_id, timeout):
+        """等待任务结束或超时，返回任务状态（任务不存在时返回 None）"""
+        event = threading.Event()
+        self._watch(job_id, event.set)
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                job = self.get(job_id)
+                remaining = deadline - time.monotonic()
+                if job is None or job['status'] in FINISHED or remaining <= 0:
+                    return job
+                # 其他进程执行的任务不会通知本进程，定期查询数据库
+                event.wait(min(remaining, self.poll_interval))
+                event.clear()
+        finally:
+            self._unwatch(job_id, event.set)
+
+    async def await_job(self, job_id, timeout):
+        """wait 的异步版本，等待期间不占用线程"""
+        from app.models.database import run_db
+
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+
+        def notify():
+            loop.call_soon_threadsafe(event.set)
+
+        self._watch(job_id, notify)
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                job = await run_db(self.get, job_id)
+                remaining = deadline - time.monotonic()
+                if job is None or job['status'] in FINISHED or remaining <= 0:
+                    return job
+                try:
+                    await asyncio.wait_for(event.wait(), min(remaining, self.poll_interval))
+                except asyncio.TimeoutError:
+                    pass
+                event.clear()
+        finally:
+            self._unwatch(job_id, notify)
+
+    def _watch(self, job_id, callback):
+        with self._lock:
+            self._watchers.setdefault(job_id, []).append(callback)
+
+    def _unwatch(self, job_id, callback):
+        with self._lock:
+            callbacks = self._watchers.get(job_id)
+            if callbacks:
+                callbacks.remove(callback)
+                if not callbacks:
+                    del self._watchers[job_id]
+
+    def _notify(self, job_id):
+        with self._lock:
+            callbacks = list(self._watchers.get(job_id, ()))
+        for callback in callbacks:
+            callback()
+
+    def _work(self):
+        while not self._stop.is_set():
+            job_id = self._queue.get()
+            if job_id is None:
+                return
+            try:
+                self._execute(job_id)
+            except Exception as e:
+                print(f"Error running job {job_id}: {str(e)}")
+            finally:
+                with self._lock:
+                    self._pending.discard(job_id)
+                self._notify(job_id)
+
+    def _poll(self):
+        """定期领取数据库中可以执行的任务：到期的重试、租约过期的任务和其他进程退出前留下的任务"""
+        from app.models.session import SessionManager
+
+        while not self._stop.wait(self.poll_interval):
+            try:
+                if time.time() - self._last_heartbeat >= self.owner_timeout / 3:
+                    self._heartbeat()
+
+                with self._lock:
+                    capacity = self.max_pending - len(self._pending)
+                if capacity > 0:
+                    for job_id in SessionManager.claimable_jobs(capacity, self.instance, self.owner_timeout):
+                        with self._lock:
+                            if job_id in self._pending:
+                                continue
+                            self._pending.add(job_id)
+                            self.picked_up += 1
+                        self._queue.put(job_id)
+
+                now = time.time()
+                if now - self._last_purge > 3600:
+                    self._last_purge = now
+                    SessionManager.purge_jobs(now - self.retention)
+            except Exception as e:
+                print(f"Error polling jobs: {str(e)}")
+
+    def _heartbeat(self):
+        from app.models.session import SessionManager
+
+        try:
+            SessionManager.heartbeat_job_worker(self.instance)
+            self._last_heartbeat = time.time()
+        except Exception as e:
+            print(f"Error writing job worker heartbeat: {str(e)}")
+
+    def _execute(self, job_id):
+        from app.models.session import SessionManager
+
+        job = SessionManager.claim_job(job_id, self.lease, self.instance, self.owner_timeout)
+        if job is None:
+            # 已被其他进程领取，还没到重试时间，或属于其他仍在运行的进程
+            return
+
+        handler, endpoint = self._handlers.get(job['kind'], (None, None))
+        with self._lock:
+            secrets = self._secrets.get(job_id)
+        if handler is None:
+            self._fail(job_id, {'error': f"未知的任务类型：{job['kind']}"})
+            return
+        if job['payload'].get('has_secrets') and secrets is None:
+            # 提交它的进程已退出（心跳超时），密钥随之丢失
+            self._fail(job_id, {'error': '使用自定义 API 配置的任务在服务重启后无法恢复，请重新提交'})
+            return
+
+        # 工作线程中的模型调用计入提交任务的接口和租户
+        set_endpoint(endpoint)
+        set_tenant(job['tenant'])
+        try:
+            handler(job_id, job['session_id'], job['payload'], secrets or {})
+        except TokenLimitExceeded as e:
+            self._fail(job_id, e.to_dict())
+            return
+        except JobError as e:
+            self._fail(job_id, {'error': str(e)})
+            return
+        except Exception as e:
+            print(f"Job {job_id} attempt {job['attempts']} failed: {str(e)}")
+            if job['attempts'] >= self.max_attempts:
+                self._fail(job_id, {'error': str(e)})
+                return
+            delay = self.retry_backoff * 2 ** (job['attempts'] - 1)
+            SessionManager.finish_job(job_id, 'queued', {'error': str(e)}, run_after=time.time() + delay)
+            with self._lock:
+                self.retried += 1
+            return
+
+        with self._lock:
+            self.succeeded += 1
+            self._secrets.pop(job_id, None)
+
+    def _fail(self, job_id, error):
+        from app.models.session import SessionManager
+
+        SessionManager.finish_job(job_id, 'failed', error)
+        with self._lock:
+            self.failed += 1
+            self._secrets.pop(job_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'pending': len(self._pending),
+                'queued': self._queue.qsize(),
+                'waiters': sum(len(callbacks) for callbacks in self._watchers.values()),
+                'submitted': self.submitted,
+                'deduplicated': self.deduplicated,
+                'rejected': self.rejected,
+                'succeeded': self.succeeded,
+                'failed': self.failed,
+                'retried': self.retried,
+                'picked_up': self.picked_up,
+                'instance': self.instance
+            }
+
+
+job_queue = JobQueue(
+    workers=int(os.getenv('JOB_WORKERS', '4')),
+    max_pending=int(os.getenv('JOB_QUEUE_SIZE', '100')),
+    max_attempts=int(os.getenv('JOB_MAX_ATTEMPTS', '3')),
+    retry_backoff=float(os.getenv('JOB_RETRY_BACKOFF', '5')),
+    lease=float(os.getenv('JOB_LEASE_SECONDS', '300')),
+    poll_interval=float(os.getenv('JOB_POLL_INTERVAL', '2')),
+    retention=float(os.getenv('JOB_RETENTION', '86400')),
+    owner_timeout=float(os.getenv('JOB_OWNER_TIMEOUT', '30'))
+)
+atexit.register(job_queue.close)
@@ -0,0 +1,93 @@
+import json
+
+
+class JSONArrayStreamParser:
+    """
+    增量解析 LLM 流式输出中的 JSON 对象数组
+
+    每收到一段文本就调用 feed()，返回这段文本中刚刚闭合的顶层对象。
+    每个字符只扫描一次，不会随缓冲区增长重复扫描；数组前后的 markdown 代码块标记、
+    说明文字都会被忽略。解析失败的单个对象会被跳过，不影响后续对象
+    """
+
+    # 状态：寻找数组开头 / 在数组中等待下一个元素 / 在对象内部 / 数组已结束
+    SEEK, ARRAY, OBJECT, DONE = range(4)
+
+    def __init__(self):
+        self.items = []
+        self._state = self.SEEK
+        self._buffer = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    @property
+    def done(self):
+        return self._state == self.DONE
+
+    def feed(self, text):
+        """输入一段文本，返回其中新解析出的对象列表"""
+        parsed = []
+        start = None  # 当前对象在本段文本中的起始位置
+
+        for i, ch in enumerate(text):
+            state = self._state
+
+            if state == self.OBJECT:
+                if self._in_string:
+                    if self._escape:
+                        self._escape = False
+                    elif ch == '\\':
+                        self._escape = True
+                    elif ch == '"':
+                        self._in_string = False
+                elif ch == '"':
+                    self._in_string = True
+                elif ch in '{[':
+                    self._depth += 1
+                elif ch in '}]':
+                    self._depth -= 1
+                    if self._depth == 0:
+                        self._buffer.append(text[start:i + 1])
+                        start = None
+                        item = self._finish_object()
+                        if item is not None:
+                            parsed.append(item)
+                        self._state = self.ARRAY
+
+            elif state == self.ARRAY:
+                if ch == '{':
+                    self._state = self.OBJECT
+                    self._depth = 1
+                    self._buffer = []
+                    start = i
+                elif ch == ']':
+                    self._state = self.DONE
+                    break
+                elif not (ch.isspace() or ch == ','):
+                    # 不是对象数组（例如说明文字中的「[注意]」），继续寻找真正的数组
+                    self._state = self.SEEK
+
+            elif state == self.SEEK:
+                if ch == '[':
+                    self._state = self.ARRAY
+
+            else:
+                break
+
+        # 对象跨越多段文本时，把本段中属于它的部分暂存起来
+        # （start 为 None 表示对象从之前的文本开始，本段全部属于它）
+        if self._state == self.OBJECT:
+            self._buffer.append(text[start:])
+
+        self.items.extend(parsed)
+        return parsed
+
+    def _finish_object(self):
+        raw = ''.join(self._buffer)
+        self._buffer = []
+        try:
+            item = json.loads(raw)
+        except ValueError:
+            return None
+        return item if isinstance(item, dict) else None
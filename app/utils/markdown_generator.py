@@ -1,38 +1,62 @@
-def generate_markdown(session_data, filepath):
-    """生成Markdown格式的需求文档"""
-    with open(filepath, 'w', encoding='utf-8') as f:
-        # 写入标题
-        f.write("# 项目需求说明书\n\n")
-        
-        # 写入原始想法
-        f.write("## 1. 项目原始想法\n\n")
-        idea_text = session_data.get('idea', '未提供项目想法')
-        f.write(f"{idea_text}\n\n")
-        
-        # 写入问答内容（只有在有数据时才添加）
-        if session_data.get('questions') and session_data.get('answers'):
-            f.write("## 2. 需求澄清问答\n\n")
-            
-            # 确保问题和答案数量匹配
-            min_len = min(len(session_data['questions']), len(session_data['answers']))
-            for i in range(min_len):
-                q = session_data['questions'][i]
-                a = session_data['answers'][i]
-                
-                question_text = q.get('text', '') if isinstance(q, dict) else str(q)
-                answer_text = a.get('answer', '') if isinstance(a, dict) else str(a)
-                
-                f.write(f"**Q{i+1}: {question_text}**\n")
-                f.write(f"A{i+1}: {answer_text}\n\n")
-        
-        # 写入分析报告
-        if session_data.get('reports'):
-            f.write("## 3. 阶段性分析报告\n\n")
-            
-            for i, report in enumerate(session_data['reports'], 1):
-                f.write(f"### 第{i}次分析:\n")
-                f.write(f"{report}\n\n")
-        
-        # 如果没有任何内容，添加默认内容
-        if not session_data.get('idea') and not session_data.get('questions') and not session_data.get('reports'):
-            f.write("暂无内容\n")
\ No newline at end of file
+"""
+需求文档（Markdown）的生成
+
+文档由每轮的片段拼接而成：每轮的问答（该轮回答的问题集和答案）在提交答案时渲染成一段，保存在 reports 表的
+对应行中（见 SessionManager.update_session_with_answers），每轮的报告片段为标题加报告原文。
+已有的轮次不会再变化，生成文档只是按顺序拼接；格式版本变化后，旧片段在下载时重新渲染（SessionManager.get_document）
+"""
+
+# 文档格式的版本号，修改渲染函数的输出时递增：下载接口的 ETag 随之变化，已保存的旧片段重新渲染
+DOCUMENT_VERSION = 2
+
+
+def render_round_qa(round_number, questions, answers):
+    """一轮的问答片段，没有问答时为空字符串"""
+    # 确保问题和答案数量匹配
+    min_len = min(len(questions), len(answers))
+    if not min_len:
+        return ""
+
+    parts = [f"### 第{round_number}轮\n\n"]
+    for i in range(min_len):
+        q = questions[i]
+        a = answers[i]
+
+        question_text = q.get('text', '') if isinstance(q, dict) else str(q)
+        answer_text = a.get('answer', '') if isinstance(a, dict) else str(a)
+
+        parts.append(f"**Q{i+1}: {question_text}**\nA{i+1}: {answer_text}\n\n")
+    return "".join(parts)
+
+
+def render_round_report(round_number, report):
+    """一轮的分析报告片段"""
+    return f"### 第{round_number}次分析:\n{report}\n\n"
+
+
+def iter_document(document):
+    """
+    逐段输出需求文档（下载接口直接作为响应体），document 为 SessionManager.get_document 的返回值
+    """
+    # 写入标题
+    yield "# 项目需求说明书\n\n"
+
+    # 写入原始想法
+    yield "## 1. 项目原始想法\n\n"
+    yield f"{document['idea'] or '未提供项目想法'}\n\n"
+
+    # 写入问答内容（只有在有数据时才添加）
+    qa_fragments = [qa for qa, _ in document['rounds'] if qa]
+    if qa_fragments:
+        yield "## 2. 需求澄清问答\n\n"
+        yield from qa_fragments
+
+    # 写入分析报告
+    if document['rounds']:
+        yield "## 3. 阶段性分析报告\n\n"
+        for _, report in document['rounds']:
+            yield report
+
+    # 如果没有任何内容，添加默认内容
+    if not document['idea'] and not document['rounds']:
+        yield "暂无内容\n"
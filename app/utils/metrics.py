@@ -0,0 +1,66 @@
+import threading
+from collections import deque
+
+
+class LatencyRecorder:
+    """
+    记录最近若干次耗时（毫秒）并计算分位数
+
+    只保留最近 window 个样本，内存占用固定，分位数反映的是近期情况
+    """
+
+    def __init__(self, window=1000):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def record(self, ms):
+        with self._lock:
+            self._samples.append(ms)
+            self.count += 1
+
+    def percentile(self, p):
+        """返回近期样本的 p 分位数（0 < p < 1），没有样本时返回 None"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+    def summary(self):
+        with self._lock:
+            samples = sorted(self._samples)
+            count = self.count
+        if not samples:
+            return {'count': count}
+
+        def pick(p):
+            return round(samples[min(len(samples) - 1, int(len(samples) * p))], 1)
+
+        return {
+            'count': count,
+            'p50_ms': pick(0.50),
+            'p95_ms': pick(0.95),
+            'p99_ms': pick(0.99),
+            'max_ms': round(samples[-1], 1)
+        }
+
+
+_recorders = {}
+_recorders_lock = threading.Lock()
+
+
+def get_recorder(name):
+    """按名称获取（不存在时创建）耗时记录器"""
+    recorder = _recorders.get(name)
+    if recorder is None:
+        with _recorders_lock:
+            recorder = _recorders.setdefault(name, LatencyRecorder())
+    return recorder
+
+
+def latency_summary():
+    """所有耗时记录器的汇总"""
+    with _recorders_lock:
+        items = list(_recorders.items())
+    return {name: recorder.summary() for name, recorder in sorted(items)}
@@ -0,0 +1,292 @@
+"""
+下一轮问题的预取（推测执行，默认关闭，QUESTION_PREFETCH=1 开启）
+
+提交答案、本轮报告保存后，在后台以空反馈生成下一轮问题。用户随后「继续」时，如果反馈为空或只是
+「继续」「好的」之类，并且会话在此期间没有变化，直接使用预取的问题（仍在生成时等待其完成），
+不再调用模型。
+
+- 同时进行的预取不超过 QUESTION_PREFETCH_CONCURRENCY 个，已满时不再预取（不排队）
+- 预取以流式调用进行：会话有新的提交、被删除或用户给出了实质性反馈时取消，正在进行的调用随之断开
+- 预取的用量照常计入单日用量（接口记为 prefetch），使用时才计入租户配额；
+  未使用（取消、过期、被替换）的预取消耗的 token 单独统计
+- 只对使用服务端 API 配置的提交预取，不替用户的自定义 API 发出额外的请求
+"""
+import asyncio
+import atexit
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from app.utils.concurrency import set_bulk_priority
+from app.utils.qwen_api import FALLBACK_QUESTIONS, stream_questions
+from app.utils.tenant_quota import set_tenant, tenant_quotas
+from app.utils.token_limit import TokenLimitExceeded
+from app.utils.token_usage import metered, set_endpoint
+
+# 预取时使用的反馈：提示词中带上已有问答，由模型自行决定深入的方向
+PREFETCH_FEEDBACK = '无'
+
+# 视为「没有实质内容」的反馈（去掉空白和标点、转为小写后比较）
+TRIVIAL_FEEDBACK = {
+    '', '无', '没有', '没了', '继续', '继续吧', '请继续', '下一步', '下一轮', '好', '好的', '可以', '行', '嗯',
+    '没问题', '都可以', '随便', 'ok', 'okay', 'yes', 'continue', 'next', 'go', 'none', 'no'
+}
+
+_PUNCTUATION_RE = re.compile(r'[\s\W_]+', re.UNICODE)
+
+_FALLBACK = [dict(question) for question in FALLBACK_QUESTIONS]
+
+
+def is_trivial_feedback(feedback):
+    """反馈为空或只是「继续」之类的确认"""
+    return _PUNCTUATION_RE.sub('', (feedback or '').lower()) in TRIVIAL_FEEDBACK
+
+
+def session_fingerprint(session_data):
+    """会话当前问题和已有答案的摘要，预取只在会话没有变化时使用"""
+    payload = json.dumps([session_data['questions'], session_data['answers']], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class _Prefetch:
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.fingerprint = None
+        self.questions = None
+        self.tokens = 0
+        self.cancelled = False
+        self.future = None
+        self.finished_at = None
+
+
+class QuestionPrefetcher:
+    def __init__(self, enabled=False, concurrency=2, ttl=600.0, max_entries=1000):
+        self.enabled = enabled
+        self.concurrency = concurrency
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # 会话 ID -> 预取（每个会话最多一个）
+        self._entries = OrderedDict()
+        self._active = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self.scheduled = 0
+        self.skipped_busy = 0
+        self.skipped_budget = 0
+        self.completed = 0
+        self.served = 0
+        self.served_after_wait = 0
+        self.missed = 0
+        self.cancelled = 0
+        self.cancelled_in_flight = 0
+        self.tokens_spent = 0
+        self.tokens_served = 0
+        self.tokens_wasted = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='prefetch')
+        return self._executor
+
+    def schedule(self, session_id):
+        """本轮报告保存后调用：取消该会话之前的预取，开始新的预取（并发已满时跳过）"""
+        if not self.enabled:
+            return False
+
+        with self._lock:
+            self._discard(self._entries.pop(session_id, None))
+            if self._active >= self.concurrency:
+                self.skipped_busy += 1
+                return False
+            self._active += 1
+            self.scheduled += 1
+
+            entry = _Prefetch(session_id)
+            self._entries[session_id] = entry
+            while len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._discard(evicted)
+            entry.future = self._get_executor().submit(self._run, entry)
+        return True
+
+    def cancel(self, session_id):
+        """取消会话的预取（会话有新的提交、被删除，或用户给出了实质性反馈）"""
+        with self._lock:
+            self._discard(self._entries.pop(session_id, None))
+
+    def _discard(self, entry):
+        """放弃一个预取：进行中的调用在下一个问题到达时断开，已完成的用量计为浪费（调用方持有锁）"""
+        if entry is None or entry.cancelled:
+            return
+        entry.cancelled = True
+        self.cancelled += 1
+        if entry.finished_at is None:
+            self.cancelled_in_flight += 1
+        else:
+            self.tokens_wasted += entry.tokens
+
+    def _run(self, entry):
+        questions, tokens = None, 0
+        try:
+            questions, tokens = self._generate(entry)
+        except TokenLimitExceeded:
+            with self._lock:
+                self.skipped_budget += 1
+        except Exception as e:
+            print(f"Error prefetching questions: {str(e)}")
+
+        with self._lock:
+            self._active -= 1
+            entry.finished_at = time.monotonic()
+            entry.tokens = tokens
+            self.tokens_spent += tokens
+            if entry.cancelled:
+                self.tokens_wasted += tokens
+                return
+            # 解析失败时得到的是默认问题，不作为预取结果
+            if questions and questions != _FALLBACK:
+                entry.questions = questions
+                self.completed += 1
+            else:
+                del self._entries[entry.session_id]
+                self.tokens_wasted += tokens
+
+    def _generate(self, entry):
+        """生成预取的问题，返回 (问题列表, 消耗的 token 数)"""
+        from app.models.session import SessionManager
+
+        # 预取的用量单独统计，不计入任何租户
+        set_endpoint('prefetch')
+        set_tenant(None)
+        set_bulk_priority()
+        session_data = SessionManager.get_session(entry.session_id)
+        if session_data is None or entry.cancelled:
+            return None, 0
+        entry.fingerprint = session_fingerprint(session_data)
+
+        questions = []
+        with metered() as meter:
+            stream = stream_questions(session_data['idea'], session_data['questions'],
+                                      session_data['answers'], PREFETCH_FEEDBACK)
+            try:
+                for question in stream:
+                    if entry.cancelled:
+                        break
+                    questions.append(question)
+            finally:
+                # 取消时关闭流，上游随之停止生成
+                stream.close()
+        return questions, meter.tokens
+
+    def _claim(self, session_id, fingerprint):
+        """取出与会话当前状态一致的预取，返回 (预取, 是否仍在进行)；状态不一致的预取被放弃"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None, False
+            if entry.finished_at is not None:
+                expired = time.monotonic() - entry.finished_at > self.ttl
+                if entry.questions is None or expired or entry.fingerprint != fingerprint:
+                    self._discard(self._entries.pop(session_id))
+                    return None, False
+                del self._entries[session_id]
+                return entry, False
+            # 仍在进行：会话状态在预取开始后才读取，先等待完成再比较
+            return entry, True
+
+    def take(self, session_id, session_data, tenant=None):
+        """
+        继续细化需求（反馈为空或没有实质内容）时调用，返回预取的问题，没有可用的预取时返回 None
+
+        预取仍在进行时等待其完成；使用的预取用量计入 tenant 的配额
+        """
+        if not self.enabled:
+            return None
+        fingerprint = session_fingerprint(session_data)
+        entry, running = self._claim(session_id, fingerprint)
+        if entry is not None and running:
+            try:
+                entry.future.result()
+            except Exception:
+                pass
+            entry, _ = self._claim(session_id, fingerprint)
+            waited = True
+        else:
+            waited = False
+        return self._serve(entry, tenant, waited)
+
+    async def atake(self, session_id, session_data, tenant=None):
+        """take 的异步版本，等待预取完成时不占用线程"""
+        if not self.enabled:
+            return None
+        fingerprint = session_fingerprint(session_data)
+        entry, running = self._claim(session_id, fingerprint)
+        if entry is not None and running:
+            try:
+                # shield：客户端断开取消本请求时不能连带取消还没开始执行的预取
+                await asyncio.shield(asyncio.wrap_future(entry.future))
+            except Exception:
+                pass
+            entry, _ = self._claim(session_id, fingerprint)
+            waited = True
+        else:
+            waited = False
+        return self._serve(entry, tenant, waited)
+
+    def _serve(self, entry, tenant, waited):
+        with self._lock:
+            if entry is None:
+                self.missed += 1
+                return None
+            self.served += 1
+            self.served_after_wait += waited
+            self.tokens_served += entry.tokens
+        tenant_quotas.charge(tenant, entry.tokens)
+        return [dict(question) for question in entry.questions]
+
+    def close(self):
+        """取消所有预取（进程退出时调用）"""
+        with self._lock:
+            for entry in self._entries.values():
+                self._discard(entry)
+            self._entries.clear()
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def stats(self):
+        with self._lock:
+            attempts = self.served + self.missed
+            return {
+                'enabled': self.enabled,
+                'concurrency': self.concurrency,
+                'active': self._active,
+                'entries': len(self._entries),
+                'scheduled': self.scheduled,
+                'skipped_busy': self.skipped_busy,
+                'skipped_budget': self.skipped_budget,
+                'completed': self.completed,
+                'served': self.served,
+                'served_after_wait': self.served_after_wait,
+                'missed': self.missed,
+                'hit_rate': round(self.served / attempts, 4) if attempts else 0.0,
+                'cancelled': self.cancelled,
+                'cancelled_in_flight': self.cancelled_in_flight,
+                'tokens_spent': self.tokens_spent,
+                'tokens_served': self.tokens_served,
+                'tokens_wasted': self.tokens_wasted
+            }
+
+
+question_prefetcher = QuestionPrefetcher(
+    enabled=os.getenv('QUESTION_PREFETCH', '0') == '1',
+    concurrency=int(os.getenv('QUESTION_PREFETCH_CONCURRENCY', '2')),
+    ttl=float(os.getenv('QUESTION_PREFETCH_TTL', '600')),
+    max_entries=int(os.getenv('QUESTION_PREFETCH_MAX_ENTRIES', '1000'))
+)
+atexit.register(question_prefetcher.close)
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import re
+import threading
+import time
+import unicodedata
+from app.utils.lru_cache import LRUCache
+
+
+def normalize_idea(idea):
+    """
+    归一化用户想法，使只有空白、全半角、大小写或结尾标点不同的想法得到相同的缓存键
+    """
+    text = unicodedata.normalize('NFKC', idea).lower()
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text.rstrip('。.!！?？~～ ')
+
+
+class QuestionCache:
+    """
+    首轮问题（只有原始想法，没有问答历史和反馈）的缓存
+
+    键由归一化后的想法、模型和提示词模板版本组成。进程内 LRU 在前，SQLite 表（question_cache）在后，
+    重启后缓存仍然有效；两层都按 ttl 过期、按 max_entries 淘汰。max_entries 为 0 时关闭缓存
+    """
+
+    def __init__(self, max_entries=0, ttl=86400, template_version=1):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.template_version = template_version
+        # 值为 (问题 JSON, 写入时间)，每次命中都重新解析，调用方拿到的是独立的副本
+        self._memory = LRUCache(max_entries=max_entries)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def key(self, idea, model):
+        raw = json.dumps([self.template_version, model, normalize_idea(idea)], ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, idea, model):
+        """返回缓存的问题列表，未命中时返回 None"""
+        from app.models.session import SessionManager
+
+        cache_key = self.key(idea, model)
+        min_created_at = time.time() - self.ttl
+
+        item = self._memory.get(cache_key)
+        if item is None or item[1] <= min_created_at:
+            try:
+                item = SessionManager.get_cached_questions(cache_key, min_created_at)
+            except Exception as e:
+                # 缓存不可用时按未命中处理，不影响正常生成
+                print(f"Error reading question cache: {str(e)}")
+                item = None
+            if item is not None:
+                self._memory.set(cache_key, item)
+
+        with self._lock:
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(item[0])
+
+    def set(self, idea, model, questions):
+        from app.models.session import SessionManager
+
+        cache_key = self.key(idea, model)
+        questions_json = json.dumps(questions, ensure_ascii=False)
+        created_at = time.time()
+
+        try:
+            SessionManager.save_cached_questions(cache_key, model, idea, questions_json, created_at,
+                                                 self.max_entries, created_at - self.ttl)
+        except Exception as e:
+            print(f"Error writing question cache: {str(e)}")
+            return
+        self._memory.set(cache_key, (questions_json, created_at))
+        with self._lock:
+            self.stores += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'template_version': self.template_version,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'stores': self.stores,
+                'memory_entries': self._memory.stats()['entries']
+            }
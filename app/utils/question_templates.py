@@ -0,0 +1,200 @@
+"""
+首轮问题的模板：按交付物类型预置的问题集，不调用模型，用于立即展示首轮问题
+
+用关键词（中文按子串匹配，相当于字符 n-gram；英文按单词匹配）给想法打分，判断交付物类型
+（PPT、代码、文章、方案、报告、设计），返回该类型的问题集；没有命中任何关键词时返回通用问题集。
+模型生成的问题随后在后台生成（见 app/routes/main.py 的 instant 模式），由前端替换
+"""
+import copy
+import re
+import threading
+
+GENERAL = 'general'
+
+# 类型 -> (名称, [(关键词, 权重)])；越具体的关键词权重越高
+DELIVERABLE_KEYWORDS = {
+    'ppt': ('演示文稿', [
+        ('ppt', 3), ('幻灯片', 3), ('演示文稿', 3), ('课件', 3), ('slides', 3), ('keynote', 3), ('deck', 2),
+        ('路演', 2), ('答辩', 2), ('汇报', 2), ('演示', 2), ('presentation', 2), ('讲解', 1), ('分享会', 1),
+    ]),
+    'code': ('代码 / 软件', [
+        ('代码', 3), ('程序', 3), ('小程序', 3), ('网站', 3), ('网页', 2), ('app', 3), ('脚本', 3), ('插件', 3),
+        ('爬虫', 3), ('api', 2), ('接口', 2), ('后端', 3), ('前端', 3), ('数据库', 2), ('算法', 2), ('开发', 2),
+        ('系统', 1), ('应用', 1), ('工具', 1), ('机器人', 1), ('python', 3), ('java', 3), ('javascript', 3),
+        ('react', 3), ('vue', 3), ('sql', 2), ('bot', 2), ('website', 3), ('software', 3), ('code', 3),
+        ('游戏', 2),
+    ]),
+    'article': ('文章 / 文案', [
+        ('文章', 3), ('博客', 3), ('公众号', 3), ('推文', 3), ('文案', 3), ('软文', 3), ('小说', 3), ('故事', 2),
+        ('论文', 3), ('作文', 3), ('演讲稿', 3), ('稿子', 2), ('新闻稿', 3), ('诗', 2), ('剧本', 3), ('书评', 3),
+        ('写一篇', 3), ('写篇', 3), ('邮件', 2), ('blog', 3), ('essay', 3), ('article', 3), ('post', 1),
+    ]),
+    'plan': ('方案 / 计划', [
+        ('方案', 3), ('计划', 2), ('计划书', 3), ('策划', 3), ('规划', 2), ('策略', 2), ('活动', 2), ('运营', 2),
+        ('营销', 2), ('推广', 2), ('创业', 2), ('预算', 2), ('流程', 1), ('路线图', 3), ('商业模式', 3),
+        ('proposal', 3), ('roadmap', 3), ('strategy', 2), ('plan', 2), ('campaign', 2),
+    ]),
+    'report': ('报告 / 分析', [
+        ('报告', 3), ('调研', 3), ('分析', 2), ('研究', 2), ('复盘', 3), ('总结', 2), ('周报', 3), ('月报', 3),
+        ('年报', 3), ('竞品', 3), ('数据分析', 3), ('白皮书', 3), ('评估', 2), ('report', 3), ('research', 3),
+        ('analysis', 3), ('survey', 2),
+    ]),
+    'design': ('设计', [
+        ('设计', 2), ('logo', 3), ('海报', 3), ('界面', 2), ('原型', 3), ('插画', 3), ('视觉', 2), ('品牌', 1),
+        ('名片', 3), ('图标', 3), ('配色', 3), ('ui', 2), ('ux', 2), ('poster', 3), ('mockup', 3), ('banner', 3),
+    ]),
+}
+
+# 类型 -> 问题集（与模型返回的问题格式相同，最后一个为叙述题）
+TEMPLATES = {
+    'ppt': [
+        {"id": "q1", "text": "这份演示文稿的主要受众是谁？", "type": "choice",
+         "options": ["公司领导 / 决策者", "客户 / 投资人", "团队同事", "学生 / 听课者", "公开场合的大众听众"]},
+        {"id": "q2", "text": "演示的主要目的是什么？", "type": "choice",
+         "options": ["汇报进展或成果", "说服对方做出决定", "讲解知识或培训", "产品或项目介绍", "其他"]},
+        {"id": "q3", "text": "预计的页数或演讲时长是多少？", "type": "fill_blank"},
+        {"id": "q4", "text": "您期望的视觉风格是？", "type": "choice",
+         "options": ["简洁商务", "科技感", "活泼有趣", "学术严谨", "与公司模板一致"]},
+        {"id": "q5", "text": "有哪些必须包含的内容、数据或案例？", "type": "fill_blank"},
+        {"id": "q6", "text": "请补充您对这份演示文稿的其他想法或要求。", "type": "narrative"},
+    ],
+    'code': [
+        {"id": "q1", "text": "这个程序要解决的核心问题或主要功能是什么？", "type": "fill_blank"},
+        {"id": "q2", "text": "它以什么形式运行？", "type": "choice",
+         "options": ["网站 / Web 应用", "手机 App", "小程序", "桌面软件", "命令行脚本", "后端服务 / API"]},
+        {"id": "q3", "text": "主要用户是谁，大约有多少人使用？", "type": "fill_blank"},
+        {"id": "q4", "text": "对技术栈有要求吗（语言、框架、部署环境）？", "type": "fill_blank"},
+        {"id": "q5", "text": "需要对接哪些已有系统或数据（账号、支付、数据库、第三方接口等）？", "type": "fill_blank"},
+        {"id": "q6", "text": "您期望的交付节奏是？", "type": "choice",
+         "options": ["先做最小可用版本", "一次完成完整功能", "只需要设计和技术方案", "只需要核心代码片段"]},
+        {"id": "q7", "text": "请补充其他需求、限制或参考产品。", "type": "narrative"},
+    ],
+    'article': [
+        {"id": "q1", "text": "这篇内容发布在哪里？", "type": "choice",
+         "options": ["公众号 / 博客", "社交媒体短文", "学术或专业刊物", "公司内部", "演讲 / 口播", "其他"]},
+        {"id": "q2", "text": "目标读者是谁？", "type": "fill_blank"},
+        {"id": "q3", "text": "您期望的语气和风格是？", "type": "choice",
+         "options": ["专业严谨", "轻松幽默", "温暖感性", "犀利有观点", "简洁直白"]},
+        {"id": "q4", "text": "预计的篇幅是多少字？", "type": "fill_blank"},
+        {"id": "q5", "text": "希望读者读完后记住或做到什么？", "type": "fill_blank"},
+        {"id": "q6", "text": "请补充需要包含的观点、素材或参考文章。", "type": "narrative"},
+    ],
+    'plan': [
+        {"id": "q1", "text": "这个方案要达成的核心目标是什么？如何衡量成功？", "type": "fill_blank"},
+        {"id": "q2", "text": "方案的阅读者或审批者是谁？", "type": "choice",
+         "options": ["公司领导", "客户", "投资人", "团队内部执行", "合作伙伴"]},
+        {"id": "q3", "text": "计划的时间范围是多长？", "type": "choice",
+         "options": ["一周以内", "一个月左右", "一个季度", "半年到一年", "更长期"]},
+        {"id": "q4", "text": "可用的预算和人力大致是多少？", "type": "fill_blank"},
+        {"id": "q5", "text": "目前已知的限制或风险有哪些？", "type": "fill_blank"},
+        {"id": "q6", "text": "请补充背景信息和您已有的初步想法。", "type": "narrative"},
+    ],
+    'report': [
+        {"id": "q1", "text": "这份报告要回答的核心问题是什么？", "type": "fill_blank"},
+        {"id": "q2", "text": "报告的读者是谁？", "type": "choice",
+         "options": ["管理层", "客户", "团队同事", "投资人", "公开发布"]},
+        {"id": "q3", "text": "已有哪些数据或资料可以使用？", "type": "fill_blank"},
+        {"id": "q4", "text": "分析的范围（时间段、市场、对象）是什么？", "type": "fill_blank"},
+        {"id": "q5", "text": "您期望的呈现形式是？", "type": "choice",
+         "options": ["图表为主的简报", "完整的文字报告", "一页纸结论摘要", "数据表格 + 说明"]},
+        {"id": "q6", "text": "请补充您已有的判断或需要重点关注的方面。", "type": "narrative"},
+    ],
+    'design': [
+        {"id": "q1", "text": "需要设计的具体是什么，会用在什么场景？", "type": "fill_blank"},
+        {"id": "q2", "text": "目标人群是谁？", "type": "fill_blank"},
+        {"id": "q3", "text": "您期望的风格是？", "type": "choice",
+         "options": ["极简", "科技感", "活泼可爱", "高端质感", "国风 / 复古", "与现有品牌一致"]},
+        {"id": "q4", "text": "有指定的颜色、字体、尺寸或格式要求吗？", "type": "fill_blank"},
+        {"id": "q5", "text": "有喜欢或需要避开的参考作品吗？", "type": "fill_blank"},
+        {"id": "q6", "text": "请补充其他要求或想传达的感觉。", "type": "narrative"},
+    ],
+    GENERAL: [
+        {"id": "q1", "text": "您最终希望得到什么形式的成果？", "type": "choice",
+         "options": ["PPT / 演示文稿", "代码 / 软件", "文章 / 文案", "方案 / 计划", "报告 / 分析", "设计作品"]},
+        {"id": "q2", "text": "这个成果是给谁用或给谁看的？", "type": "fill_blank"},
+        {"id": "q3", "text": "您最看重的是什么？", "type": "choice",
+         "options": ["尽快完成", "质量和细节", "成本可控", "创意和新意"]},
+        {"id": "q4", "text": "有截止时间或篇幅、规模上的要求吗？", "type": "fill_blank"},
+        {"id": "q5", "text": "请详细描述您的想法、背景和已有的材料。", "type": "narrative"},
+    ],
+}
+
+_ENGLISH_RE = re.compile(r'^[a-z]+$')
+
+
+def _compile(keywords):
+    """英文关键词按单词匹配（避免 app 命中 apple），中文关键词按子串匹配"""
+    compiled = []
+    for keyword, weight in keywords:
+        if _ENGLISH_RE.match(keyword):
+            compiled.append((re.compile(rf'(?<![a-z]){keyword}(?![a-z])'), weight))
+        else:
+            compiled.append((keyword, weight))
+    return compiled
+
+
+_COMPILED = {kind: _compile(keywords) for kind, (_, keywords) in DELIVERABLE_KEYWORDS.items()}
+
+
+def score_idea(idea):
+    """返回各交付物类型的得分"""
+    text = (idea or '').lower()
+    scores = {}
+    for kind, keywords in _COMPILED.items():
+        score = 0
+        for keyword, weight in keywords:
+            if isinstance(keyword, str):
+                if keyword in text:
+                    score += weight
+            elif keyword.search(text):
+                score += weight
+        if score:
+            scores[kind] = score
+    return scores
+
+
+def classify_idea(idea):
+    """判断交付物类型，返回 (类型, 置信度)；没有命中任何关键词时返回 (GENERAL, 0.0)"""
+    scores = score_idea(idea)
+    if not scores:
+        return GENERAL, 0.0
+    # 同分时按 DELIVERABLE_KEYWORDS 中的顺序
+    kind = max(scores, key=scores.get)
+    return kind, round(scores[kind] / sum(scores.values()), 2)
+
+
+class TemplateStats:
+    """模板问题的使用统计：各类型的次数，以及模型生成的问题被前端采用的次数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.by_type = {}
+        self.adopted = 0
+
+    def record(self, kind):
+        with self._lock:
+            self.by_type[kind] = self.by_type.get(kind, 0) + 1
+
+    def record_adopted(self):
+        with self._lock:
+            self.adopted += 1
+
+    def stats(self):
+        with self._lock:
+            total = sum(self.by_type.values())
+            return {
+                'served': total,
+                'by_type': dict(self.by_type),
+                'general_rate': round(self.by_type.get(GENERAL, 0) / total, 4) if total else 0.0,
+                'refined_adopted': self.adopted
+            }
+
+
+template_stats = TemplateStats()
+
+
+def template_questions(idea):
+    """返回 (交付物类型, 置信度, 问题列表)，问题列表为副本"""
+    kind, confidence = classify_idea(idea)
+    template_stats.record(kind)
+    return kind, confidence, copy.deepcopy(TEMPLATES[kind])
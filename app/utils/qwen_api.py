@@ -1,42 +1,304 @@
+import asyncio
+import hashlib
+import itertools
+import json
 import os
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
 from dotenv import load_dotenv
+from app.models.database import run_db
+from app.utils.call_policy import CallPolicy, breaker_stats
+from app.utils.concurrency import limiter_stats
+from app.utils.context import count_tokens, fit_report_context
+from app.utils.disconnects import disconnects
+from app.utils.json_stream import JSONArrayStreamParser
+from app.utils.lru_cache import LRUCache
+from app.utils.question_cache import QuestionCache
+from app.utils.question_templates import TEMPLATES
+from app.utils.similar_ideas import similar_ideas
+from app.utils.structured_output import (astructured_request, normalize_question, parse_questions, parse_stats,
+                                         structured_request)
+from app.utils.tenant_quota import current_tenant, tenant_quotas
+from app.utils.token_limit import token_budget
+from app.utils.token_usage import token_usage
 
 # 加载环境变量
 load_dotenv()
 
+
+def _http2_available():
+    """安装了 h2 时才能启用 HTTP/2"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _limits(max_connections):
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20")),
+        keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+    )
+
+
+# 所有 API 客户端共用的 HTTP 连接池：复用 TCP/TLS 连接（keep-alive），可用时启用 HTTP/2
+http_client = DefaultHttpxClient(
+    limits=_limits(int(os.getenv("LLM_MAX_CONNECTIONS", "100"))),
+    http2=_http2_available()
+)
+
+class _ShardedAsyncTransport(httpx.AsyncBaseTransport):
+    """
+    把连接分散到多个连接池，请求轮流分配
+
+    httpcore 每次分配连接都要遍历池中所有连接，单个池同时有数百个进行中的请求时，
+    开销随并发数平方增长（400 个并发请求时仅连接池簿记就要数秒 CPU）
+    """
+
+    # 每个分片的连接数上限
+    SHARD_SIZE = 64
+
+    def __init__(self, max_connections, http2=False):
+        shards = max(1, -(-max_connections // self.SHARD_SIZE))
+        per_shard = -(-max_connections // shards)
+        self._transports = [
+            httpx.AsyncHTTPTransport(limits=_limits(per_shard), http2=http2)
+            for _ in range(shards)
+        ]
+        self._next = itertools.count()
+
+    async def handle_async_request(self, request):
+        transport = self._transports[next(self._next) % len(self._transports)]
+        return await transport.handle_async_request(request)
+
+    async def aclose(self):
+        for transport in self._transports:
+            await transport.aclose()
+
+
+# 异步路径（app/asgi.py）共用的连接池。每个进行中的调用在 HTTP/1.1 下各占一个连接，
+# 上限决定了一个进程能同时等待多少个模型调用
+async_http_client = DefaultAsyncHttpxClient(
+    transport=_ShardedAsyncTransport(int(os.getenv("LLM_ASYNC_MAX_CONNECTIONS", "1000")),
+                                     http2=_http2_available())
+)
+
+DEFAULT_API_KEY = os.getenv("QWEN_API_KEY") or os.getenv("OPENAI_API_KEY")
+DEFAULT_BASE_URL = os.getenv("QWEN_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
+
 # 创建默认 OpenAI 客户端（这里使用 Qwen API 兼容的格式）
+# 重试由调用策略（app/utils/call_policy.py）负责，客户端本身不重试
 default_client = OpenAI(
-    api_key=os.getenv("QWEN_API_KEY") or os.getenv("OPENAI_API_KEY"),
-    base_url=os.getenv("QWEN_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
+    api_key=DEFAULT_API_KEY,
+    base_url=DEFAULT_BASE_URL,
+    http_client=http_client,
+    max_retries=0
+)
+
+default_async_client = AsyncOpenAI(
+    api_key=DEFAULT_API_KEY,
+    base_url=DEFAULT_BASE_URL,
+    http_client=async_http_client,
+    max_retries=0
+)
+
+# 自定义 API 配置的客户端缓存，键为 (密钥指纹, base_url)，缓存键和统计中不出现原始密钥；
+# 闲置超过 CLIENT_IDLE_TIMEOUT 秒的客户端会被淘汰
+_custom_clients = LRUCache(
+    max_entries=int(os.getenv("CLIENT_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("CLIENT_IDLE_TIMEOUT", "600")),
+    sliding=True
 )
+_custom_async_clients = LRUCache(
+    max_entries=int(os.getenv("CLIENT_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("CLIENT_IDLE_TIMEOUT", "600")),
+    sliding=True
+)
+
+
+def _key_fingerprint(api_key):
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
 
 
 def get_client(custom_api_key=None, custom_base_url=None):
     """获取 API 客户端，支持自定义配置"""
     if custom_api_key:
-        return OpenAI(
-            api_key=custom_api_key,
-            base_url=custom_base_url or os.getenv("QWEN_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
-        )
+        base_url = custom_base_url or DEFAULT_BASE_URL
+        cache_key = (_key_fingerprint(custom_api_key), base_url)
+
+        client = _custom_clients.get(cache_key)
+        if client is None:
+            # 共用 http_client，淘汰的客户端不需要单独关闭连接
+            client = OpenAI(api_key=custom_api_key, base_url=base_url, http_client=http_client,
+                            max_retries=0)
+            _custom_clients.set(cache_key, client)
+        return client
     return default_client
 
 
-def generate_questions(idea, questions_list=None, answers_list=None, feedback=None, 
-                      custom_api_key=None, custom_base_url=None, custom_model=None):
+def get_async_client(custom_api_key=None, custom_base_url=None):
+    """获取异步 API 客户端（AsyncOpenAI），缓存方式与 get_client 相同"""
+    if custom_api_key:
+        base_url = custom_base_url or DEFAULT_BASE_URL
+        cache_key = (_key_fingerprint(custom_api_key), base_url)
+
+        client = _custom_async_clients.get(cache_key)
+        if client is None:
+            client = AsyncOpenAI(api_key=custom_api_key, base_url=base_url, http_client=async_http_client,
+                                 max_retries=0)
+            _custom_async_clients.set(cache_key, client)
+        return client
+    return default_async_client
+
+
+def client_cache_stats():
+    """自定义 API 客户端缓存的统计"""
+    return _custom_clients.stats()
+
+
+def async_client_cache_stats():
+    """异步路径自定义 API 客户端缓存的统计"""
+    return _custom_async_clients.stats()
+
+
+# AI 返回内容中解析不出问题时使用的默认问题
+FALLBACK_QUESTIONS = [
+    {
+        "id": "fallback-1",
+        "text": "(AI返回失败，默认问题)请详细描述您的项目目标和预期功能。",
+        "type": "narrative"
+    },
+    {
+        "id": "fallback-2",
+        "text": "(AI返回失败，默认问题)您的目标用户群体是谁？",
+        "type": "narrative"
+    }
+]
+
+# 调用 API 出错时使用的默认问题
+ERROR_QUESTIONS = [
+    {
+        "id": "error-1",
+        "text": "(AI返回失败，默认问题)请详细描述您的项目想法。",
+        "type": "narrative"
+    }
+]
+
+
+def is_default_questions(questions):
+    """是否为模型调用失败时返回的默认问题"""
+    default_ids = {q['id'] for q in FALLBACK_QUESTIONS + ERROR_QUESTIONS}
+    return bool(questions) and all(q.get('id') in default_ids for q in questions)
+
+
+# 单次调用的输出 token 上限，预留 token 时按「提示词 + 输出上限」估算
+QUESTIONS_MAX_TOKENS = 4000
+REPORT_MAX_TOKENS = 4000
+
+
+def _reserve_tokens(prompt, max_tokens, is_custom_api):
     """
-    使用 Qwen API 根据用户想法、已有问答和反馈生成问题
+    调用模型前预留本次最多可能消耗的 token，超出单日限额时抛出 TokenLimitExceeded
+
+    调用结束后按 response.usage 结算，失败时释放
     """
-    # 获取客户端
-    client = get_client(custom_api_key, custom_base_url)
-    
-    # 获取模型
-    model = custom_model or os.getenv("QWEN_MODEL", "qwen-flash")
-    
-    # 标记是否使用自定义 API 配置
-    is_custom_api = bool(custom_api_key)
-    
-    # 构建提示词 - 检查是否有问答历史
+    return token_budget.reserve(count_tokens(prompt) + max_tokens, is_custom_api)
+
+
+async def _areserve_tokens(prompt, max_tokens, is_custom_api):
+    """
+    _reserve_tokens 的异步版本：预留时可能从数据库同步已用量，放到数据库线程池中执行
+
+    等待期间请求被取消时，线程中完成的预留随即释放
+    """
+    future = asyncio.ensure_future(run_db(_reserve_tokens, prompt, max_tokens, is_custom_api))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        future.add_done_callback(
+            lambda f: f.cancelled() or f.exception() is not None or f.result().release())
+        raise
+
+
+def _record_usage(tokens, model):
+    """记录使用服务端 API 配置的调用用量：计入当日统计和当前请求所属租户的配额"""
+    token_usage.record(tokens, model)
+    tenant_quotas.charge(current_tenant(), tokens)
+
+
+def _record_discarded(response):
+    """
+    对冲中落后但成功返回的响应：结果丢弃，用量照常记录（只有服务端 API 配置的调用会对冲）
+
+    预留只按胜出的一次调用结算，丢弃的用量另外计入单日限额的已用量，否则要等下次同步数据库才计入
+    """
+    if response.usage:
+        token_budget.commit(response.usage.total_tokens)
+        _record_usage(response.usage.total_tokens, response.model)
+
+
+# 生成问题和生成报告的调用策略：截止时间、重试、对冲请求和熔断
+questions_policy = CallPolicy.from_env('questions', 60)
+report_policy = CallPolicy.from_env('report', 180)
+
+
+def question_parse_stats():
+    return parse_stats.stats()
+
+
+def call_policy_stats():
+    return {
+        'questions': questions_policy.stats(),
+        'report': report_policy.stats(),
+        'breakers': breaker_stats(),
+        'concurrency': limiter_stats()
+    }
+
+
+# 首轮提示词模板的版本号，修改 _build_questions_prompt 中只有原始想法的提示词时递增，旧的缓存随之失效
+QUESTIONS_PROMPT_VERSION = 2
+
+# 首轮问题缓存（默认关闭，设置 QUESTION_CACHE_SIZE 开启）
+question_cache = QuestionCache(
+    max_entries=int(os.getenv("QUESTION_CACHE_SIZE", "0")),
+    ttl=float(os.getenv("QUESTION_CACHE_TTL", "86400")),
+    template_version=QUESTIONS_PROMPT_VERSION
+)
+
+
+def question_cache_stats():
+    """首轮问题缓存的统计"""
+    return question_cache.stats()
+
+
+def _is_cacheable(questions_list, feedback, is_custom_api):
+    """只缓存使用服务端默认 API 配置的首轮问题（没有问答历史和反馈）"""
+    return question_cache.enabled and not is_custom_api and not questions_list and not feedback
+
+
+def _is_reusable(questions):
+    """相似想法的历史问题中，默认问题和即时模式的模板问题不复用"""
+    return not is_default_questions(questions) and questions not in TEMPLATES.values()
+
+
+def _find_similar_questions(idea, questions_list, feedback, is_custom_api):
+    """首轮问题（使用服务端默认 API 配置）在相似想法的历史会话中查找可以复用的问题，没有时返回 None"""
+    if not similar_ideas.enabled or is_custom_api or questions_list or feedback:
+        return None
+    try:
+        return similar_ideas.find_questions(idea, accept=_is_reusable)
+    except Exception as e:
+        print(f"Error finding similar questions: {str(e)}")
+        return None
+
+
+def _build_questions_prompt(idea, questions_list=None, answers_list=None, feedback=None):
+    """
+    构建生成问题的提示词
+    """
+    # 检查是否有问答历史
     has_qa_history = questions_list and len(questions_list) > 0 and feedback
     
     if has_qa_history:
@@ -71,7 +333,7 @@ def generate_questions(idea, questions_list=None, answers_list=None, feedback=No
         注意：不要重复已经问过的问题，应该根据用户的反馈和已有答案提出新的深入问题。
         问题类型可以包括选择题、填空题和叙述题。
         其中，最后一个问题应当为叙述题，允许用户自由陈述或补充想法
-        请以 JSON 格式返回问题列表，每个问题包含以下字段：
+        请以 JSON 格式返回问题列表：只输出一个 JSON 对象 {{"questions": [...]}}，不要输出其他内容。每个问题包含以下字段：
         - id: 问题唯一标识
         - text: 问题内容
         - type: 问题类型 (choice, fill_blank, narrative)
@@ -95,7 +357,7 @@ def generate_questions(idea, questions_list=None, answers_list=None, feedback=No
         请基于以上信息，提出 5-10 个有针对性的问题来进一步明确需求。
         问题类型可以包括选择题、填空题和叙述题。
         其中，最后一个问题应当为叙述题，允许用户自由陈述或补充想法
-        请以 JSON 格式返回问题列表，每个问题包含以下字段：
+        请以 JSON 格式返回问题列表：只输出一个 JSON 对象 {{"questions": [...]}}，不要输出其他内容。每个问题包含以下字段：
         - id: 问题唯一标识
         - text: 问题内容
         - type: 问题类型 (choice, fill_blank, narrative)
@@ -118,82 +380,298 @@ def generate_questions(idea, questions_list=None, answers_list=None, feedback=No
         请提出 5-10 个有针对性的问题来明确需求。
         问题类型可以包括选择题、填空题和叙述题。
         其中，最后一个问题应当为叙述题，允许用户自由陈述或补充想法
-        请以 JSON 格式返回问题列表，每个问题包含以下字段：
+        请以 JSON 格式返回问题列表：只输出一个 JSON 对象 {{"questions": [...]}}，不要输出其他内容。每个问题包含以下字段：
         - id: 问题唯一标识
         - text: 问题内容
         - type: 问题类型 (choice, fill_blank, narrative)
         - options: 选项列表（仅选择题需要）
         """
+    return prompt
+
+
+def generate_questions(idea, questions_list=None, answers_list=None, feedback=None, 
+                      custom_api_key=None, custom_base_url=None, custom_model=None):
+    """
+    使用 Qwen API 根据用户想法、已有问答和反馈生成问题
+    """
+    # 获取客户端
+    client = get_client(custom_api_key, custom_base_url)
+    
+    # 获取模型
+    model = custom_model or os.getenv("QWEN_MODEL", "qwen-flash")
+    
+    # 标记是否使用自定义 API 配置
+    is_custom_api = bool(custom_api_key)
+    
+    # 构建提示词
+    prompt = _build_questions_prompt(idea, questions_list, answers_list, feedback)
+
+    # 首轮问题命中缓存时不调用模型，不消耗 token
+    cacheable = _is_cacheable(questions_list, feedback, is_custom_api)
+    if cacheable:
+        cached = question_cache.get(idea, model)
+        if cached is not None:
+            return cached
+
+    # 相似想法的历史会话中有用户回答过的首轮问题时直接复用
+    similar = _find_similar_questions(idea, questions_list, feedback, is_custom_api)
+    if similar is not None:
+        return similar
+
+    reservation = _reserve_tokens(prompt, QUESTIONS_MAX_TOKENS, is_custom_api)
+
+    def create(call_model, timeout):
+        def request(request_timeout, **response_format):
+            return client.chat.completions.create(
+                model=call_model,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt
+                    }
+                ],
+                temperature=0.7,
+                max_tokens=QUESTIONS_MAX_TOKENS,  # 增加 token 限制，允许生成更多问题
+                timeout=request_timeout,
+                **response_format
+            )
+        # 使用服务端 API 配置时请求 JSON 模式输出
+        return structured_request(request, client.base_url, call_model, timeout,
+                                  enabled=not is_custom_api)
     
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            temperature=0.7,
-            max_tokens=4000  # 增加 token 限制，允许生成更多问题
-        )
+        # 使用自定义 API 配置时不对冲（不替用户发出额外的请求）
+        response, used_model = questions_policy.call(client.base_url, model, create, hedge=not is_custom_api,
+                                                      on_discard=_record_discarded)
+        reservation.settle(response.usage.total_tokens if response.usage else 0)
+        disconnects.observe('questions', response.usage)
         
         # 解析 API 响应
         content = response.choices[0].message.content.strip()
         
         # 记录 token 使用量（仅当使用服务端默认 API 配置时且响应有效）
         if not is_custom_api and hasattr(response, 'usage') and response.usage:
-            from app.models.session import SessionManager
-            total_tokens = response.usage.total_tokens
-            SessionManager.add_token_usage(total_tokens)
+            _record_usage(response.usage.total_tokens, used_model)
         
-        # 尝试提取 JSON 部分
-        import re
-        json_match = re.search(r'\[.*\]', content, re.DOTALL)
-        if json_match:
-            import json as json_lib
-            questions = json_lib.loads(json_match.group())
-            return questions
-        else:
-            # 如果没有找到 JSON，返回默认问题作为备选
-            return [
-                {
-                    "id": "fallback-1",
-                    "text": "(AI返回失败，默认问题)请详细描述您的项目目标和预期功能。",
-                    "type": "narrative"
-                },
-                {
-                    "id": "fallback-2",
-                    "text": "(AI返回失败，默认问题)您的目标用户群体是谁？",
-                    "type": "narrative"
-                }
-            ]
+        questions = parse_questions(content)
+        if questions is None:
+            # 如果没有找到 JSON，返回默认问题作为备选（不缓存）
+            return [dict(q) for q in FALLBACK_QUESTIONS]
+
+        # 熔断时改用备用模型生成的问题不写入主模型的缓存
+        if cacheable and used_model == model:
+            question_cache.set(idea, model, questions)
+        return questions
     
     except Exception as e:
         print(f"Error calling Qwen API: {str(e)}")
         # 返回默认问题作为错误处理（不记录 token，因为 API 调用失败）
-        return [
-            {
-                "id": "error-1",
-                "text": "(AI返回失败，默认问题)请详细描述您的项目想法。",
-                "type": "narrative"
-            }
-        ]
+        return [dict(q) for q in ERROR_QUESTIONS]
+    finally:
+        reservation.release()
 
 
-def process_answers_to_doc(idea, questions, answers, custom_api_key=None, custom_base_url=None, custom_model=None):
+async def agenerate_questions(idea, questions_list=None, answers_list=None, feedback=None,
+                             custom_api_key=None, custom_base_url=None, custom_model=None):
     """
-    处理用户答案并生成阶段性报告
+    generate_questions 的异步版本：等待模型返回时不占用线程，记录 token 用量的数据库写入放到专用线程池
+    """
+    client = get_async_client(custom_api_key, custom_base_url)
+    model = custom_model or os.getenv("QWEN_MODEL", "qwen-flash")
+    is_custom_api = bool(custom_api_key)
+    prompt = _build_questions_prompt(idea, questions_list, answers_list, feedback)
+
+    cacheable = _is_cacheable(questions_list, feedback, is_custom_api)
+    if cacheable:
+        cached = await run_db(question_cache.get, idea, model)
+        if cached is not None:
+            return cached
+
+    similar = await run_db(_find_similar_questions, idea, questions_list, feedback, is_custom_api)
+    if similar is not None:
+        return similar
+
+    reservation = await _areserve_tokens(prompt, QUESTIONS_MAX_TOKENS, is_custom_api)
+
+    def create(call_model, timeout):
+        def request(request_timeout, **response_format):
+            return client.chat.completions.create(
+                model=call_model,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt
+                    }
+                ],
+                temperature=0.7,
+                max_tokens=QUESTIONS_MAX_TOKENS,
+                timeout=request_timeout,
+                **response_format
+            )
+        return astructured_request(request, client.base_url, call_model, timeout,
+                                   enabled=not is_custom_api)
+
+    try:
+        response, used_model = await questions_policy.acall(client.base_url, model, create,
+                                                             hedge=not is_custom_api, on_discard=_record_discarded)
+        reservation.settle(response.usage.total_tokens if response.usage else 0)
+        disconnects.observe('questions', response.usage)
+
+        content = response.choices[0].message.content.strip()
+
+        # 记录 token 使用量（仅当使用服务端默认 API 配置时且响应有效）
+        if not is_custom_api and response.usage:
+            _record_usage(response.usage.total_tokens, used_model)
+
+        questions = parse_questions(content)
+        if questions is None:
+            return [dict(q) for q in FALLBACK_QUESTIONS]
+
+        if cacheable and used_model == model:
+            await run_db(question_cache.set, idea, model, questions)
+        return questions
+
+    except asyncio.CancelledError:
+        # 客户端断开（见 app/utils/disconnects.py）：调用随之断开，没有用量可记录
+        disconnects.record_cancelled('questions')
+        raise
+    except Exception as e:
+        print(f"Error calling Qwen API: {str(e)}")
+        # 返回默认问题作为错误处理（不记录 token，因为 API 调用失败）
+        return [dict(q) for q in ERROR_QUESTIONS]
+    finally:
+        reservation.release()
+
+
+def stream_questions(idea, questions_list=None, answers_list=None, feedback=None,
+                     custom_api_key=None, custom_base_url=None, custom_model=None, on_cancel=None):
+    """
+    流式生成问题，每解析出一个完整的问题对象就立即产出
+
+    流结束后仍未解析出任何问题时产出默认问题；调用失败时直接抛出异常，由调用方处理。
+    上游的流已经打开、调用方提前结束迭代（例如客户端断开）时调用 on_cancel(已生成的 token 数)；
+    命中缓存或相似想法时没有上游调用，不会调用
     """
     # 获取客户端
     client = get_client(custom_api_key, custom_base_url)
-    
+
     # 获取模型
-    model = custom_model or os.getenv("QWEN_MODEL", "qwen-max")
-    
+    model = custom_model or os.getenv("QWEN_MODEL", "qwen-flash")
+
     # 标记是否使用自定义 API 配置
     is_custom_api = bool(custom_api_key)
-    
+
+    # 构建提示词
+    prompt = _build_questions_prompt(idea, questions_list, answers_list, feedback)
+
+    # 首轮问题命中缓存时直接产出，不调用模型
+    cacheable = _is_cacheable(questions_list, feedback, is_custom_api)
+    if cacheable:
+        cached = question_cache.get(idea, model)
+        if cached is not None:
+            yield from cached
+            return
+
+    similar = _find_similar_questions(idea, questions_list, feedback, is_custom_api)
+    if similar is not None:
+        yield from similar
+        return
+
+    reservation = _reserve_tokens(prompt, QUESTIONS_MAX_TOKENS, is_custom_api)
+
+    def create(call_model, timeout):
+        def request(request_timeout, **response_format):
+            return client.chat.completions.create(
+                model=call_model,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt
+                    }
+                ],
+                temperature=0.7,
+                max_tokens=QUESTIONS_MAX_TOKENS,
+                stream=True,
+                stream_options={"include_usage": True},  # 最后一个块携带本次调用的 token 用量
+                timeout=request_timeout,
+                **response_format
+            )
+        return structured_request(request, client.base_url, call_model, timeout,
+                                  enabled=not is_custom_api)
+
+    try:
+        stream, used_model = questions_policy.open_stream(client.base_url, model, create, hedge=not is_custom_api)
+    except BaseException:
+        reservation.release()
+        raise
+
+    # JSON 模式下输出为 {"questions": [...]}，解析器同样从第一个数组开始解析
+    parser = JSONArrayStreamParser()
+    questions = []
+    seen_ids = set()
+    dropped = fixed = 0
+    usage = None
+    try:
+        for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage
+            if chunk.choices:
+                content = chunk.choices[0].delta.content
+                if content and not parser.done:
+                    for item in parser.feed(content):
+                        # 逐个校验，无法使用的问题跳过
+                        question, changed = normalize_question(item, seen_ids)
+                        if question is None:
+                            dropped += 1
+                            continue
+                        fixed += changed
+                        questions.append(question)
+                        yield question
+    except GeneratorExit:
+        if on_cancel is not None:
+            on_cancel(count_tokens(json.dumps(questions, ensure_ascii=False)))
+        raise
+    finally:
+        # 调用方提前结束迭代时关闭连接，上游随之停止生成
+        stream.close()
+        # 没有读到用量（出错或提前结束）时相当于释放预留
+        reservation.settle(usage.total_tokens if usage else 0)
+        disconnects.observe('questions', usage)
+
+    # 记录 token 使用量（仅当使用服务端默认 API 配置时）
+    if not is_custom_api and usage:
+        _record_usage(usage.total_tokens, used_model)
+
+    if not questions:
+        parse_stats.record('failed', dropped=dropped)
+        for question in FALLBACK_QUESTIONS:
+            yield dict(question)
+        return
+
+    parse_stats.record('salvaged' if dropped or fixed else 'clean', dropped, fixed)
+    if cacheable and used_model == model:
+        question_cache.set(idea, model, questions)
+
+
+# 生成报告失败时返回（并作为该轮报告保存）的错误信息前缀
+REPORT_ERROR_PREFIX = "处理答案时发生错误："
+
+
+def latest_report(reports):
+    """最近一轮成功生成的报告（跳过失败时保存的错误信息），没有时返回 None"""
+    for report in reversed(reports):
+        if report and not report.startswith(REPORT_ERROR_PREFIX):
+            return report
+    return None
+
+
+def _build_report_prompt(idea, questions, answers, previous_report=None):
+    """
+    构建生成阶段性报告的提示词
+
+    questions 和 answers 只包含本轮的问答；之前的轮次通过 previous_report（上一轮报告）带入，
+    压缩到 REPORT_CONTEXT_BUDGET 的预算内
+    """
     # 创建问题和答案的映射
     qa_pairs = []
     for i, answer in enumerate(answers):
@@ -204,6 +682,21 @@ def process_answers_to_doc(idea, questions, answers, custom_api_key=None, custom
                 'question_type': questions[i].get('type', 'narrative')
             })
 
+    template_tokens = count_tokens(_render_report_prompt(idea, '', []))
+    summary, qa_pairs, stats = fit_report_context(template_tokens, previous_report, qa_pairs)
+
+    # 记录每轮提示词的 token 数，观察是否随轮次增长
+    print(f"Report prompt tokens: {stats['prompt_tokens']} (template {stats['template_tokens']}, "
+          f"previous report {stats['summary_tokens']}, Q&A {stats['qa_tokens']}, budget {stats['budget']})")
+
+    return _render_report_prompt(idea, summary, qa_pairs)
+
+
+def _render_report_prompt(idea, summary, qa_pairs):
+    previous = f"""- 上一轮简报摘要（已综合之前各轮的问答，与本轮答案冲突时以本轮为准）：
+    {summary}
+    """ if summary else ''
+
     # 构建提示词让 AI 生成分析报告
     prompt = f"""
     # Role
@@ -211,7 +704,7 @@ def process_answers_to_doc(idea, questions, answers, custom_api_key=None, custom
     这份简报将传递给下游 AI（可能是 PPT 生成器、写作助手、代码引擎或设计工具），因此必须清晰、无歧义，且适配最终交付物的类型。
     # Input Data
     - 原始想法：{idea}
-    - 问答对：
+    {previous}- 问答对：
     {chr(10).join([f"问题：{pair['question']} | 答案：{pair['answer']}" for pair in qa_pairs])}
 
     # Goals
@@ -259,10 +752,29 @@ def process_answers_to_doc(idea, questions, answers, custom_api_key=None, custom
     # Initialization
     请基于输入数据，生成符合上述结构的《任务执行简报》。
     """
+    return prompt
 
-    try:
-        response = client.chat.completions.create(
-            model=model,
+
+def process_answers_to_doc(idea, questions, answers, custom_api_key=None, custom_base_url=None, custom_model=None,
+                           previous_report=None):
+    """
+    处理用户答案并生成阶段性报告
+    """
+    # 获取客户端
+    client = get_client(custom_api_key, custom_base_url)
+    
+    # 获取模型
+    model = custom_model or os.getenv("QWEN_MODEL", "qwen-max")
+    
+    # 标记是否使用自定义 API 配置
+    is_custom_api = bool(custom_api_key)
+    
+    prompt = _build_report_prompt(idea, questions, answers, previous_report)
+    reservation = _reserve_tokens(prompt, REPORT_MAX_TOKENS, is_custom_api)
+
+    def create(call_model, timeout):
+        return client.chat.completions.create(
+            model=call_model,
             messages=[
                 {
                     "role": "user",
@@ -270,20 +782,141 @@ def process_answers_to_doc(idea, questions, answers, custom_api_key=None, custom
                 }
             ],
             temperature=0.5,
-            max_tokens=4000  # 增加 token 限制，允许生成更详细的报告
+            max_tokens=REPORT_MAX_TOKENS,  # 增加 token 限制，允许生成更详细的报告
+            timeout=timeout
         )
+
+    try:
+        # 使用自定义 API 配置时不对冲（不替用户发出额外的请求）
+        response, used_model = report_policy.call(client.base_url, model, create, hedge=not is_custom_api,
+                                                  on_discard=_record_discarded)
+        reservation.settle(response.usage.total_tokens if response.usage else 0)
+        disconnects.observe('report', response.usage)
         
         report = response.choices[0].message.content.strip()
         
         # 记录 token 使用量（仅当使用服务端默认 API 配置时且响应有效）
         if not is_custom_api and hasattr(response, 'usage') and response.usage:
-            from app.models.session import SessionManager
-            total_tokens = response.usage.total_tokens
-            SessionManager.add_token_usage(total_tokens)
+            _record_usage(response.usage.total_tokens, used_model)
         
         return report
 
     except Exception as e:
         print(f"Error processing answers to doc: {str(e)}")
         # 不记录 token，因为 API 调用失败
-        return f"处理答案时发生错误：{str(e)}"
+        return f"{REPORT_ERROR_PREFIX}{str(e)}"
+    finally:
+        reservation.release()
+
+
+async def aprocess_answers_to_doc(idea, questions, answers, custom_api_key=None, custom_base_url=None,
+                                  custom_model=None, previous_report=None):
+    """
+    process_answers_to_doc 的异步版本
+    """
+    client = get_async_client(custom_api_key, custom_base_url)
+    model = custom_model or os.getenv("QWEN_MODEL", "qwen-max")
+    is_custom_api = bool(custom_api_key)
+    prompt = _build_report_prompt(idea, questions, answers, previous_report)
+    reservation = await _areserve_tokens(prompt, REPORT_MAX_TOKENS, is_custom_api)
+
+    def create(call_model, timeout):
+        return client.chat.completions.create(
+            model=call_model,
+            messages=[
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ],
+            temperature=0.5,
+            max_tokens=REPORT_MAX_TOKENS,
+            timeout=timeout
+        )
+
+    try:
+        response, used_model = await report_policy.acall(client.base_url, model, create, hedge=not is_custom_api,
+                                                         on_discard=_record_discarded)
+        reservation.settle(response.usage.total_tokens if response.usage else 0)
+        disconnects.observe('report', response.usage)
+
+        report = response.choices[0].message.content.strip()
+
+        # 记录 token 使用量（仅当使用服务端默认 API 配置时且响应有效）
+        if not is_custom_api and response.usage:
+            _record_usage(response.usage.total_tokens, used_model)
+
+        return report
+
+    except asyncio.CancelledError:
+        disconnects.record_cancelled('report')
+        raise
+    except Exception as e:
+        print(f"Error processing answers to doc: {str(e)}")
+        # 不记录 token，因为 API 调用失败
+        return f"{REPORT_ERROR_PREFIX}{str(e)}"
+    finally:
+        reservation.release()
+
+
+def stream_answers_to_doc(idea, questions, answers, custom_api_key=None, custom_base_url=None, custom_model=None,
+                          previous_report=None):
+    """
+    流式生成阶段性报告，按到达顺序逐段产出报告内容
+
+    token 使用量从流末尾的 usage 块中读取并记录；调用失败时直接抛出异常，由调用方处理
+    """
+    # 获取客户端
+    client = get_client(custom_api_key, custom_base_url)
+
+    # 获取模型
+    model = custom_model or os.getenv("QWEN_MODEL", "qwen-max")
+
+    # 标记是否使用自定义 API 配置
+    is_custom_api = bool(custom_api_key)
+
+    prompt = _build_report_prompt(idea, questions, answers, previous_report)
+
+    reservation = _reserve_tokens(prompt, REPORT_MAX_TOKENS, is_custom_api)
+
+    def create(call_model, timeout):
+        return client.chat.completions.create(
+            model=call_model,
+            messages=[
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ],
+            temperature=0.5,
+            max_tokens=REPORT_MAX_TOKENS,
+            stream=True,
+            stream_options={"include_usage": True},  # 最后一个块携带本次调用的 token 用量
+            timeout=timeout
+        )
+
+    try:
+        stream, used_model = report_policy.open_stream(client.base_url, model, create, hedge=not is_custom_api)
+    except BaseException:
+        reservation.release()
+        raise
+
+    usage = None
+    try:
+        for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage
+            if chunk.choices:
+                content = chunk.choices[0].delta.content
+                if content:
+                    yield content
+    finally:
+        # 调用方提前结束迭代时关闭连接，上游随之停止生成
+        stream.close()
+        # 没有读到用量（出错或提前结束）时相当于释放预留
+        reservation.settle(usage.total_tokens if usage else 0)
+        disconnects.observe('report', usage)
+
+    # 记录 token 使用量（仅当使用服务端默认 API 配置时）
+    if not is_custom_api and usage:
+        _record_usage(usage.total_tokens, used_model)
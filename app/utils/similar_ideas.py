@@ -0,0 +1,266 @@
+"""
+相似想法检索：复用历史会话中相似想法的首轮问题
+
+首轮问题缓存（question_cache.py）只在想法归一化后完全相同时命中，而很多想法只是换了一种说法。
+这里把历史会话的想法转换成字符 n-gram（2、3 字）的哈希向量（feature hashing，按哈希值的一位取正负号
+抵消冲突的偏差），L2 归一化后存放在一个 float32 矩阵中，查询时用一次矩阵乘法算出与所有想法的余弦相似度。
+一批想法的 n-gram 哈希在拼接后的码点数组上一次算出，不逐个 n-gram 调用 Python 函数。
+
+- 启动时在后台线程中从 sessions 表载入全部想法，create_session / create_sessions 时增量加入，
+  delete_session 时把对应的行清零（不再命中，重启后回收）
+- 相似度达到 SIMILAR_IDEA_THRESHOLD 的候选中，只复用用户实际回答过的首轮问题（第 1 轮对应的问题集），
+  跳过默认问题和模板问题
+- 占用内存约为 会话数 × SIMILAR_IDEA_DIM × 4 字节；多进程部署时每个进程各有一份，
+  其他进程新建的会话在重启后才能检索到
+"""
+import os
+import threading
+import time
+
+import numpy as np
+
+from app.utils.metrics import get_recorder
+from app.utils.question_cache import normalize_idea
+
+NGRAM_SIZES = (2, 3)
+_PRIME = np.uint64(1099511628211)
+
+# 查询耗时（毫秒），出现在 /api/metrics 的 latency 中
+_query_latency = get_recorder('similar_ideas.query')
+
+
+def _ngram_hashes(ideas):
+    """
+    返回 (行号, 哈希值)：一批想法的全部字符 n-gram 的 64 位哈希（多项式哈希 + murmur3 的混合步骤，
+    不同进程中结果相同）。想法之间用码点 0 分隔，跨越分隔符的 n-gram 丢弃
+    """
+    joined = '\0'.join(normalize_idea(idea).replace('\0', '') for idea in ideas) + '\0'
+    codes = np.frombuffer(joined.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    separators = codes == 0
+    # 每个位置所属的想法：之前出现过的分隔符个数
+    positions_row = np.concatenate(([0], np.cumsum(separators[:-1])))
+
+    rows, hashes = [], []
+    for n in NGRAM_SIZES:
+        count = len(codes) - n + 1
+        if count <= 0:
+            continue
+        value = np.full(count, n, dtype=np.uint64)
+        valid = np.ones(count, dtype=bool)
+        for offset in range(n):
+            window = codes[offset:offset + count]
+            value = value * _PRIME + window
+            valid &= window != 0
+        rows.append(positions_row[:count][valid])
+        hashes.append(value[valid])
+
+    value = np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint64)
+    value ^= value >> np.uint64(33)
+    value *= np.uint64(0xff51afd7ed558ccd)
+    value ^= value >> np.uint64(33)
+    return (np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)), value
+
+
+def vectorize(ideas, dim):
+    """把想法转换成 (len(ideas), dim) 的 L2 归一化矩阵（没有 n-gram 的想法为零向量）"""
+    rows, hashes = _ngram_hashes(ideas)
+    signs = np.where(hashes >> np.uint64(63), 1.0, -1.0)
+    buckets = rows.astype(np.int64) * dim + (hashes % np.uint64(dim)).astype(np.int64)
+    vectors = np.bincount(buckets, weights=signs, minlength=len(ideas) * dim)
+    vectors = vectors.reshape(len(ideas), dim).astype(np.float32)
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class IdeaIndex:
+    """会话 ID -> 想法向量的内存索引"""
+
+    def __init__(self, dim=256):
+        self.dim = dim
+        self._lock = threading.Lock()
+        # 容量按倍数增长，前 _size 行有效；被删除的行清零并把 ID 置为 None
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+        self._ids = []
+        self._rows = {}
+        self._size = 0
+        self.removed = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._rows)
+
+    def add_many(self, items):
+        """加入 [(会话 ID, 想法)]，已经在索引中的会话忽略"""
+        items = {session_id: idea for session_id, idea in items if session_id not in self._rows}
+        if not items:
+            return
+        # 向量化放在锁外
+        vectors = vectorize(list(items.values()), self.dim)
+
+        with self._lock:
+            # 向量化期间可能已经由其他线程加入
+            keep, session_ids = [], []
+            for i, session_id in enumerate(items):
+                if session_id not in self._rows:
+                    keep.append(i)
+                    session_ids.append(session_id)
+            needed = self._size + len(keep)
+            if needed > len(self._vectors):
+                grown = np.zeros((max(needed, len(self._vectors) * 2, 1024), self.dim), dtype=np.float32)
+                grown[:self._size] = self._vectors[:self._size]
+                self._vectors = grown
+            self._vectors[self._size:needed] = vectors[keep]
+            self._ids.extend(session_ids)
+            self._rows.update(zip(session_ids, range(self._size, needed)))
+            self._size = needed
+
+    def remove(self, session_id):
+        with self._lock:
+            row = self._rows.pop(session_id, None)
+            if row is None:
+                return
+            self._vectors[row] = 0
+            self._ids[row] = None
+            self.removed += 1
+
+    def query(self, idea, k):
+        """返回最相似的 k 个 [(会话 ID, 相似度)]，按相似度从高到低排列"""
+        vector = vectorize([idea], self.dim)[0]
+        with self._lock:
+            size = self._size
+            # 扩容时换成新数组，旧数组的视图仍然有效，矩阵乘法不需要持有锁
+            matrix = self._vectors[:size]
+            ids = self._ids
+        if not size:
+            return []
+
+        scores = matrix @ vector
+        k = min(k, size)
+        top = np.argpartition(scores, size - k)[size - k:]
+        top = top[np.argsort(scores[top])[::-1]]
+        results = []
+        for row in top:
+            session_id = ids[row]
+            if session_id is not None and scores[row] > 0:
+                results.append((session_id, float(scores[row])))
+        return results
+
+    def memory_bytes(self):
+        with self._lock:
+            return self._vectors.nbytes
+
+
+class SimilarIdeas:
+    """
+    按相似想法复用历史会话的首轮问题；threshold 为 0 时关闭（不建索引，不占内存）
+    """
+
+    def __init__(self, threshold=0.0, dim=256, candidates=5, load_batch=5000):
+        self.threshold = threshold
+        self.candidates = candidates
+        self.load_batch = load_batch
+        self.index = IdeaIndex(dim)
+        self._lock = threading.Lock()
+        self._loader = None
+        self.ready = False
+        self.build_seconds = None
+        self.lookups = 0
+        self.hits = 0
+        self._hit_score_total = 0.0
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    def load(self):
+        """在后台线程中载入历史会话的想法（应用启动时调用），载入完成前只能检索到已载入的部分"""
+        if not self.enabled or self._loader is not None:
+            return
+        self._loader = threading.Thread(target=self._load, name='similar-ideas-loader', daemon=True)
+        self._loader.start()
+
+    def _load(self):
+        from app.models.session import SessionManager
+
+        started = time.perf_counter()
+        try:
+            for batch in SessionManager.iter_session_ideas(self.load_batch):
+                self.index.add_many(batch)
+        except Exception as e:
+            print(f"Error loading similar idea index: {str(e)}")
+            return
+        self.build_seconds = round(time.perf_counter() - started, 3)
+        self.ready = True
+
+    def add(self, items):
+        """新建会话时加入索引，items 为 [(会话 ID, 想法)]"""
+        if not self.enabled:
+            return
+        try:
+            self.index.add_many(items)
+        except Exception as e:
+            # 索引不可用时只影响复用，不影响创建会话
+            print(f"Error updating similar idea index: {str(e)}")
+
+    def remove(self, session_id):
+        if self.enabled:
+            self.index.remove(session_id)
+
+    def find_questions(self, idea, accept=None):
+        """
+        返回相似度达到阈值的历史会话中用户回答过的首轮问题，没有时返回 None
+
+        accept 为可选的判断函数，返回 False 的问题集跳过（例如默认问题）
+        """
+        from app.models.session import SessionManager
+
+        if not self.enabled:
+            return None
+
+        started = time.perf_counter()
+        candidates = [(session_id, score) for session_id, score in self.index.query(idea, self.candidates)
+                      if score >= self.threshold]
+        _query_latency.record((time.perf_counter() - started) * 1000)
+
+        questions, score = None, None
+        if candidates:
+            answered = SessionManager.get_answered_first_questions([session_id for session_id, _ in candidates])
+            for session_id, score in candidates:
+                found = answered.get(session_id)
+                if found and (accept is None or accept(found)):
+                    questions = found
+                    break
+
+        with self._lock:
+            self.lookups += 1
+            if questions is not None:
+                self.hits += 1
+                self._hit_score_total += score
+        return questions
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'threshold': self.threshold,
+                'dim': self.index.dim,
+                'ready': self.ready,
+                'build_seconds': self.build_seconds,
+                'entries': len(self.index),
+                'removed': self.index.removed,
+                'memory_bytes': self.index.memory_bytes(),
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'hit_rate': round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+                'misses': self.lookups - self.hits,
+                'avg_hit_score': round(self._hit_score_total / self.hits, 4) if self.hits else None
+            }
+
+
+similar_ideas = SimilarIdeas(
+    threshold=float(os.getenv('SIMILAR_IDEA_THRESHOLD', '0')),
+    dim=int(os.getenv('SIMILAR_IDEA_DIM', '256')),
+    candidates=int(os.getenv('SIMILAR_IDEA_CANDIDATES', '5'))
+)
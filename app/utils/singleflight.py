@@ -0,0 +1,170 @@
+import asyncio
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+
+
+def request_key(session_id, endpoint, payload):
+    """由会话 ID、接口名和请求数据的哈希组成的合并键（请求数据中的密钥只以哈希形式出现）"""
+    digest = hashlib.sha256(
+        json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    ).hexdigest()
+    return f"{session_id}:{endpoint}:{digest}"
+
+
+class CallCancelled(Exception):
+    """合并的调用因为所有等待方都已离开（客户端断开）而被取消"""
+
+
+class LocalBackend:
+    """
+    进程内后端：登记进行中的调用，同一个键的后续请求拿到同一个 Future
+
+    Future 既可以在线程中阻塞等待，也可以在事件循环中 await，同步和异步路径可以互相合并。
+    跨进程的后端需要实现相同的 begin / finish 接口，结果需要可以 JSON 序列化
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def begin(self, key):
+        """返回 (future, leader)，leader 为 True 表示调用方负责执行并通过 finish 发布结果"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = Future()
+            self._calls[key] = future
+            return future, True
+
+    def finish(self, key, future, result=None, error=None):
+        """发布结果并移除登记，之后到达的相同请求会重新执行"""
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class SingleFlight:
+    """
+    合并并发的相同请求：同一个键同时只执行一次，其余请求等待并共享同一个结果（或异常）
+
+    只合并进行中的调用，调用结束后到达的请求会重新执行。异步调用在独立的任务中执行，
+    等待方被取消（客户端断开）时只是不再等待，本进程中所有等待方都离开后调用才被取消
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or LocalBackend()
+        self._lock = threading.Lock()
+        # Future -> 本进程中等待该调用的请求数（包括执行方）
+        self._waiters = {}
+        # Future -> (事件循环, 执行调用的任务)
+        self._tasks = {}
+        self.leaders = 0
+        self.shared = 0
+        self.cancelled = 0
+
+    def _count(self, leader):
+        with self._lock:
+            if leader:
+                self.leaders += 1
+            else:
+                self.shared += 1
+
+    def do(self, key, fn):
+        """在当前线程中执行 fn()，或等待正在执行的相同调用"""
+        future, leader = self.backend.begin(key)
+        self._count(leader)
+        if not leader:
+            # 同步的等待方无法取消，计入等待方，避免异步的执行方断开时调用被取消
+            with self._lock:
+                self._waiters[future] = self._waiters.get(future, 0) + 1
+            try:
+                return future.result()
+            finally:
+                self._leave(future, False)
+
+        try:
+            result = fn()
+        except BaseException as e:
+            self.backend.finish(key, future, error=e)
+            raise
+        self.backend.finish(key, future, result=result)
+        return result
+
+    async def ado(self, key, coro_fn):
+        """do 的异步版本，coro_fn() 返回协程"""
+        future, leader = self.backend.begin(key)
+        self._count(leader)
+        with self._lock:
+            self._waiters[future] = self._waiters.get(future, 0) + 1
+        if leader:
+            task = asyncio.ensure_future(self._run(key, future, coro_fn))
+            with self._lock:
+                self._tasks[future] = (asyncio.get_running_loop(), task)
+
+        cancelled = False
+        waiting = asyncio.wrap_future(future)
+        try:
+            # shield：等待方被取消时不能连带取消 Future，否则执行方发布结果会失败
+            return await asyncio.shield(waiting)
+        except asyncio.CancelledError:
+            cancelled = True
+            # 不再有人读取结果，取出异常避免「exception was never retrieved」警告
+            waiting.add_done_callback(lambda f: f.cancelled() or f.exception())
+            raise
+        finally:
+            self._leave(future, cancelled)
+
+    async def _run(self, key, future, coro_fn):
+        try:
+            result = await coro_fn()
+        except asyncio.CancelledError:
+            self._finish(key, future, error=CallCancelled('请求已取消'))
+        except BaseException as e:
+            # 异常由等待方重新抛出
+            self._finish(key, future, error=e)
+        else:
+            self._finish(key, future, result=result)
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            self._tasks.pop(future, None)
+        self.backend.finish(key, future, result=result, error=error)
+
+    def _leave(self, future, cancelled):
+        """等待方离开；最后一个等待方是被取消时，取消还在进行的调用"""
+        with self._lock:
+            remaining = self._waiters.pop(future) - 1
+            if remaining:
+                self._waiters[future] = remaining
+            call = self._tasks.get(future) if cancelled and not remaining else None
+            if call is not None:
+                self.cancelled += 1
+        if call is not None:
+            loop, task = call
+            loop.call_soon_threadsafe(task.cancel)
+
+    def stats(self):
+        with self._lock:
+            total = self.leaders + self.shared
+            return {
+                'executed': self.leaders,
+                'shared': self.shared,
+                'shared_rate': round(self.shared / total, 4) if total else 0.0,
+                'cancelled': self.cancelled,
+                'in_flight': self.backend.in_flight()
+            }
+
+
+# 提交答案、继续细化需求等接口共用的合并组
+llm_requests = SingleFlight()
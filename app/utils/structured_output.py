@@ -0,0 +1,356 @@
+"""
+问题列表的结构化输出：JSON 模式请求、本地 JSON 修复和字段校验
+
+- 使用服务端 API 配置时请求 response_format（QUESTIONS_RESPONSE_FORMAT：json_object / json_schema / none），
+  服务端因该参数拒绝时在剩余时间内去掉后重试一次，并记住该 (base_url, 模型) 不再发送
+- 模型输出先按原样解析，失败时在本地修复：去掉 markdown 代码块、多余的逗号，
+  补全被截断的最后一个元素（丢弃不完整的部分后闭合括号）
+- 每个问题校验 id / text / type / options：缺少 text 的丢弃，类型别名归一，
+  选择题没有选项时改为叙述题，id 缺失或重复时重新编号
+
+多数格式问题可以在本地挽救，不需要重新调用模型；各类结果计入统计
+"""
+import json
+import os
+import re
+import threading
+import time
+
+import openai
+
+QUESTION_TYPES = ('choice', 'fill_blank', 'narrative')
+
+_TYPE_ALIASES = {
+    'single_choice': 'choice',
+    'multiple_choice': 'choice',
+    'multi_choice': 'choice',
+    'select': 'choice',
+    'radio': 'choice',
+    'checkbox': 'choice',
+    '选择题': 'choice',
+    'fill': 'fill_blank',
+    'fill-blank': 'fill_blank',
+    'fillblank': 'fill_blank',
+    'blank': 'fill_blank',
+    'short_answer': 'fill_blank',
+    '填空题': 'fill_blank',
+    'text': 'narrative',
+    'open': 'narrative',
+    'open_ended': 'narrative',
+    'essay': 'narrative',
+    '叙述题': 'narrative',
+}
+
+QUESTIONS_JSON_SCHEMA = {
+    'name': 'questions',
+    'schema': {
+        'type': 'object',
+        'properties': {
+            'questions': {
+                'type': 'array',
+                'items': {
+                    'type': 'object',
+                    'properties': {
+                        'id': {'type': 'string'},
+                        'text': {'type': 'string'},
+                        'type': {'type': 'string', 'enum': list(QUESTION_TYPES)},
+                        'options': {'type': 'array', 'items': {'type': 'string'}}
+                    },
+                    'required': ['id', 'text', 'type']
+                }
+            }
+        },
+        'required': ['questions']
+    }
+}
+
+_FENCE_RE = re.compile(r'```[a-zA-Z]*')
+# 最多尝试的 JSON 起始位置数
+_MAX_STARTS = 8
+
+# 不支持 response_format 的 (base_url, 模型)
+_unsupported = set()
+_unsupported_lock = threading.Lock()
+
+
+def response_format(base_url, model):
+    """返回请求的 response_format 参数（dict，可能为空）"""
+    mode = os.getenv('QUESTIONS_RESPONSE_FORMAT', 'json_object')
+    if mode not in ('json_object', 'json_schema'):
+        return {}
+    with _unsupported_lock:
+        if (str(base_url), model) in _unsupported:
+            return {}
+    if mode == 'json_schema':
+        return {'response_format': {'type': 'json_schema', 'json_schema': QUESTIONS_JSON_SCHEMA}}
+    return {'response_format': {'type': 'json_object'}}
+
+
+def _mark_unsupported(base_url, model):
+    with _unsupported_lock:
+        _unsupported.add((str(base_url), model))
+
+
+def _rejects_response_format(error):
+    """400 错误是否因为 response_format 参数（其他原因的 400 重试也不会成功）"""
+    detail = ' '.join(str(part) for part in (error.param, error.message, error.body) if part).lower()
+    return any(keyword in detail for keyword in ('response_format', 'json_object', 'json_schema', 'json mode'))
+
+
+def _remaining(timeout, started):
+    return None if timeout is None else timeout - (time.monotonic() - started)
+
+
+def structured_request(request, base_url, model, timeout, enabled=True):
+    """
+    调用 request(timeout, **kwargs) 发出请求，enabled 时带上 response_format
+
+    带参数的请求因 response_format 被拒绝（400）时，在 timeout 的剩余时间内不带参数重试一次，
+    成功后记住该服务端不支持，之后不再发送；其他 400 错误直接抛出
+    """
+    kwargs = response_format(base_url, model) if enabled else {}
+    if not kwargs:
+        return request(timeout)
+    started = time.monotonic()
+    try:
+        return request(timeout, **kwargs)
+    except openai.BadRequestError as e:
+        remaining = _remaining(timeout, started)
+        if not _rejects_response_format(e) or (remaining is not None and remaining <= 0):
+            raise
+        response = request(remaining)
+        print(f"response_format not supported by {model}, disabled: {str(e)}")
+        _mark_unsupported(base_url, model)
+        return response
+
+
+async def astructured_request(request, base_url, model, timeout, enabled=True):
+    """structured_request 的异步版本，request(timeout, **kwargs) 返回协程"""
+    kwargs = response_format(base_url, model) if enabled else {}
+    if not kwargs:
+        return await request(timeout)
+    started = time.monotonic()
+    try:
+        return await request(timeout, **kwargs)
+    except openai.BadRequestError as e:
+        remaining = _remaining(timeout, started)
+        if not _rejects_response_format(e) or (remaining is not None and remaining <= 0):
+            raise
+        response = await request(remaining)
+        print(f"response_format not supported by {model}, disabled: {str(e)}")
+        _mark_unsupported(base_url, model)
+        return response
+
+
+def repair_json(text):
+    """
+    从模型输出中取出第一个 JSON 值并尽量修复，返回 (值, 是否经过修复)，无法解析时返回 (None, True)
+
+    处理 markdown 代码块、对象和数组末尾多余的逗号，以及输出被截断（丢弃最后一个不完整的元素，
+    再闭合所有未闭合的括号）
+    """
+    text = _FENCE_RE.sub('', text)
+    # 说明文字中可能出现「[注意]」之类的括号，依次尝试之后的位置
+    starts = [match.start() for match in re.finditer(r'[\[{]', text)][:_MAX_STARTS]
+    for start in starts:
+        value, repaired = _repair_from(text, start)
+        if value is not None:
+            return value, repaired
+    return None, True
+
+
+def _repair_from(text, start):
+    out = []
+    stack = []
+    # 最近一个完整值结束的位置：(输出长度, 当时的括号栈)
+    savepoint = None
+    in_string = escape = False
+    end = None
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            out.append(ch)
+            if escape:
+                escape = False
+            elif ch == '\\':
+                escape = True
+            elif ch == '"':
+                in_string = False
+            continue
+
+        if ch == '"':
+            in_string = True
+        elif ch in '[{':
+            stack.append(ch)
+        elif ch in ']}':
+            # 去掉闭合括号前多余的逗号
+            while out and (out[-1].isspace() or out[-1] == ','):
+                out.pop()
+            if not stack:
+                break
+            # 按开括号闭合，顺带纠正不匹配的括号
+            out.append('}' if stack.pop() == '{' else ']')
+            if not stack:
+                end = i
+                break
+            savepoint = (len(out), list(stack))
+            continue
+        elif ch == ',':
+            savepoint = (len(out), list(stack))
+        out.append(ch)
+
+    raw = text[start:end + 1] if end is not None else None
+    if raw is not None:
+        try:
+            return json.loads(raw), False
+        except ValueError:
+            pass
+
+    if end is None:
+        # 输出被截断：回到最近一个完整值之后，闭合剩余的括号
+        if savepoint is None:
+            return None, True
+        length, stack = savepoint
+        out = out[:length]
+        while out and (out[-1].isspace() or out[-1] == ','):
+            out.pop()
+        out.extend('}' if opener == '{' else ']' for opener in reversed(stack))
+
+    try:
+        return json.loads(''.join(out)), True
+    except ValueError:
+        return None, True
+
+
+def extract_question_items(value):
+    """从解析结果中取出问题数组：数组本身，或 JSON 模式下对象中的 questions 字段"""
+    if isinstance(value, list):
+        return value
+    if isinstance(value, dict):
+        items = value.get('questions')
+        if isinstance(items, list):
+            return items
+        # 字段名不同时取第一个对象数组
+        for item in value.values():
+            if isinstance(item, list) and any(isinstance(element, dict) for element in item):
+                return item
+    return None
+
+
+def normalize_question(item, seen_ids):
+    """
+    校验并规范化单个问题，返回 (问题, 是否做过修改)，无法使用时返回 (None, True)
+
+    seen_ids 为已使用的 id 集合，用于发现重复的 id
+    """
+    if not isinstance(item, dict):
+        return None, True
+    text = item.get('text') or item.get('question')
+    if not isinstance(text, str) or not text.strip():
+        return None, True
+
+    fixed = 'text' not in item
+    question_type = item.get('type')
+    type_key = str(question_type).strip().lower()
+    normalized_type = _TYPE_ALIASES.get(type_key, type_key)
+
+    options = item.get('options')
+    if options is not None:
+        if isinstance(options, list):
+            cleaned = [str(option).strip() for option in options
+                       if isinstance(option, (str, int, float)) and str(option).strip()]
+        else:
+            cleaned = []
+        fixed = fixed or cleaned != options
+        options = cleaned
+
+    if normalized_type not in QUESTION_TYPES:
+        normalized_type = 'choice' if options else 'narrative'
+    if normalized_type == 'choice' and not options:
+        normalized_type = 'narrative'
+    fixed = fixed or normalized_type != question_type
+
+    question_id = item.get('id')
+    if isinstance(question_id, (int, float)) and not isinstance(question_id, bool):
+        question_id = str(question_id)
+    if not isinstance(question_id, str) or not question_id.strip() or question_id in seen_ids:
+        base = f"q{len(seen_ids) + 1}"
+        question_id = base
+        suffix = 1
+        while question_id in seen_ids:
+            suffix += 1
+            question_id = f"{base}-{suffix}"
+        fixed = True
+    elif question_id != item.get('id'):
+        fixed = True
+    seen_ids.add(question_id)
+
+    question = {'id': question_id, 'text': text.strip(), 'type': normalized_type}
+    if normalized_type == 'choice':
+        question['options'] = options
+    elif 'options' in item:
+        fixed = True
+    return question, fixed or question['text'] != text
+
+
+class ParseStats:
+    """问题解析结果的统计：clean（原样可用）/ salvaged（本地修复后可用）/ failed（使用默认问题）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clean = 0
+        self.salvaged = 0
+        self.failed = 0
+        self.dropped_items = 0
+        self.fixed_items = 0
+
+    def record(self, outcome, dropped=0, fixed=0):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            self.dropped_items += dropped
+            self.fixed_items += fixed
+
+    def stats(self):
+        with self._lock:
+            total = self.clean + self.salvaged + self.failed
+            return {
+                'responses': total,
+                'clean': self.clean,
+                'salvaged': self.salvaged,
+                'failed': self.failed,
+                'dropped_items': self.dropped_items,
+                'fixed_items': self.fixed_items,
+                'salvage_rate': round(self.salvaged / total, 4) if total else 0.0,
+                'failure_rate': round(self.failed / total, 4) if total else 0.0,
+                'response_format': os.getenv('QUESTIONS_RESPONSE_FORMAT', 'json_object'),
+                'response_format_unsupported': len(_unsupported)
+            }
+
+
+parse_stats = ParseStats()
+
+
+def parse_questions(content):
+    """解析模型返回的问题列表，返回校验后的问题列表，无法得到任何有效问题时返回 None"""
+    value, repaired = repair_json(content or '')
+    items = extract_question_items(value)
+    if not items:
+        parse_stats.record('failed')
+        return None
+
+    questions = []
+    seen_ids = set()
+    dropped = fixed = 0
+    for item in items:
+        question, changed = normalize_question(item, seen_ids)
+        if question is None:
+            dropped += 1
+            continue
+        fixed += changed
+        questions.append(question)
+
+    if not questions:
+        parse_stats.record('failed', dropped=dropped)
+        return None
+    parse_stats.record('salvaged' if repaired or dropped or fixed else 'clean', dropped, fixed)
+    return questions
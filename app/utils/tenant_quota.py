@@ -0,0 +1,260 @@
+"""
+按租户（客户端）的滑动窗口配额
+
+每个租户在最近 TENANT_QUOTA_WINDOW 秒内的请求数和 token 用量分别不能超过
+TENANT_REQUEST_LIMIT 和 TENANT_TOKEN_LIMIT（0 为不限制），超出时返回 429 和 Retry-After。
+滑动窗口用两个固定窗口近似：估算值 = 上一窗口计数 × 上一窗口仍在滑动窗口内的比例 + 当前窗口计数，
+每个租户只保存 5 个整数，检查为 O(1)。租户数超过 TENANT_QUOTA_MAX_ENTRIES 时淘汰最久未访问的租户；
+计数每隔 TENANT_QUOTA_FLUSH_INTERVAL 秒写入 tenant_quota 表，启动时载入，重启后配额不会清零
+"""
+import atexit
+import contextvars
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# 当前请求的租户，由 Flask 的 before_request 和 ASGI 入口设置
+_tenant = contextvars.ContextVar('tenant', default=None)
+
+# 条目下标：[窗口编号, 上一窗口 token, 当前窗口 token, 上一窗口请求数, 当前窗口请求数]
+_WINDOW, _PREV_TOKENS, _CUR_TOKENS, _PREV_REQUESTS, _CUR_REQUESTS = range(5)
+
+
+def resolve_tenant(client_id=None, forwarded_for=None, remote_addr=None):
+    """
+    确定请求所属的租户
+
+    设置了 TENANT_HEADER 时优先使用该请求头（应由前置的网关或认证层写入，客户端可以伪造）；
+    TRUST_PROXY_HEADERS=1 时使用 X-Forwarded-For 的第一个地址，否则使用连接的对端地址
+    """
+    if client_id:
+        return 'client:' + client_id.strip()[:128]
+    if forwarded_for and os.getenv('TRUST_PROXY_HEADERS', '0') == '1':
+        return 'ip:' + forwarded_for.split(',')[0].strip()
+    return 'ip:' + (remote_addr or 'unknown')
+
+
+def set_tenant(tenant):
+    _tenant.set(tenant)
+
+
+def current_tenant():
+    return _tenant.get()
+
+
+class QuotaExceeded(Exception):
+    """租户在滑动窗口内的请求数或 token 用量超出配额"""
+
+    def __init__(self, kind, limit, retry_after):
+        super().__init__('请求过于频繁，已超出当前客户端的使用配额，请稍后再试')
+        self.kind = kind
+        self.limit = limit
+        self.retry_after = retry_after
+
+    def to_dict(self):
+        return {
+            'error': 'tenant_quota_exceeded',
+            'message': str(self),
+            'quota': self.kind,
+            'limit': self.limit,
+            'retry_after': self.retry_after
+        }
+
+
+class TenantQuotas:
+    """进程内的租户配额计数（多进程部署时每个进程分别计数）"""
+
+    def __init__(self, token_limit=0, request_limit=0, window=3600.0, max_entries=50000, flush_interval=30.0):
+        self.token_limit = token_limit
+        self.request_limit = request_limit
+        self.window = window
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # 上次写入后有变化的租户；被淘汰的租户保存最后的计数，下次写入时落盘
+        self._dirty = set()
+        self._evicted = {}
+        self._thread = None
+        self._stop = threading.Event()
+        self.evictions = 0
+        self.rejected_requests = 0
+        self.rejected_tokens = 0
+        self.flushes = 0
+
+    @property
+    def enabled(self):
+        return bool(self.token_limit or self.request_limit)
+
+    def _entry(self, tenant, now):
+        """取出租户的计数并滚动到当前窗口（调用方持有锁）"""
+        index = int(now // self.window)
+        entry = self._entries.get(tenant)
+        if entry is None:
+            # 淘汰后尚未写入数据库的租户再次出现时恢复原来的计数
+            entry = self._evicted.pop(tenant, None)
+            if entry is None:
+                entry = [index, 0, 0, 0, 0]
+            else:
+                self._dirty.add(tenant)
+            self._entries[tenant] = entry
+            while len(self._entries) > self.max_entries:
+                evicted, counts = self._entries.popitem(last=False)
+                if evicted in self._dirty:
+                    self._dirty.discard(evicted)
+                    self._evicted[evicted] = counts
+                    # 两次写入之间淘汰的租户也有上限，超出时丢弃最早淘汰的计数
+                    if len(self._evicted) > self.max_entries:
+                        del self._evicted[next(iter(self._evicted))]
+                self.evictions += 1
+        else:
+            self._entries.move_to_end(tenant)
+
+        if entry[_WINDOW] != index:
+            if entry[_WINDOW] == index - 1:
+                entry[_PREV_TOKENS], entry[_PREV_REQUESTS] = entry[_CUR_TOKENS], entry[_CUR_REQUESTS]
+            else:
+                entry[_PREV_TOKENS] = entry[_PREV_REQUESTS] = 0
+            entry[_CUR_TOKENS] = entry[_CUR_REQUESTS] = 0
+            entry[_WINDOW] = index
+        return entry
+
+    def _retry_after(self, previous, current, limit, now):
+        """估算值降到 limit 以下需要等待的秒数"""
+        window_start = (now // self.window) * self.window
+        elapsed = now - window_start
+        if current >= limit:
+            # 当前窗口本身已满：等到下一个窗口，再等上一窗口（即现在的当前窗口）滑出足够的比例
+            wait = self.window - elapsed + self.window * (1 - limit / current)
+        else:
+            wait = self.window * (1 - (limit - current) / previous) - elapsed
+        return max(1, math.ceil(wait))
+
+    def admit(self, tenant, count_tokens=True):
+        """
+        准入检查并计入一次请求，超出配额时抛出 QuotaExceeded
+
+        count_tokens 为 False 时（使用自定义 API 配置）只检查请求数
+        """
+        if not self.enabled or tenant is None:
+            return
+
+        now = time.time()
+        with self._lock:
+            entry = self._entry(tenant, now)
+            weight = 1 - (now % self.window) / self.window
+
+            if count_tokens and self.token_limit:
+                tokens = entry[_PREV_TOKENS] * weight + entry[_CUR_TOKENS]
+                if tokens >= self.token_limit:
+                    self.rejected_tokens += 1
+                    raise QuotaExceeded('tokens', self.token_limit, self._retry_after(
+                        entry[_PREV_TOKENS], entry[_CUR_TOKENS], self.token_limit, now))
+
+            if self.request_limit:
+                requests = entry[_PREV_REQUESTS] * weight + entry[_CUR_REQUESTS]
+                if requests >= self.request_limit:
+                    self.rejected_requests += 1
+                    raise QuotaExceeded('requests', self.request_limit, self._retry_after(
+                        entry[_PREV_REQUESTS], entry[_CUR_REQUESTS], self.request_limit, now))
+
+            entry[_CUR_REQUESTS] += 1
+            self._dirty.add(tenant)
+
+        self._start()
+
+    def charge(self, tenant, tokens):
+        """计入模型调用的实际 token 用量"""
+        if not self.token_limit or tenant is None or not tokens:
+            return
+
+        with self._lock:
+            entry = self._entry(tenant, time.time())
+            entry[_CUR_TOKENS] += tokens
+            self._dirty.add(tenant)
+
+    def _start(self):
+        if self._thread is not None or self.flush_interval <= 0:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='tenant-quota-flush', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def load(self):
+        """从数据库载入仍在滑动窗口内的计数（应用启动时调用）"""
+        from app.models.session import SessionManager
+
+        if not self.enabled:
+            return 0
+        min_window = int(time.time() // self.window) - 1
+        rows = SessionManager.load_tenant_quotas(min_window, self.max_entries)
+        with self._lock:
+            # 按最近更新时间从旧到新插入，保持 LRU 顺序
+            for tenant, *counts in reversed(rows):
+                if tenant not in self._entries:
+                    self._entries[tenant] = list(counts)
+        return len(rows)
+
+    def flush(self):
+        """把有变化的计数写入数据库，返回写入的租户数"""
+        from app.models.session import SessionManager
+
+        with self._lock:
+            rows = [(tenant, *self._entries[tenant]) for tenant in self._dirty]
+            rows.extend((tenant, *counts) for tenant, counts in self._evicted.items())
+            dirty, evicted = self._dirty, self._evicted
+            self._dirty, self._evicted = set(), {}
+        if not rows:
+            return 0
+
+        try:
+            SessionManager.save_tenant_quotas(rows, int(time.time() // self.window) - 1)
+        except Exception as e:
+            print(f"Error saving tenant quotas: {str(e)}")
+            with self._lock:
+                self._dirty |= {tenant for tenant in dirty if tenant in self._entries}
+                for tenant, counts in evicted.items():
+                    self._evicted.setdefault(tenant, counts)
+            return 0
+
+        with self._lock:
+            self.flushes += 1
+        return len(rows)
+
+    def close(self):
+        """停止后台线程并写入剩余的计数（进程退出时调用）"""
+        self._stop.set()
+        if self.enabled:
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'token_limit': self.token_limit,
+                'request_limit': self.request_limit,
+                'window': self.window,
+                'tenants': len(self._entries),
+                'max_entries': self.max_entries,
+                'evictions': self.evictions,
+                'rejected_requests': self.rejected_requests,
+                'rejected_tokens': self.rejected_tokens,
+                'flushes': self.flushes
+            }
+
+
+tenant_quotas = TenantQuotas(
+    token_limit=int(os.getenv('TENANT_TOKEN_LIMIT', '0')),
+    request_limit=int(os.getenv('TENANT_REQUEST_LIMIT', '0')),
+    window=float(os.getenv('TENANT_QUOTA_WINDOW', '3600')),
+    max_entries=int(os.getenv('TENANT_QUOTA_MAX_ENTRIES', '50000')),
+    flush_interval=float(os.getenv('TENANT_QUOTA_FLUSH_INTERVAL', '30'))
+)
+atexit.register(tenant_quotas.close)
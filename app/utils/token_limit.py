@@ -1,44 +1,233 @@
 from functools import wraps
+from datetime import datetime, timedelta
 from flask import jsonify, request
+import math
 import os
+import threading
+import time
+from app.utils.tenant_quota import QuotaExceeded, current_tenant, tenant_quotas
+
+
+class TokenLimitExceeded(Exception):
+    """预留 token 时超出单日限额"""
+
+    def __init__(self, token_limit, today_usage, requested=0):
+        super().__init__('服务端已达单日 token 限额，请明日再试或切换/搭建个人服务端')
+        self.token_limit = token_limit
+        self.today_usage = today_usage
+        self.requested = requested
+
+    def to_dict(self):
+        # 单日限额在次日零点重置
+        now = datetime.now()
+        tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        return {
+            'error': 'token_limit_reached',
+            'message': str(self),
+            'token_limit': self.token_limit,
+            'today_usage': self.today_usage,
+            'retry_after': max(1, math.ceil((tomorrow - now).total_seconds()))
+        }
+
+
+class Reservation:
+    """一次模型调用预留的 token，调用结束后 settle（按实际用量结算）或 release（释放）"""
+
+    def __init__(self, budget, tokens):
+        self._budget = budget
+        self.tokens = tokens
+        self.done = False
+
+    def settle(self, actual_tokens):
+        """按实际用量结算：释放预留，把实际用量计入当日已用"""
+        self._budget._finish(self, actual_tokens)
+
+    def release(self):
+        """调用失败或没有返回用量时释放预留（已结算时不做任何事）"""
+        self._budget._finish(self, 0)
+
+
+class _NoReservation:
+    """使用自定义 API 配置时不占用服务端限额"""
+    tokens = 0
+
+    def settle(self, actual_tokens):
+        pass
+
+    def release(self):
+        pass
+
+
+class TokenBudget:
+    """
+    单日 token 限额的进程内准入控制
+
+    每次调用前按「提示词 + max_tokens」预留，已用量加上所有进行中的预留超过限额时拒绝，
+    并发请求不会一起越过限额。已用量在内存中累加，每隔 TOKEN_BUDGET_SYNC_INTERVAL 秒
+    从 token_usage 表同步一次（取较大值），以计入其他进程的用量；检查本身不查询数据库
+    """
+
+    def __init__(self, sync_interval=30.0):
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._date = None
+        self._committed = 0
+        self._reserved = 0
+        self._active = 0
+        self._synced_at = None  # None 表示需要立即同步
+        self.rejected = 0
+
+    @staticmethod
+    def limit():
+        # 限额为 0 表示无限制；每次读取环境变量，修改后无需重启
+        return int(os.getenv('DAILY_TOKEN_LIMIT', '0'))
+
+    def _roll_day(self):
+        """跨天时重置（调用方持有锁）"""
+        today = datetime.now().strftime('%Y-%m-%d')
+        if today != self._date:
+            self._date = today
+            self._committed = 0
+            self._synced_at = None
+
+    def _sync(self):
+        """
+        到达同步间隔时从数据库同步已用量
+
+        查询在锁外执行：settle / release 在异步路径中运行于事件循环，不能等待数据库
+        """
+        with self._lock:
+            self._roll_day()
+            now = time.monotonic()
+            if self._synced_at is not None and now - self._synced_at < self.sync_interval:
+                return
+            self._synced_at = now
+            date = self._date
+
+        from app.utils.token_usage import token_usage
+        try:
+            # 本进程的用量批量写入数据库，同步时加上尚未写入的部分
+            usage = token_usage.database_usage()
+        except Exception as e:
+            print(f"Error syncing token usage: {str(e)}")
+            return
+        with self._lock:
+            if self._date == date:
+                self._committed = max(self._committed, usage)
+
+    def usage(self):
+        """返回 (今日已用, 进行中的预留)"""
+        self._sync()
+        with self._lock:
+            return self._committed, self._reserved
+
+    def check(self):
+        """已用量加预留已达限额时抛出 TokenLimitExceeded"""
+        token_limit = self.limit()
+        if token_limit == 0:
+            return
+        self._sync()
+        with self._lock:
+            if self._committed + self._reserved >= token_limit:
+                self.rejected += 1
+                raise TokenLimitExceeded(token_limit, self._committed)
+
+    def reserve(self, tokens, is_custom_api=False):
+        """
+        预留 tokens，超出限额时抛出 TokenLimitExceeded；使用自定义 API 配置时不预留
+
+        可能查询数据库，异步路径中通过 run_db 调用
+        """
+        if is_custom_api:
+            return _NoReservation()
+
+        token_limit = self.limit()
+        self._sync()
+        with self._lock:
+            if token_limit and self._committed + self._reserved + tokens > token_limit:
+                self.rejected += 1
+                raise TokenLimitExceeded(token_limit, self._committed, tokens)
+            self._reserved += tokens
+            self._active += 1
+        return Reservation(self, tokens)
+
+    def _finish(self, reservation, actual_tokens):
+        with self._lock:
+            if reservation.done:
+                return
+            reservation.done = True
+            self._reserved -= reservation.tokens
+            self._active -= 1
+            self._committed += actual_tokens
+
+    def commit(self, tokens):
+        """把没有预留的用量直接计入当日已用（例如对冲中被丢弃的响应），不查询数据库"""
+        with self._lock:
+            self._committed += tokens
+
+    def stats(self):
+        committed, reserved = self.usage()
+        with self._lock:
+            return {
+                'token_limit': self.limit(),
+                'today_usage': committed,
+                'reserved': reserved,
+                'active_reservations': self._active,
+                'rejected': self.rejected
+            }
+
+
+token_budget = TokenBudget(sync_interval=float(os.getenv('TOKEN_BUDGET_SYNC_INTERVAL', '30')))
+
+
+def token_limit_error(data, tenant=None):
+    """
+    检查单日 token 限额和租户配额，超出时返回错误信息（dict），否则返回 None
+
+    data 为请求的 JSON 数据，tenant 为请求所属的租户；使用自定义 API 配置的请求不受服务端
+    单日限额和租户 token 配额限制，但仍计入租户的请求数。单日限额这里只是提前拒绝，
+    准确的限额控制在每次模型调用前的预留（token_budget.reserve）中
+    """
+    # 检查请求中是否使用自定义 API 配置
+    # 如果使用自定义 API 配置，则不受服务端限额限制
+    is_custom_api = False
+    try:
+        custom_config = (data or {}).get('custom_api') or {}
+        is_custom_api = bool(custom_config.get('api_key'))
+    except Exception:
+        # 如果无法解析请求数据，继续执行限额检查
+        pass
+
+    # 如果限额为 0，表示无限制
+    if not is_custom_api and TokenBudget.limit() != 0:
+        try:
+            token_budget.check()
+        except TokenLimitExceeded as e:
+            return e.to_dict()
+
+    try:
+        tenant_quotas.admit(tenant, count_tokens=not is_custom_api)
+    except QuotaExceeded as e:
+        return e.to_dict()
+    return None
 
 
 def check_token_limit(f):
-    """检查 token 限额的装饰器"""
+    """检查 token 限额和租户配额的装饰器"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # 获取限额配置
-        token_limit = int(os.getenv('DAILY_TOKEN_LIMIT', '0'))
-
-        # 如果限额为 0，表示无限制
-        if token_limit == 0:
+        # 都没有启用时不需要解析请求数据
+        if TokenBudget.limit() == 0 and not tenant_quotas.enabled:
             return f(*args, **kwargs)
 
-        # 检查请求中是否使用自定义 API 配置
-        # 如果使用自定义 API 配置，则不受服务端限额限制
         try:
-            data = request.get_json() or {}
-            custom_config = data.get('custom_api') or {}
-            custom_api_key = custom_config.get('api_key')
-            
-            # 如果用户提供了自定义 API key，跳过限额检查
-            if custom_api_key:
-                return f(*args, **kwargs)
+            data = request.get_json()
         except Exception:
-            # 如果无法解析请求数据，继续执行限额检查
-            pass
-
-        # 检查今日 token 使用量
-        from app.models.session import SessionManager
-        today_usage = SessionManager.get_today_token_usage()
-
-        if today_usage >= token_limit:
-            return jsonify({
-                'error': 'token_limit_reached',
-                'message': '服务端已达单日 token 限额，请明日再试或切换/搭建个人服务端',
-                'token_limit': token_limit,
-                'today_usage': today_usage
-            }), 429
+            data = None
+
+        error = token_limit_error(data, current_tenant())
+        if error:
+            return jsonify(error), 429
 
         return f(*args, **kwargs)
 
@@ -0,0 +1,247 @@
+"""
+token 用量的进程内汇总
+
+模型调用结束后只在内存中累加用量（按日期、模型、接口），由后台线程每隔
+TOKEN_USAGE_FLUSH_INTERVAL 秒在一个事务中批量写入 token_usage 和 token_usage_breakdown 表，
+进程退出时再写入一次。调用路径上记账不访问数据库；进程被强制结束时最多丢失一个间隔内的用量
+
+当日已有的细分用量在启动时（create_app）载入，跨天后由后台线程重新载入
+"""
+import atexit
+import contextvars
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+# 当前请求的接口（路由规则），由 Flask 的 before_request 和 ASGI 入口设置
+_endpoint = contextvars.ContextVar('token_usage_endpoint', default='unknown')
+
+
+# 当前上下文中的用量计数器，由 metered() 设置
+_meter = contextvars.ContextVar('token_usage_meter', default=None)
+
+
+def set_endpoint(endpoint):
+    """标记当前请求的接口，之后的模型调用用量计入该接口"""
+    _endpoint.set(endpoint or 'unknown')
+
+
+class UsageMeter:
+    def __init__(self):
+        self.tokens = 0
+        self.calls = 0
+
+
+@contextmanager
+def metered():
+    """统计 with 块内（包括从中复制上下文的线程）记录的用量，用于计算单次操作消耗的 token"""
+    meter = UsageMeter()
+    token = _meter.set(meter)
+    try:
+        yield meter
+    finally:
+        _meter.reset(token)
+
+
+def _today():
+    return datetime.now().strftime('%Y-%m-%d')
+
+
+class TokenUsageAggregator:
+    """
+    汇总 token 用量并定期批量写入数据库
+
+    flush_interval <= 0 时每次记录后立即由后台线程写入（不做汇总）
+    """
+
+    def __init__(self, flush_interval=5.0):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # 保证同一时间只有一次写入，写入失败放回的增量不会和下一次写入交错
+        self._flush_lock = threading.Lock()
+        # (日期, 模型, 接口) -> [token 数, 调用次数]，尚未写入数据库的增量
+        self._pending = {}
+        # (模型, 接口) -> [token 数, 调用次数]，今日用量（启动时已有的记录 + 本进程的用量）
+        self._totals = {}
+        self._date = None
+        # 已从数据库载入细分用量的日期
+        self._loaded = None
+        self._thread = None
+        self._stop = threading.Event()
+        # flush_interval <= 0 时唤醒后台线程立即写入
+        self._wake = threading.Event()
+        self.flushes = 0
+        self.flush_errors = 0
+        self.flushed_tokens = 0
+
+    def _roll(self, today):
+        """跨天时清空今日用量（调用方持有锁），当日已有的用量由 load 载入"""
+        if today != self._date:
+            self._date = today
+            self._totals = {}
+
+    def load(self):
+        """
+        从数据库载入当日已有的细分用量（启动时和跨天后调用），当日已经载入时不做任何事
+
+        查询在 _lock 外执行，记账只访问内存；查询时持有写入锁，数据库中的用量和尚未写入的增量不会重叠
+        """
+        from app.models.session import SessionManager
+
+        today = _today()
+        with self._lock:
+            self._roll(today)
+            if self._loaded == today:
+                return
+
+        with self._flush_lock:
+            try:
+                rows = SessionManager.get_token_usage_breakdown(today)
+            except Exception as e:
+                print(f"Error loading token usage breakdown: {str(e)}")
+                return
+
+            with self._lock:
+                if self._date != today:
+                    return
+                # 载入前记录的用量要么已经写入数据库（在查询结果中），要么仍在 _pending 中
+                totals = {(model, endpoint): [tokens, calls] for model, endpoint, tokens, calls in rows}
+                for (day, model, endpoint), (tokens, calls) in self._pending.items():
+                    if day == today:
+                        total = totals.setdefault((model, endpoint), [0, 0])
+                        total[0] += tokens
+                        total[1] += calls
+                self._totals = totals
+                self._loaded = today
+
+    def record(self, tokens, model, endpoint=None):
+        """记录一次模型调用的用量，endpoint 默认取当前请求的接口"""
+        today = _today()
+        key = (model or 'unknown', endpoint or _endpoint.get())
+
+        with self._lock:
+            self._roll(today)
+            pending = self._pending.setdefault((today,) + key, [0, 0])
+            pending[0] += tokens
+            pending[1] += 1
+            total = self._totals.setdefault(key, [0, 0])
+            total[0] += tokens
+            total[1] += 1
+            meter = _meter.get()
+            if meter is not None:
+                meter.tokens += tokens
+                meter.calls += 1
+
+        if self.flush_interval <= 0:
+            # 写入放在后台线程中：异步路径中记账运行于事件循环，不能等待数据库
+            self._wake.set()
+        self._start()
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='token-usage-flush', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval if self.flush_interval > 0 else None)
+            self._wake.clear()
+            self.load()
+            self.flush()
+
+    def flush(self):
+        """把尚未写入的增量写入数据库，返回写入的 token 数；写入失败时增量保留到下一次"""
+        from app.models.session import SessionManager
+
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+
+            try:
+                SessionManager.flush_token_usage([
+                    (date, model, endpoint, tokens, calls)
+                    for (date, model, endpoint), (tokens, calls) in pending.items()
+                ])
+            except Exception as e:
+                print(f"Error flushing token usage: {str(e)}")
+                with self._lock:
+                    self.flush_errors += 1
+                    for key, (tokens, calls) in pending.items():
+                        merged = self._pending.setdefault(key, [0, 0])
+                        merged[0] += tokens
+                        merged[1] += calls
+                return 0
+
+            flushed = sum(tokens for tokens, _ in pending.values())
+            with self._lock:
+                self.flushes += 1
+                self.flushed_tokens += flushed
+            return flushed
+
+    def close(self):
+        """停止后台线程并写入剩余的增量（进程退出时调用）"""
+        self._stop.set()
+        self._wake.set()
+        self.flush()
+
+    def pending_tokens(self, date=None):
+        """尚未写入数据库的用量"""
+        date = date or _today()
+        with self._lock:
+            return sum(tokens for (day, _, _), (tokens, _) in self._pending.items() if day == date)
+
+    def database_usage(self):
+        """
+        数据库中的今日总量（包括其他进程写入的用量）加上本进程尚未写入的用量
+
+        持有写入锁读取，避免一次写入进行到一半时同一批用量被漏算或重复计算
+        """
+        from app.models.session import SessionManager
+
+        today = _today()
+        with self._flush_lock:
+            return SessionManager.get_today_token_usage() + self.pending_tokens(today)
+
+    def today(self):
+        """今日用量（从内存读取）：总量以及按模型、按接口的细分"""
+        with self._lock:
+            self._roll(_today())
+            totals = {key: list(value) for key, value in self._totals.items()}
+
+        by_model = {}
+        by_endpoint = {}
+        for (model, endpoint), (tokens, calls) in totals.items():
+            for breakdown, name in ((by_model, model), (by_endpoint, endpoint)):
+                entry = breakdown.setdefault(name, {'tokens': 0, 'calls': 0})
+                entry['tokens'] += tokens
+                entry['calls'] += calls
+
+        return {
+            'date': self._date,
+            'total_tokens': sum(tokens for tokens, _ in totals.values()),
+            'calls': sum(calls for _, calls in totals.values()),
+            'by_model': by_model,
+            'by_endpoint': by_endpoint
+        }
+
+    def stats(self):
+        stats = self.today()
+        with self._lock:
+            stats.update({
+                'pending_tokens': sum(tokens for tokens, _ in self._pending.values()),
+                'flush_interval': self.flush_interval,
+                'flushes': self.flushes,
+                'flush_errors': self.flush_errors,
+                'flushed_tokens': self.flushed_tokens
+            })
+        return stats
+
+
+token_usage = TokenUsageAggregator(flush_interval=float(os.getenv('TOKEN_USAGE_FLUSH_INTERVAL', '5')))
+atexit.register(token_usage.close)
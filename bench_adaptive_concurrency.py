@@ -0,0 +1,110 @@
+"""
+自适应并发限制和公平调度的基准测试（app/utils/concurrency.py）
+
+1. 过载：模拟服务最多同时处理 CAPACITY 个请求，超出返回 429。THREADS 个线程同时调用 generate_questions，
+   分别在固定的大上限（相当于不限制）和自适应上限下运行，比较上游 429 次数、失败（默认问题）次数和总耗时。
+2. 公平：上限固定为 8，大量批量请求（如批量导入）持续排队时，比较交互式请求和批量请求的耗时。
+
+用法：python bench_adaptive_concurrency.py [线程数] [服务端并发上限] [每个线程的调用次数]
+"""
+import itertools
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '.'))
+
+from mock_llm_server import start_mock_server
+
+THREADS = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+CAPACITY = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+CALLS = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+LATENCY = 0.2
+
+# 每次调用使用不同的想法，相同的并发请求会被合并
+_ideas = itertools.count()
+
+os.environ.update(QWEN_API_KEY='sk-bench', QUESTION_CACHE_SIZE='0', DAILY_TOKEN_LIMIT='0')
+
+from app.utils.concurrency import get_limiter, set_bulk_priority  # noqa: E402
+from app.utils.qwen_api import generate_questions  # noqa: E402
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def call(base_url, bulk=False):
+    """调用一次，返回 (耗时, 是否成功)"""
+    if bulk:
+        set_bulk_priority()
+    started = time.perf_counter()
+    questions = generate_questions(f'想法 {next(_ideas)}：一个需要澄清需求的项目', custom_api_key='sk-bench',
+                                   custom_base_url=base_url)
+    # 调用失败时返回的默认问题 id 为 error-N / fallback-N
+    return time.perf_counter() - started, questions[0]['id'].startswith('q')
+
+
+def run_overload(label, limiter_env):
+    os.environ.update(limiter_env)
+    server, base_url = start_mock_server(latency=LATENCY, capacity=CAPACITY)
+
+    def worker(_):
+        return [call(base_url) for _ in range(CALLS)]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        results = [result for results in executor.map(worker, range(THREADS)) for result in results]
+    elapsed = time.perf_counter() - started
+
+    failed = sum(not ok for _, ok in results)
+    # 客户端的 base_url 末尾带 /
+    stats = get_limiter(base_url + '/', os.getenv('QWEN_MODEL', 'qwen-flash')).stats()
+    print(f"{label}：总耗时 {elapsed:6.2f}s，失败 {failed}/{len(results)}，上游 429 {server.rate_limited} 次，"
+          f"上游请求 {server.requests}，p95 {percentile([t for t, _ in results], 0.95):.2f}s，"
+          f"最终上限 {stats['limit']}（减少 {stats['decreases']} 次）")
+    server.shutdown()
+
+
+def run_fairness():
+    os.environ.update(LLM_CONCURRENCY_INITIAL='8', LLM_CONCURRENCY_MIN='8', LLM_CONCURRENCY_MAX='8')
+    server, base_url = start_mock_server(latency=LATENCY)
+    stop = threading.Event()
+    bulk_times, interactive_times = [], []
+
+    def bulk_worker():
+        while not stop.is_set():
+            bulk_times.append(call(base_url, bulk=True)[0])
+
+    threads = [threading.Thread(target=bulk_worker, daemon=True) for _ in range(48)]
+    for thread in threads:
+        thread.start()
+    # 等批量请求把队列占满
+    time.sleep(1.0)
+
+    def interactive_worker(_):
+        for _ in range(10):
+            interactive_times.append(call(base_url)[0])
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(interactive_worker, range(4)))
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    print(f"交互式请求：{len(interactive_times)} 次，p50 {percentile(interactive_times, 0.5):.2f}s，"
+          f"p95 {percentile(interactive_times, 0.95):.2f}s")
+    print(f"批量请求：  {len(bulk_times)} 次，p50 {percentile(bulk_times, 0.5):.2f}s，"
+          f"p95 {percentile(bulk_times, 0.95):.2f}s")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    print(f"{THREADS} 个线程，每个调用 {CALLS} 次，服务端并发上限 {CAPACITY}，模型延迟 {LATENCY}s\n")
+    run_overload('固定上限 1000', {'LLM_CONCURRENCY_INITIAL': '1000', 'LLM_CONCURRENCY_MIN': '1000'})
+    run_overload('自适应上限  ', {'LLM_CONCURRENCY_INITIAL': '64', 'LLM_CONCURRENCY_MIN': '1'})
+    print("\n上限固定为 8，48 个线程持续发出批量请求，4 个线程发出交互式请求：")
+    run_fairness()
@@ -0,0 +1,135 @@
+"""
+单进程并发会话容量基准测试：对比 WSGI（固定线程数，相当于 gunicorn --threads N）与 ASGI 异步路径
+
+使用带固定延迟的本地模拟服务（mock_llm_server.py）代替真实模型，同时发起 N 个 /api/generate-questions 请求，
+统计全部完成的耗时。线程模型下每个请求在等待模型期间占用一个线程，N 超过线程数后只能分批完成；
+异步路径下所有请求同时等待模型，总耗时接近单次延迟。
+
+用法：python bench_async_capacity.py [模型延迟秒数] [WSGI 线程数] [并发数,...]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '.'))
+
+from mock_llm_server import start_mock_server
+
+LATENCY = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+THREADS = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+CONCURRENCY = [int(n) for n in sys.argv[3].split(',')] if len(sys.argv) > 3 else [16, 100, 400]
+
+# 模拟服务要在导入应用之前启动，默认客户端在导入时读取 QWEN_BASE_URL
+mock_server, mock_url = start_mock_server(latency=LATENCY)
+os.environ['QWEN_BASE_URL'] = mock_url
+os.environ.setdefault('QWEN_API_KEY', 'sk-bench')
+os.environ['DAILY_TOKEN_LIMIT'] = '0'
+# 测量进程本身的容量：模拟服务不会过载，自适应并发上限直接从足够大的值开始
+os.environ.setdefault('LLM_CONCURRENCY_INITIAL', '1000')
+
+import httpx
+import uvicorn
+from app.models.session import SessionManager
+
+SessionManager.DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench_async.db')
+
+from app import create_app
+from app.asgi import ASGIApp
+from app.routes.async_main import ROUTES
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class PooledWSGIServer(WSGIServer):
+    """固定大小线程池的 WSGI 服务，模拟 gunicorn gthread worker"""
+    request_queue_size = 1024
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = ThreadPoolExecutor(max_workers=THREADS)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def start_wsgi(flask_app):
+    server = make_server('127.0.0.1', 0, flask_app, server_class=PooledWSGIServer, handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def start_asgi(flask_app):
+    config = uvicorn.Config(ASGIApp(flask_app, ROUTES), host='127.0.0.1', port=0,
+                            log_level='warning', lifespan='on', backlog=2048)
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, f"http://127.0.0.1:{port}"
+
+
+async def fire(base_url, n):
+    latencies = []
+    # 压测端同样按每 50 个连接一个客户端分片，避免 httpcore 连接池的簿记开销算到被测服务头上
+    clients = [httpx.AsyncClient(base_url=base_url, timeout=None,
+                                 limits=httpx.Limits(max_connections=50, max_keepalive_connections=50))
+               for _ in range(-(-n // 50))]
+
+    async def one(i):
+        start = time.perf_counter()
+        response = await clients[i % len(clients)].post('/api/generate-questions', json={'idea': f'压测想法 {i}'})
+        latencies.append(time.perf_counter() - start)
+        return response.status_code == 200 and 'session_id' in response.json()
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one(i) for i in range(n)))
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        await client.aclose()
+
+    latencies.sort()
+    return elapsed, sum(results), latencies
+
+
+def run(label, base_url):
+    for n in CONCURRENCY:
+        mock_server.max_in_flight = 0
+        elapsed, ok, latencies = asyncio.run(fire(base_url, n))
+        print(f"{label:<14} 并发 {n:4d}  成功 {ok:4d}  同时等待模型 {mock_server.max_in_flight:4d}  "
+              f"总耗时 {elapsed:6.2f}s  p50 {latencies[len(latencies) // 2]:6.2f}s  "
+              f"p99 {latencies[int(len(latencies) * 0.99)]:6.2f}s  吞吐 {ok / elapsed:6.1f} 会话/s")
+
+
+if __name__ == '__main__':
+    flask_app = create_app()
+    print(f"模型延迟 {LATENCY}s，WSGI 线程数 {THREADS}\n")
+
+    wsgi_server, wsgi_url = start_wsgi(flask_app)
+    run(f'WSGI {THREADS} 线程', wsgi_url)
+    wsgi_server.shutdown()
+    print()
+
+    asgi_server, asgi_url = start_asgi(flask_app)
+    run('ASGI 异步', asgi_url)
+    asgi_server.should_exit = True
+
+    print(f"\n「同时等待模型」为模拟服务观察到的并发调用峰值，即单进程能同时服务的会话数："
+          f"WSGI 等于线程数，ASGI 只受 LLM_ASYNC_MAX_CONNECTIONS 和 LLM_CONCURRENCY_* 限制")
+    mock_server.shutdown()
@@ -0,0 +1,71 @@
+"""
+批量导入想法的基准测试（/api/generate-questions/batch）
+
+使用带固定延迟的本地模拟服务代替真实模型，对比逐个调用 /api/generate-questions 与一次批量请求
+导入 N 个想法的总耗时。批量请求按 BATCH_CONCURRENCY 并发生成，总耗时约为 ceil(N / 并发数) 次模型延迟。
+
+用法：python bench_batch_ingest.py [想法数] [并发数] [模型延迟秒数]
+"""
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '.'))
+
+from mock_llm_server import start_mock_server
+
+IDEAS = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+CONCURRENCY = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+LATENCY = float(sys.argv[3]) if len(sys.argv) > 3 else 0.2
+
+mock_server, mock_url = start_mock_server(latency=LATENCY)
+os.environ.update(QWEN_API_KEY='sk-bench', QWEN_BASE_URL=mock_url, QUESTION_CACHE_SIZE='0',
+                  DAILY_TOKEN_LIMIT='0', BATCH_CONCURRENCY=str(CONCURRENCY))
+
+from app.models.session import SessionManager  # noqa: E402
+SessionManager.DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench_batch.db')
+
+from app import create_app  # noqa: E402
+
+
+def run_sequential(client, ideas):
+    for idea in ideas:
+        response = client.post('/api/generate-questions', json={'idea': idea})
+        assert response.status_code == 200, response.get_json()
+
+
+def run_batch(client, ideas):
+    response = client.post('/api/generate-questions/batch', json={'ideas': ideas})
+    first = None
+    lines = []
+    for chunk in response.response:
+        for line in chunk.decode('utf-8').splitlines():
+            if first is None:
+                first = time.perf_counter()
+            lines.append(json.loads(line))
+    summary = lines[-1]
+    assert summary['done'] and summary['succeeded'] == len(ideas), summary
+    return first
+
+
+if __name__ == '__main__':
+    client = create_app().test_client()
+    ideas = [f'想法 {i}：一个需要澄清需求的项目' for i in range(IDEAS)]
+
+    print(f"{IDEAS} 个想法，模型延迟 {LATENCY}s，批量并发 {CONCURRENCY}\n")
+
+    started = time.perf_counter()
+    run_sequential(client, ideas)
+    sequential = time.perf_counter() - started
+
+    started = time.perf_counter()
+    first = run_batch(client, ideas)
+    batch = time.perf_counter() - started
+
+    print(f"逐个调用：{sequential:6.2f}s")
+    print(f"批量请求：{batch:6.2f}s（首行 {first - started:.2f}s，"
+          f"理论下限 {math.ceil(IDEAS / CONCURRENCY) * LATENCY:.2f}s），加速 {sequential / batch:.1f}x")
+    print(f"模拟服务同时处理的请求数峰值：{mock_server.max_in_flight}")
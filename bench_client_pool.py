@@ -0,0 +1,73 @@
+"""
+自定义 API 客户端基准测试：对比「每次请求新建 OpenAI 客户端」与缓存客户端 + 共享连接池的单次调用耗时
+
+使用本地模拟服务（mock_llm_server.py），模拟服务本身不加延迟，测得的差异即建立客户端和连接的开销。
+真实部署中上游是 HTTPS，每次新建客户端还要额外付出 TLS 握手的开销。
+
+用法：python bench_client_pool.py [调用次数] [并发线程数]
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '.'))
+os.environ.setdefault('QWEN_API_KEY', 'sk-bench')
+
+from openai import OpenAI
+from app.utils import qwen_api
+from mock_llm_server import start_mock_server
+
+CALLS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+THREADS = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+API_KEY = 'sk-user-provided-key'
+MESSAGES = [{"role": "user", "content": "ping"}]
+
+
+def uncached_client(api_key, base_url):
+    """旧实现：每次请求都新建客户端（新的连接池，没有 keep-alive）"""
+    return OpenAI(api_key=api_key, base_url=base_url)
+
+
+def run(get_client, base_url, label):
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(n):
+        for _ in range(n):
+            start = time.perf_counter()
+            client = get_client(API_KEY, base_url)
+            client.chat.completions.create(model='mock', messages=MESSAGES, max_tokens=10)
+            with lock:
+                latencies.append((time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=worker, args=(CALLS // THREADS,)) for _ in range(THREADS)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    mean = sum(latencies) / len(latencies)
+    print(f"{label:<22} 平均 {mean:6.2f}ms  p50 {latencies[len(latencies) // 2]:6.2f}ms  "
+          f"p99 {latencies[int(len(latencies) * 0.99)]:6.2f}ms  吞吐 {len(latencies) / elapsed:7.1f} 次/s")
+    return mean
+
+
+if __name__ == '__main__':
+    server, base_url = start_mock_server()
+    print(f"调用 {CALLS} 次，{THREADS} 个线程，模拟服务 {base_url}\n")
+
+    # 预热
+    run(qwen_api.get_client, base_url, '预热')
+    print()
+
+    before = run(uncached_client, base_url, '每次新建客户端')
+    after = run(qwen_api.get_client, base_url, '缓存客户端+共享连接池')
+
+    print(f"\n每次调用节省 {before - after:.2f}ms")
+    print(f"客户端缓存：{qwen_api.client_cache_stats()}")
+    server.shutdown()
@@ -0,0 +1,122 @@
+"""
+并发提交压力测试：多个线程同时向同一个会话提交答案，检查轮次是否丢失，并统计延迟分布
+
+对比「先读 MAX(round_number) 再写入」的多次往返实现与单个 BEGIN IMMEDIATE 写事务的实现
+
+用法：python bench_concurrent_rounds.py [线程数] [每线程提交次数]
+"""
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '.'))
+
+from app.models import database
+from app.models.session import SessionManager
+
+THREADS = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+SUBMITS_PER_THREAD = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+
+ANSWERS = [{'questionId': f'q{i}', 'answer': f'答案 {i}' * 20} for i in range(8)]
+REPORT = '## 1. 任务概览\n' + '报告内容' * 500
+
+
+def multi_round_trip_update(session_id, answers, report):
+    """旧实现：默认（DEFERRED）事务中依次查询会话、最大轮次、当前问题集，再写入"""
+    with SessionManager._connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,))
+        if not cursor.fetchone():
+            return None
+        cursor.execute("SELECT MAX(round_number) FROM reports WHERE session_id = ?", (session_id,))
+        next_round = (cursor.fetchone()[0] or 0) + 1
+        cursor.execute("SELECT MAX(set_number) FROM question_sets WHERE session_id = ?", (session_id,))
+        question_set = cursor.fetchone()[0]
+        created_at = datetime.now().isoformat()
+        cursor.execute("""
+            INSERT INTO reports (session_id, round_number, question_set, report, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (session_id, next_round, question_set, report, created_at))
+        cursor.executemany("""
+            INSERT INTO answers (session_id, round_number, position, answer)
+            VALUES (?, ?, ?, ?)
+        """, [(session_id, next_round, i, json.dumps(a)) for i, a in enumerate(answers)])
+        cursor.execute("UPDATE sessions SET updated_at = ? WHERE id = ?", (created_at, session_id))
+        return next_round
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(update, label, resubmit=False):
+    """
+    resubmit=True 时，提交因轮次冲突失败后立即重新提交（相当于用户看到报错后重试），
+    延迟从第一次提交开始计算，失败次数即不重试时会丢失的轮次数
+    """
+    session_id = SessionManager.create_session('并发提交测试')
+    SessionManager.save_questions(session_id, [{'id': 'q1', 'text': '问题 1', 'type': 'narrative'}])
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(THREADS)
+
+    def worker():
+        barrier.wait()
+        for _ in range(SUBMITS_PER_THREAD):
+            start = time.perf_counter()
+            while True:
+                try:
+                    update(session_id, ANSWERS, REPORT)
+                    break
+                except Exception as e:
+                    with lock:
+                        errors.append(f"{type(e).__name__}: {e}")
+                    if not resubmit:
+                        break
+            with lock:
+                latencies.append((time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=worker) for _ in range(THREADS)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    rounds = SessionManager.get_rounds(session_id)
+    numbers = [r['round_number'] for r in rounds]
+    expected = THREADS * SUBMITS_PER_THREAD
+    contiguous = numbers == list(range(1, len(numbers) + 1))
+    complete_answers = all(len(r['answers']) == len(ANSWERS) for r in rounds)
+
+    print(f"[{label}]")
+    print(f"  提交 {expected} 次，保存轮次 {len(rounds)}，丢失 {expected - len(rounds)}，"
+          f"轮次连续 {contiguous}，答案完整 {complete_answers}")
+    if errors:
+        print(f"  失败 {len(errors)} 次{'（已重新提交）' if resubmit else ''}，例如 {errors[0]}")
+    if latencies:
+        print(f"  耗时 {elapsed:.2f}s  p50 {percentile(latencies, 0.50):.1f}ms  "
+              f"p99 {percentile(latencies, 0.99):.1f}ms  max {max(latencies):.1f}ms")
+    print()
+
+
+if __name__ == '__main__':
+    print(f"线程数 {THREADS}，每线程提交 {SUBMITS_PER_THREAD} 次（同一会话）\n")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        SessionManager.DB_PATH = os.path.join(tmp, 'rounds.db')
+        SessionManager.init_db()
+
+        run(multi_round_trip_update, '多次往返 + DEFERRED 事务')
+        run(multi_round_trip_update, '多次往返 + DEFERRED 事务，冲突后重新提交', resubmit=True)
+        run(SessionManager.update_session_with_answers, '单个 BEGIN IMMEDIATE 事务')
+
+        database.close_all()
@@ -0,0 +1,91 @@
+"""
+需求文档生成的基准测试（/api/download-pdf）
+
+创建一个会话并逐轮提交（每轮一个新的问题集、QUESTIONS 个答案和约 REPORT_CHARS 字的报告），
+每提交一轮后下载一次文档（不带 If-None-Match），记录耗时；最后在 ROUNDS 轮时连续下载多次，
+并比较生成文档数据（SessionManager.get_document）时全部轮次重新渲染、只渲染最后一轮和全部使用已保存片段的耗时。
+
+用法：python bench_document_render.py [轮数] [每轮问题数] [报告字数]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '.'))
+
+ROUNDS = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+QUESTIONS = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+REPORT_CHARS = int(sys.argv[3]) if len(sys.argv) > 3 else 4000
+REPEAT = 20
+
+os.environ.update(QWEN_API_KEY='sk-bench', DAILY_TOKEN_LIMIT='0')
+
+from app.models.session import SessionManager  # noqa: E402
+SessionManager.DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench_document.db')
+
+from app import create_app  # noqa: E402
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def download(client, session_id):
+    started = time.perf_counter()
+    response = client.get(f'/api/download-pdf/{session_id}')
+    body = response.get_data()
+    assert response.status_code == 200, body[:200]
+    return time.perf_counter() - started, len(body)
+
+
+if __name__ == '__main__':
+    client = create_app().test_client()
+    session_id = SessionManager.create_session('开发一个在线学习平台')
+    report_line = '本轮分析：用户需要支持课程管理、学习进度跟踪和在线测验，后续需要确认支付方式。\n'
+    report = (report_line * (REPORT_CHARS // len(report_line) + 1))[:REPORT_CHARS]
+
+    after_round = []
+    for round_number in range(1, ROUNDS + 1):
+        questions = [{'id': f'q{i}', 'text': f'第 {round_number} 轮的第 {i} 个问题？', 'type': 'narrative'}
+                     for i in range(1, QUESTIONS + 1)]
+        SessionManager.save_questions(session_id, questions)
+        answers = [{'answer': f'第 {round_number} 轮第 {i} 题的回答'} for i in range(1, QUESTIONS + 1)]
+        SessionManager.update_session_with_answers(session_id, answers, f'## 第 {round_number} 轮\n{report}')
+        after_round.append(download(client, session_id))
+
+    repeated = [download(client, session_id)[0] for _ in range(REPEAT)]
+
+    etag = client.get(f'/api/download-pdf/{session_id}').headers['ETag']
+    not_modified = []
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        assert client.get(f'/api/download-pdf/{session_id}', headers={'If-None-Match': etag}).status_code == 304
+        not_modified.append(time.perf_counter() - started)
+
+    def render(stale_from):
+        """把 stale_from 轮及之后的片段标记为过期后生成文档数据，返回耗时"""
+        with SessionManager._connection() as conn:
+            conn.execute("UPDATE reports SET fragment_version = NULL WHERE session_id = ? AND round_number >= ?",
+                         (session_id, stale_from))
+        started = time.perf_counter()
+        SessionManager.get_document(session_id)
+        return time.perf_counter() - started
+
+    full = [render(1) for _ in range(REPEAT)]
+    incremental = [render(ROUNDS) for _ in range(REPEAT)]
+    cached = [render(ROUNDS + 1) for _ in range(REPEAT)]
+
+    print(f"{ROUNDS} 轮，每轮 {QUESTIONS} 个问题，报告约 {REPORT_CHARS} 字，文档 {after_round[-1][1] / 1024:.0f}KiB\n")
+    for round_number in sorted({1, 10, 25, ROUNDS}):
+        if round_number <= ROUNDS:
+            print(f"第 {round_number:3d} 轮提交后下载：{after_round[round_number - 1][0] * 1000:7.2f}ms")
+    last = [t for t, _ in after_round[-10:]]
+    print(f"最后 10 轮提交后下载：平均 {sum(last) / len(last) * 1000:7.2f}ms")
+    print(f"{ROUNDS} 轮时重复下载 {REPEAT} 次：p50 {percentile(repeated, 0.5) * 1000:7.2f}ms，"
+          f"p95 {percentile(repeated, 0.95) * 1000:7.2f}ms")
+    print(f"带 If-None-Match 的重复下载（304）：p50 {percentile(not_modified, 0.5) * 1000:7.2f}ms\n")
+    print(f"生成文档数据，{ROUNDS} 轮全部重新渲染：p50 {percentile(full, 0.5) * 1000:7.2f}ms")
+    print(f"生成文档数据，只渲染最后一轮：    p50 {percentile(incremental, 0.5) * 1000:7.2f}ms")
+    print(f"生成文档数据，全部使用已保存片段：p50 {percentile(cached, 0.5) * 1000:7.2f}ms")
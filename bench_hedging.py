@@ -0,0 +1,110 @@
+"""
+对冲请求对长尾延迟的影响（app/utils/call_policy.py）
+
+模拟服务按长尾分布注入延迟：大部分请求约 0.2 秒，少数请求 2 秒或 5 秒。
+分别在关闭和开启对冲（LLM_HEDGE）时调用 generate_questions，比较 p50 / p95 / p99
+和上游请求的增加比例。
+
+用法：python bench_hedging.py [调用次数] [并发数]
+"""
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '.'))
+
+from mock_llm_server import start_mock_server
+
+CALLS = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+CONCURRENCY = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+_random = random.Random(42)
+_random_lock = threading.Lock()
+
+
+def long_tail_latency():
+    with _random_lock:
+        r = _random.random()
+        if r < 0.01:
+            return 5.0
+        if r < 0.04:
+            return 2.0
+        return _random.uniform(0.15, 0.25)
+
+
+server, base_url = start_mock_server(latency=long_tail_latency)
+os.environ.update(QWEN_API_KEY='sk-bench', QWEN_BASE_URL=base_url, QUESTION_CACHE_SIZE='0')
+
+from app.models.session import SessionManager  # noqa: E402
+import tempfile  # noqa: E402
+SessionManager.DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+SessionManager.init_token_usage()
+
+from app.utils import qwen_api  # noqa: E402
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+
+    def pick(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+
+    return pick(0.50), pick(0.95), pick(0.99)
+
+
+def timed_call(i):
+    started = time.perf_counter()
+    qwen_api.generate_questions(f'想法 {i}')
+    return time.perf_counter() - started
+
+
+def run_sync(hedge):
+    qwen_api.questions_policy.hedge = hedge
+    # 先积累足够的耗时样本，对冲时机取近期 p95
+    with ThreadPoolExecutor(CONCURRENCY) as pool:
+        list(pool.map(timed_call, range(50)))
+        before = server.requests
+        samples = list(pool.map(timed_call, range(CALLS)))
+    return samples, server.requests - before
+
+
+async def run_async(hedge):
+    qwen_api.questions_policy.hedge = hedge
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def timed(i):
+        async with semaphore:
+            started = time.perf_counter()
+            await qwen_api.agenerate_questions(f'想法 {i}')
+            return time.perf_counter() - started
+
+    await asyncio.gather(*(timed(i) for i in range(50)))
+    before = server.requests
+    samples = await asyncio.gather(*(timed(i) for i in range(CALLS)))
+    return samples, server.requests - before
+
+
+def report(name, samples, upstream):
+    p50, p95, p99 = percentiles(samples)
+    print(f"{name:<12}{p50:>7.0f}ms{p95:>6.0f}ms{p99:>6.0f}ms  {upstream}（+{upstream / CALLS - 1:.0%}）")
+
+
+async def run_async_both():
+    # 异步客户端的连接绑定在事件循环上，两种模式在同一个事件循环中运行
+    return [await run_async(hedge) for hedge in (False, True)]
+
+
+if __name__ == '__main__':
+    print(f"{CALLS} 次调用，并发 {CONCURRENCY}，延迟：96% 约 0.2s，3% 2s，1% 5s\n")
+    print(f"{'':<12}{'p50':>8}{'p95':>8}{'p99':>8}  上游请求")
+    for hedge in (False, True):
+        report(f"同步{'（对冲）' if hedge else ''}", *run_sync(hedge))
+    for hedge, result in zip((False, True), asyncio.run(run_async_both())):
+        report(f"异步{'（对冲）' if hedge else ''}", *result)
+
+    print(f"\n调用策略统计：{qwen_api.questions_policy.stats()}")
+    print(f"上游看到的断开连接（被取消的落后请求）：{server.disconnects}")
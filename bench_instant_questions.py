@@ -0,0 +1,69 @@
+"""
+即时模式的基准测试（/api/generate-questions 的 instant 模式）
+
+使用带固定延迟的本地模拟服务代替真实模型，比较普通模式和即时模式返回首轮问题的耗时，
+以及即时模式下后台生成的问题可以替换的时间（提交请求到任务完成）。
+
+用法：python bench_instant_questions.py [请求数] [模型延迟秒数]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '.'))
+
+from mock_llm_server import start_mock_server
+
+REQUESTS = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+LATENCY = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+
+mock_server, mock_url = start_mock_server(latency=LATENCY)
+os.environ.update(QWEN_API_KEY='sk-bench', QWEN_BASE_URL=mock_url, QUESTION_CACHE_SIZE='0',
+                  DAILY_TOKEN_LIMIT='0')
+
+from app.models.session import SessionManager  # noqa: E402
+SessionManager.DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench_instant.db')
+
+from app import create_app  # noqa: E402
+
+IDEAS = ['帮我做一个季度工作汇报的PPT', '开发一个记账小程序', '写一篇关于远程办公的公众号文章',
+         '策划一场新品发布活动', '做一份竞品调研报告', '设计一个咖啡店的logo', '我想学做饭']
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def run(client, instant):
+    """返回 (首轮问题的耗时列表, 后台问题就绪的耗时列表)"""
+    first, refined = [], []
+    for i in range(REQUESTS):
+        started = time.perf_counter()
+        response = client.post('/api/generate-questions',
+                               json={'idea': f'{IDEAS[i % len(IDEAS)]}（{i}）', 'instant': instant})
+        data = response.get_json()
+        assert response.status_code == 200, data
+        first.append(time.perf_counter() - started)
+        if instant:
+            job_id = data['refinement']['job_id']
+            job = client.get(f'/api/jobs/{job_id}?wait=30').get_json()
+            assert job['status'] == 'succeeded', job
+            refined.append(time.perf_counter() - started)
+            adopted = client.post(f"/api/session/{data['session_id']}/adopt-questions", json={'job_id': job_id})
+            assert adopted.status_code == 200, adopted.get_json()
+    return first, refined
+
+
+if __name__ == '__main__':
+    client = create_app().test_client()
+    print(f"{REQUESTS} 个请求，模型延迟 {LATENCY}s\n")
+
+    normal, _ = run(client, False)
+    instant, refined = run(client, True)
+
+    print(f"普通模式首轮问题：p50 {percentile(normal, 0.5) * 1000:8.1f}ms，p95 {percentile(normal, 0.95) * 1000:8.1f}ms")
+    print(f"即时模式首轮问题：p50 {percentile(instant, 0.5) * 1000:8.1f}ms，p95 {percentile(instant, 0.95) * 1000:8.1f}ms")
+    print(f"即时模式后台问题就绪：p50 {percentile(refined, 0.5) * 1000:8.1f}ms")
+    print(f"交付物类型：{client.get('/api/metrics').get_json()['instant_questions']['by_type']}")
@@ -0,0 +1,62 @@
+"""
+多轮报告提示词长度对比：每轮发送全部历史问答 vs 本轮问答 + 上一轮报告摘要（app/utils/context.py）
+
+不调用模型，只构建提示词并计算 token 数。离线环境中 tiktoken 无法下载编码文件时按字符估算。
+
+用法：python bench_report_context.py [轮数] [每轮问题数]
+"""
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '.'))
+os.environ.setdefault('QWEN_API_KEY', 'sk-bench')
+
+from app.utils import qwen_api
+from app.utils.context import REPORT_CONTEXT_BUDGET, count_tokens
+
+ROUNDS = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+QUESTIONS_PER_ROUND = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+
+IDEA = "做一个介绍公司新产品的 PPT，面向潜在投资人"
+
+
+def make_round(n):
+    questions = [{'id': f'r{n}q{i}', 'text': f'第 {n} 轮问题 {i}：关于受众、风格、篇幅和重点内容，您的具体要求是什么？',
+                  'type': 'narrative'} for i in range(QUESTIONS_PER_ROUND)]
+    answers = [{'answer': f'第 {n} 轮回答 {i}：希望突出产品的核心优势和市场数据，风格简洁商务，'
+                          f'控制在 15 页以内，并补充竞品对比和融资计划。' * 2} for i in range(QUESTIONS_PER_ROUND)]
+    return questions, answers
+
+
+def make_report(n):
+    sections = []
+    for title in ['任务概览', '内容与逻辑', '风格与规范', '约束与假设', '给下游 AI 的指令']:
+        lines = [f'- **要点 {i}**: 第 {n} 轮综合后的{title}说明，包含受众、结构、数据来源和注意事项等细节。'
+                 for i in range(8)]
+        sections.append(f'## {title}\n' + '\n'.join(lines))
+    return '\n\n'.join(sections)
+
+
+if __name__ == '__main__':
+    print(f"{ROUNDS} 轮，每轮 {QUESTIONS_PER_ROUND} 个问题，预算 {REPORT_CONTEXT_BUDGET} tokens\n")
+    print(f"{'轮次':>4}  {'全部历史':>8}  {'压缩后':>8}")
+
+    history = []
+    previous_report = None
+    full_total = compact_total = 0
+    for n in range(1, ROUNDS + 1):
+        questions, answers = make_round(n)
+        history.extend(
+            {'question': q['text'], 'answer': a['answer'], 'question_type': q['type']}
+            for q, a in zip(questions, answers)
+        )
+
+        full = count_tokens(qwen_api._render_report_prompt(IDEA, '', history))
+        compact = count_tokens(qwen_api._build_report_prompt(IDEA, questions, answers, previous_report))
+        full_total += full
+        compact_total += compact
+        print(f"{n:>4}  {full:>8}  {compact:>8}")
+
+        previous_report = make_report(n)
+
+    print(f"\n合计  {full_total:>8}  {compact_total:>8}（减少 {1 - compact_total / full_total:.0%}）")
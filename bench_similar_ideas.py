@@ -0,0 +1,97 @@
+"""
+相似想法索引的基准测试（app/utils/similar_ideas.py）
+
+生成 N 个合成想法（不同的开头、动作、主题和限定语组合），测量：
+1. 建索引耗时（向量化 + 写入矩阵；以及启动时从 sessions 表分批读出再建索引的耗时）和内存占用
+2. 单次查询耗时
+3. 换一种说法的想法（改写开头、增减限定语）能否检索到原想法，以及无关想法的最高相似度，用于选择阈值
+
+用法：python bench_similar_ideas.py [想法数] [向量维数]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '.'))
+
+from app.models.session import SessionManager  # noqa: E402
+from app.utils.similar_ideas import IdeaIndex  # noqa: E402
+
+IDEAS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+DIM = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+QUERIES = 200
+
+PREFIXES = ['我想', '帮我', '我打算', '想要', '请帮我', '公司需要', '']
+ACTIONS = ['开发一个', '做一个', '写一篇', '设计一个', '策划一场', '整理一份', '搭建一个']
+SUBJECTS = ['在线学习平台', '记账小程序', '健身打卡应用', '宠物社区', '二手交易网站', '读书分享公众号',
+            '咖啡店品牌', '新品发布会', '年度销售报告', '校园招聘活动', '智能客服机器人', '旅行攻略网站',
+            '家庭菜谱应用', '会议纪要工具', '员工培训课程', '社区团购系统', '英语口语练习', '跑步数据分析']
+MODIFIERS = ['', '，面向大学生', '，面向中小企业', '，要简洁', '，预算有限', '，需要支持多语言', '，三个月内上线',
+             '，给老年人用', '，主打性价比', '，风格年轻化']
+
+
+def synthetic_idea(rng, i):
+    # 末尾的编号让每个想法各不相同，模拟真实数据中的细节差异
+    return (f"{rng.choice(PREFIXES)}{rng.choice(ACTIONS)}{rng.choice(SUBJECTS)}"
+            f"{rng.choice(MODIFIERS)}{rng.choice(MODIFIERS)}，第{i}号项目的{rng.choice(SUBJECTS)}")
+
+
+def paraphrase(rng, idea):
+    """换开头、加一个限定语"""
+    for prefix in PREFIXES:
+        if prefix and idea.startswith(prefix):
+            idea = idea[len(prefix):]
+            break
+    return f"{rng.choice([p for p in PREFIXES if p])}{idea}{rng.choice(MODIFIERS[1:])}"
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+if __name__ == '__main__':
+    rng = random.Random(0)
+    ideas = [synthetic_idea(rng, i) for i in range(IDEAS)]
+    index = IdeaIndex(DIM)
+
+    started = time.perf_counter()
+    for start in range(0, IDEAS, 5000):
+        index.add_many([(str(i), ideas[i]) for i in range(start, min(start + 5000, IDEAS))])
+    build = time.perf_counter() - started
+
+    print(f"{IDEAS} 个想法，向量维数 {DIM}")
+    print(f"建索引：{build:.2f}s（{build / IDEAS * 1e6:.1f}µs/个），矩阵内存 {index.memory_bytes() / 2 ** 20:.1f}MiB"
+          f"（有效部分 {IDEAS * DIM * 4 / 2 ** 20:.1f}MiB，其余为扩容预留）")
+
+    SessionManager.DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench_similar.db')
+    SessionManager.init_db()
+    for start in range(0, IDEAS, 5000):
+        SessionManager.create_sessions(ideas[start:start + 5000])
+    started = time.perf_counter()
+    loaded = IdeaIndex(DIM)
+    for batch in SessionManager.iter_session_ideas(5000):
+        loaded.add_many(batch)
+    print(f"从数据库载入并建索引：{time.perf_counter() - started:.2f}s")
+
+    samples = rng.sample(range(IDEAS), QUERIES)
+    latencies, found, paraphrase_scores, unrelated_scores = [], 0, [], []
+    for i in samples:
+        query = paraphrase(rng, ideas[i])
+        started = time.perf_counter()
+        results = index.query(query, 5)
+        latencies.append(time.perf_counter() - started)
+        top_id, top_score = results[0]
+        if top_id == str(i):
+            found += 1
+            paraphrase_scores.append(top_score)
+        # 与原想法无关的最高相似度（错误复用的风险）
+        unrelated_scores.append(max((score for session_id, score in results if session_id != str(i)), default=0))
+
+    print(f"查询：p50 {percentile(latencies, 0.5) * 1000:.2f}ms，p95 {percentile(latencies, 0.95) * 1000:.2f}ms")
+    print(f"改写后检索到原想法：{found}/{QUERIES}，相似度 p5 {percentile(paraphrase_scores, 0.05):.3f}，"
+          f"p50 {percentile(paraphrase_scores, 0.5):.3f}")
+    print(f"其他想法的最高相似度：p50 {percentile(unrelated_scores, 0.5):.3f}，"
+          f"p95 {percentile(unrelated_scores, 0.95):.3f}")
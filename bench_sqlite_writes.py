@@ -0,0 +1,148 @@
+"""
+并发写入基准测试：对比「每次调用都打开/关闭连接 + 默认回滚日志」与连接池 + WAL 的吞吐量
+
+用法：python bench_sqlite_writes.py [线程数] [每线程会话数]
+"""
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '.'))
+
+from app.models import database
+from app.models.session import SessionManager
+
+THREADS = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+SESSIONS_PER_THREAD = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+QUESTIONS = [{'id': f'q{i}', 'text': f'问题 {i}', 'type': 'narrative'} for i in range(8)]
+ANSWERS = [{'questionId': f'q{i}', 'answer': f'答案 {i}' * 20} for i in range(8)]
+REPORT = '## 1. 任务概览\n' + '报告内容' * 500
+
+
+class LegacySessionManager:
+    """旧实现：每次调用都新建连接，create_session 时重复建表"""
+    DB_PATH = None
+
+    @classmethod
+    def init_db(cls):
+        conn = sqlite3.connect(cls.DB_PATH)
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY, idea TEXT NOT NULL, created_at TEXT NOT NULL,
+                questions TEXT DEFAULT '[]', answers TEXT DEFAULT '[]', reports TEXT DEFAULT '[]',
+                final_doc_path TEXT, updated_at TEXT NOT NULL
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS rounds (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL,
+                round_number INTEGER NOT NULL, questions TEXT NOT NULL, answers TEXT NOT NULL,
+                report TEXT, created_at TEXT NOT NULL, UNIQUE (session_id, round_number)
+            )
+        """)
+        conn.commit()
+        conn.close()
+
+    @classmethod
+    def create_session(cls, idea):
+        cls.init_db()
+        session_id = str(uuid.uuid4())
+        created_at = datetime.now().isoformat()
+        conn = sqlite3.connect(cls.DB_PATH)
+        conn.execute("INSERT INTO sessions (id, idea, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                     (session_id, idea, created_at, created_at))
+        conn.commit()
+        conn.close()
+        return session_id
+
+    @classmethod
+    def save_questions(cls, session_id, questions):
+        conn = sqlite3.connect(cls.DB_PATH)
+        conn.execute("UPDATE sessions SET questions = ?, updated_at = ? WHERE id = ?",
+                     (json.dumps(questions), datetime.now().isoformat(), session_id))
+        conn.commit()
+        conn.close()
+
+    @classmethod
+    def update_session_with_answers(cls, session_id, answers, report):
+        conn = sqlite3.connect(cls.DB_PATH)
+        cursor = conn.cursor()
+        cursor.execute("SELECT answers, reports FROM sessions WHERE id = ?", (session_id,))
+        row = cursor.fetchone()
+        current_answers = json.loads(row[0]) + answers
+        current_reports = json.loads(row[1]) + [report]
+        cursor.execute("UPDATE sessions SET answers = ?, reports = ?, updated_at = ? WHERE id = ?",
+                       (json.dumps(current_answers), json.dumps(current_reports),
+                        datetime.now().isoformat(), session_id))
+        cursor.execute("SELECT MAX(round_number) FROM rounds WHERE session_id = ?", (session_id,))
+        next_round = (cursor.fetchone()[0] or 0) + 1
+        cursor.execute("SELECT questions FROM sessions WHERE id = ?", (session_id,))
+        current_questions = cursor.fetchone()[0]
+        cursor.execute("""
+            INSERT OR REPLACE INTO rounds (session_id, round_number, questions, answers, report, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (session_id, next_round, current_questions, json.dumps(answers), report,
+              datetime.now().isoformat()))
+        conn.commit()
+        conn.close()
+
+    @classmethod
+    def get_session(cls, session_id):
+        conn = sqlite3.connect(cls.DB_PATH)
+        row = conn.execute("SELECT * FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        conn.close()
+        return row
+
+
+def run(manager, label):
+    """每个线程模拟若干个会话：创建、保存问题、提交两轮答案、读取会话"""
+    errors = []
+
+    def worker():
+        for _ in range(SESSIONS_PER_THREAD):
+            try:
+                session_id = manager.create_session('并发写入测试')
+                manager.save_questions(session_id, QUESTIONS)
+                manager.update_session_with_answers(session_id, ANSWERS, REPORT)
+                manager.update_session_with_answers(session_id, ANSWERS, REPORT)
+                manager.get_session(session_id)
+            except sqlite3.OperationalError as e:
+                errors.append(str(e))
+
+    threads = [threading.Thread(target=worker) for _ in range(THREADS)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    # 每个会话包含 5 次数据库操作
+    ops = THREADS * SESSIONS_PER_THREAD * 5
+    print(f"{label:<10} 耗时 {elapsed:7.2f}s  吞吐 {ops / elapsed:8.1f} ops/s  "
+          f"错误 {len(errors)}{'（' + errors[0] + '）' if errors else ''}")
+    return ops / elapsed
+
+
+if __name__ == '__main__':
+    print(f"线程数 {THREADS}，每线程 {SESSIONS_PER_THREAD} 个会话\n")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        LegacySessionManager.DB_PATH = os.path.join(tmp, 'legacy.db')
+        LegacySessionManager.init_db()
+        before = run(LegacySessionManager, '旧实现')
+
+        SessionManager.DB_PATH = os.path.join(tmp, 'pooled.db')
+        SessionManager.init_db()
+        after = run(SessionManager, '连接池+WAL')
+        database.close_all()
+
+    print(f"\n吞吐提升 {after / before:.1f}x")
@@ -1,5 +1,6 @@
 import sqlite3
-import json
+
+from app.models.session import SessionManager
 
 DB_PATH = "clarity_ai.db"
 
@@ -10,6 +11,7 @@ def check_rounds_data():
     # 获取所有会话
     cursor.execute("SELECT id, idea FROM sessions")
     sessions = cursor.fetchall()
+    conn.close()
     
     print(f"找到 {len(sessions)} 个会话\n")
     
@@ -18,22 +20,15 @@ def check_rounds_data():
         print(f"想法：{idea[:50]}...")
         
         # 获取该会话的轮次数据
-        cursor.execute("""
-            SELECT round_number, questions, answers, report, created_at 
-            FROM rounds 
-            WHERE session_id = ? 
-            ORDER BY round_number ASC
-        """, (session_id,))
-        
-        rounds = cursor.fetchall()
+        rounds = SessionManager.get_rounds(session_id)
         print(f"轮次数量：{len(rounds)}")
         
         for round_data in rounds:
-            round_num = round_data[0]
-            questions = json.loads(round_data[1])
-            answers = json.loads(round_data[2])
-            report = round_data[3][:50] if round_data[3] else "None"
-            created_at = round_data[4]
+            round_num = round_data['round_number']
+            questions = round_data['questions']
+            answers = round_data['answers']
+            report = round_data['report'][:50] if round_data['report'] else "None"
+            created_at = round_data['created_at']
             
             print(f"\n  第 {round_num} 轮:")
             print(f"    问题数量：{len(questions)}")
@@ -44,8 +39,9 @@ def check_rounds_data():
             print(f"    创建时间：{created_at}")
         
         print("\n" + "="*80 + "\n")
-    
-    conn.close()
 
 if __name__ == "__main__":
+    # 与应用启动时一致：建表并迁移旧版数据
+    SessionManager.init_db()
+    SessionManager.migrate_legacy_storage()
     check_rounds_data()
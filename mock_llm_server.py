@@ -0,0 +1,165 @@
+"""
+本地 OpenAI 兼容的模拟服务，供基准测试使用（不调用真实模型，不消耗 token）
+
+支持 /v1/chat/completions 的普通和流式（stream=True）响应，可以注入固定或随机的延迟，
+也可以限制同时处理的请求数（超出时返回 429）。
+
+用法：python mock_llm_server.py [端口] [延迟秒数]
+"""
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+QUESTIONS_CONTENT = json.dumps([
+    {"id": "q1", "text": "这份交付物的主要受众是谁？", "type": "narrative"},
+    {"id": "q2", "text": "您期望的风格是？", "type": "choice", "options": ["简洁商务", "活泼有趣", "科技感"]},
+    {"id": "q3", "text": "预计的篇幅或规模是多少？", "type": "fill_blank"},
+    {"id": "q4", "text": "还有什么需要补充的吗？", "type": "narrative"}
+], ensure_ascii=False)
+
+REPORT_CONTENT = "## 1. 任务概览 (Task Overview)\n- **任务类型**: 模拟报告\n" + "- 模拟内容\n" * 40
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # 响应头和响应体分开写出，不关闭 Nagle 算法时 keep-alive 连接上会出现约 40ms 的延迟确认
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _content_for(self, body):
+        prompt = json.dumps(body.get('messages', []), ensure_ascii=False)
+        return self.server.questions_content if '问题列表' in prompt else REPORT_CONTENT
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if body.get('response_format') and self.server.reject_response_format:
+            # 模拟不支持 JSON 模式的服务端
+            payload = json.dumps({"error": {"message": "response_format is not supported",
+                                            "type": "invalid_request_error"}}).encode()
+            self.send_response(400)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        content = self._content_for(body)
+        model = body.get('model', 'mock')
+        usage = {"prompt_tokens": 100, "completion_tokens": 50, "total_tokens": 150}
+
+        self.server.requests += 1
+        if not self.server.enter():
+            # 模拟服务端的并发上限
+            payload = json.dumps({"error": {"message": "Too many concurrent requests",
+                                            "type": "rate_limit_error"}}).encode()
+            self.send_response(429)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        try:
+            time.sleep(self.server.next_latency())
+        finally:
+            self.server.leave()
+
+        if body.get('stream'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            try:
+                for i in range(0, len(content), 16):
+                    chunk = {"id": "mock", "object": "chat.completion.chunk", "created": 0, "model": model,
+                             "choices": [{"index": 0, "delta": {"content": content[i:i + 16]},
+                                          "finish_reason": None}]}
+                    self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+                    time.sleep(self.server.chunk_interval)
+                final = {"id": "mock", "object": "chat.completion.chunk", "created": 0, "model": model,
+                         "choices": [], "usage": usage}
+                self._write_chunk(f"data: {json.dumps(final)}\n\n".encode())
+                self._write_chunk(b"data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                self.server.disconnects += 1
+            return
+
+        payload = json.dumps({
+            "id": "mock", "object": "chat.completion", "created": 0, "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": "stop"}],
+            "usage": usage
+        }, ensure_ascii=False).encode()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            # 调用方已取消请求（例如对冲中落后的请求）
+            self.server.disconnects += 1
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, latency=0.0, chunk_interval=0.0, capacity=None):
+        super().__init__(address, MockLLMHandler)
+        # latency 可以是秒数，也可以是每次调用返回秒数的函数（用于注入长尾延迟）
+        self.latency = latency
+        self.chunk_interval = chunk_interval
+        # 生成问题时返回的内容（可以替换为格式有问题的输出）；为 True 时拒绝带 response_format 的请求
+        self.questions_content = QUESTIONS_CONTENT
+        self.reject_response_format = False
+        # 同时处理的请求数上限，超出的请求返回 429（None 表示不限制）
+        self.capacity = capacity
+        self.rate_limited = 0
+        self.requests = 0
+        self.disconnects = 0
+        # 同时处于等待中的请求数及其峰值，反映调用方实际的并发度
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def next_latency(self):
+        return self.latency() if callable(self.latency) else self.latency
+
+    def enter(self):
+        """开始处理一个请求，超出并发上限时返回 False"""
+        with self._lock:
+            if self.capacity is not None and self.in_flight >= self.capacity:
+                self.rate_limited += 1
+                return False
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+def start_mock_server(port=0, latency=0.0, chunk_interval=0.0, capacity=None):
+    """在后台线程中启动模拟服务，返回 (server, base_url)"""
+    server = MockLLMServer(('127.0.0.1', port), latency, chunk_interval, capacity)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 18080
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    server = MockLLMServer(('127.0.0.1', port), latency)
+    print(f"模拟服务已启动：http://127.0.0.1:{port}/v1（延迟 {latency}s）")
+    server.serve_forever()
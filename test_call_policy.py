@@ -0,0 +1,75 @@
+"""
+模型调用策略中异步对冲的测试（app/utils/call_policy.py）：同时返回的响应的取舍和用量记录
+
+可以用 pytest 运行，也可以直接运行：python test_call_policy.py
+"""
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '.'))
+
+from app.utils.call_policy import CallPolicy, get_breaker  # noqa: E402
+
+
+def _policy(base_url):
+    """近期耗时约 10ms 的对冲策略：主请求 10ms 未返回即发出对冲请求"""
+    breaker = get_breaker(base_url, 'm')
+    for _ in range(20):
+        breaker.record_success(10)
+    return CallPolicy('hedge-test', deadline=5, hedge=True)
+
+
+def test_simultaneous_success_prefers_primary_and_records_discarded():
+    async def main():
+        policy = _policy('http://hedge-both')
+        release = asyncio.Event()
+        calls = []
+
+        async def fn(model, timeout):
+            index = len(calls)
+            calls.append(model)
+            if index == 1:
+                # 两个请求都已发出，同时返回
+                release.set()
+            await release.wait()
+            return f'response-{index}'
+
+        discarded = []
+        result = await policy.acall('http://hedge-both', 'm', fn, on_discard=discarded.append)
+        return result, discarded, policy.stats()
+
+    (response, model), discarded, stats = asyncio.run(main())
+    assert (response, model) == ('response-0', 'm')
+    assert discarded == ['response-1']
+    assert stats['hedged'] == 1 and stats['hedge_wins'] == 0
+
+
+def test_hedge_win_cancels_primary_without_discard():
+    async def main():
+        policy = _policy('http://hedge-win')
+        calls = []
+
+        async def fn(model, timeout):
+            index = len(calls)
+            calls.append(model)
+            if index == 0:
+                await asyncio.sleep(5)
+            return f'response-{index}'
+
+        discarded = []
+        result = await policy.acall('http://hedge-win', 'm', fn, on_discard=discarded.append)
+        return result, discarded, policy.stats()
+
+    (response, _), discarded, stats = asyncio.run(main())
+    assert response == 'response-1'
+    assert discarded == []
+    assert stats['hedge_wins'] == 1
+
+
+if __name__ == '__main__':
+    tests = [(name, fn) for name, fn in sorted(globals().items()) if name.startswith('test_') and callable(fn)]
+    for name, fn in tests:
+        fn()
+        print(f"✅ {name}")
+    print(f"\n{len(tests)} 个测试通过")
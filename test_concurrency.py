@@ -0,0 +1,205 @@
+"""
+模型调用并发限制的测试（app/utils/concurrency.py）：AIMD 调整、批量请求的名额、租户轮转和取消时归还名额
+
+可以用 pytest 运行，也可以直接运行：python test_concurrency.py
+"""
+import asyncio
+import contextvars
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '.'))
+
+from app.utils.concurrency import AdaptiveLimiter, LimiterTimeout, set_bulk_priority  # noqa: E402
+from app.utils.tenant_quota import set_tenant  # noqa: E402
+
+
+def _fill(limiter):
+    """占满全部名额"""
+    for _ in range(int(limiter.limit)):
+        limiter.acquire(0)
+
+
+def test_limit_increases_only_when_saturated():
+    limiter = AdaptiveLimiter(initial=4, latency_tolerance=0)
+    # 上限没有用满时成功调用不增加上限
+    limiter.acquire(0)
+    limiter.release(elapsed=0.1)
+    assert limiter.limit == 4
+
+    # 用满时慢启动，每次 +1
+    _fill(limiter)
+    limiter.release(elapsed=0.1)
+    assert limiter.limit == 5
+    assert limiter.increases == 1
+
+
+def test_overload_decreases_once_per_wave():
+    limiter = AdaptiveLimiter(initial=8, backoff=0.5)
+    _fill(limiter)
+    limiter.release(elapsed=0.1)
+    assert limiter.limit == 9
+
+    # 同一波请求的多个 429 只减少一次，之后退出慢启动
+    limiter.release(overloaded=True)
+    limiter.release(overloaded=True)
+    assert limiter.limit == 4.5
+    assert limiter.decreases == 1
+    assert not limiter.stats()['slow_start']
+
+    # 退出慢启动后用满时每次增加 1/上限
+    while limiter.in_flight:
+        limiter.release()
+    _fill(limiter)
+    limiter.release(elapsed=0.1)
+    assert abs(limiter.limit - (4.5 + 1 / 4.5)) < 1e-9
+
+
+def test_slow_response_counts_as_overload():
+    limiter = AdaptiveLimiter(initial=8, backoff=0.5, latency_tolerance=4.0)
+    limiter.acquire(0)
+    limiter.release(elapsed=0.1)
+    limiter.acquire(0)
+    limiter.release(elapsed=1.0)
+    assert limiter.limit == 4
+    assert limiter.decreases == 1
+
+
+def test_limit_never_below_minimum():
+    limiter = AdaptiveLimiter(initial=2, min_limit=1, backoff=0.1)
+    limiter.acquire(0)
+    limiter.release(overloaded=True)
+    assert limiter.limit == 1
+
+
+def _start_waiters(limiter, labels, results, bulk=False, tenant=None):
+    """每个标签一个线程排队等待名额，拿到名额时记录标签；按顺序逐个入队"""
+    threads = []
+    for label in labels:
+        def wait(label=label):
+            if bulk:
+                set_bulk_priority()
+            set_tenant(tenant)
+            limiter.acquire(5)
+            results.append(label)
+
+        expected = limiter.waiting + 1
+        thread = threading.Thread(target=contextvars.Context().run, args=(wait,))
+        thread.start()
+        while limiter.waiting < expected:
+            time.sleep(0.001)
+        threads.append(thread)
+    return threads
+
+
+def _grant_all(limiter, results, count):
+    """逐个归还名额，每次等被唤醒的等待者记录后再归还下一个，返回授予顺序"""
+    for i in range(count):
+        limiter.release()
+        deadline = time.monotonic() + 5
+        while len(results) < i + 1:
+            assert time.monotonic() < deadline, 'waiter was not granted'
+            time.sleep(0.001)
+    return list(results)
+
+
+def test_bulk_gets_its_share_under_interactive_load():
+    limiter = AdaptiveLimiter(initial=1, bulk_share=4)
+    limiter.acquire(0)
+    results = []
+    threads = _start_waiters(limiter, [f'i{n}' for n in range(8)], results)
+    threads += _start_waiters(limiter, ['b0', 'b1'], results, bulk=True)
+
+    order = _grant_all(limiter, results, 10)
+    for thread in threads:
+        thread.join()
+    # 每 4 次授予中至少有一次给批量请求，交互式请求仍然优先
+    assert order == ['i0', 'i1', 'i2', 'b0', 'i3', 'i4', 'i5', 'b1', 'i6', 'i7']
+
+
+def test_bulk_runs_when_no_interactive_waiting():
+    limiter = AdaptiveLimiter(initial=1, bulk_share=4)
+    limiter.acquire(0)
+    results = []
+    threads = _start_waiters(limiter, ['b0', 'b1'], results, bulk=True)
+    assert _grant_all(limiter, results, 2) == ['b0', 'b1']
+    for thread in threads:
+        thread.join()
+
+
+def test_tenants_rotate_within_priority():
+    limiter = AdaptiveLimiter(initial=1)
+    limiter.acquire(0)
+    results = []
+    threads = _start_waiters(limiter, ['a0', 'a1', 'a2'], results, tenant='a')
+    threads += _start_waiters(limiter, ['b0'], results, tenant='b')
+    assert _grant_all(limiter, results, 4) == ['a0', 'b0', 'a1', 'a2']
+    for thread in threads:
+        thread.join()
+
+
+def test_acquire_timeout_leaves_queue():
+    limiter = AdaptiveLimiter(initial=1)
+    limiter.acquire(0)
+    try:
+        limiter.acquire(0.01)
+    except LimiterTimeout:
+        pass
+    else:
+        raise AssertionError('expected LimiterTimeout')
+    assert limiter.waiting == 0 and limiter.timeouts == 1
+    limiter.release()
+    assert limiter.in_flight == 0
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def main():
+        limiter = AdaptiveLimiter(initial=1)
+        limiter.acquire(0)
+        task = asyncio.ensure_future(limiter.aacquire(5))
+        await asyncio.sleep(0)
+        assert limiter.waiting == 1
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        assert limiter.waiting == 0
+        limiter.release()
+        assert limiter.in_flight == 0
+
+    asyncio.run(main())
+
+
+def test_granted_then_cancelled_waiter_returns_slot():
+    async def main():
+        limiter = AdaptiveLimiter(initial=1)
+        limiter.acquire(0)
+        task = asyncio.ensure_future(limiter.aacquire(5))
+        await asyncio.sleep(0)
+        # 名额已经交给等待者，但它被唤醒之前就被取消
+        limiter.release()
+        assert limiter.in_flight == 1 and limiter.waiting == 0
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        assert task.cancelled()
+        assert limiter.in_flight == 0
+
+        # 归还的名额可以立即再次使用
+        await limiter.aacquire(0)
+        assert limiter.in_flight == 1
+
+    asyncio.run(main())
+
+
+if __name__ == '__main__':
+    tests = [(name, fn) for name, fn in sorted(globals().items()) if name.startswith('test_') and callable(fn)]
+    for name, fn in tests:
+        fn()
+        print(f"✅ {name}")
+    print(f"\n{len(tests)} 个测试通过")
@@ -0,0 +1,189 @@
+"""
+后台任务队列的测试（app/utils/job_queue.py 和 SessionManager 的任务表）：领取、租约、重试和重复执行的幂等性
+
+使用临时数据库，可以用 pytest 运行，也可以直接运行：python test_job_queue.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '.'))
+
+from app.models.session import SessionManager  # noqa: E402
+from app.utils.job_queue import JobError, JobQueue  # noqa: E402
+
+
+def setup_module():
+    SessionManager.DB_PATH = os.path.join(tempfile.mkdtemp(), 'test_job_queue.db')
+    SessionManager.init_db()
+    SessionManager.init_jobs()
+
+
+QUESTIONS = [{'id': 'q1', 'text': '目标用户是谁？', 'type': 'narrative'}]
+ANSWERS = [{'answer': '大学生'}]
+
+
+def _session():
+    session_id = SessionManager.create_session('开发一个在线学习平台')
+    SessionManager.save_questions(session_id, QUESTIONS)
+    return session_id
+
+
+def _rounds(session_id):
+    with SessionManager._connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM reports WHERE session_id = ?", (session_id,)).fetchone()[0]
+
+
+def _status(job_id):
+    return SessionManager.get_job(job_id)['status']
+
+
+def test_second_run_of_succeeded_job_does_not_append_round():
+    session_id = _session()
+    job_id, created = SessionManager.create_job('submit-answers', session_id, {})
+    assert created
+    # 第一次执行的租约过期后被重新领取，两次执行都写入结果
+    assert SessionManager.claim_job(job_id, 0) is not None
+    time.sleep(0.01)
+    assert SessionManager.claim_job(job_id, 60)['attempts'] == 2
+
+    assert SessionManager.update_session_with_answers(session_id, ANSWERS, '报告', job_id=job_id) == 1
+    assert SessionManager.update_session_with_answers(session_id, ANSWERS, '报告', job_id=job_id) == 1
+    assert _rounds(session_id) == 1
+
+    job = SessionManager.get_job(job_id)
+    assert job['status'] == 'succeeded' and job['round'] == 1 and job['report'] == '报告'
+    # 已完成的任务不能再被领取
+    assert SessionManager.claim_job(job_id, 60) is None
+
+
+def test_other_jobs_still_append_rounds():
+    session_id = _session()
+    for expected in (1, 2):
+        job_id, _ = SessionManager.create_job('submit-answers', session_id, {})
+        SessionManager.claim_job(job_id, 60)
+        assert SessionManager.update_session_with_answers(session_id, ANSWERS, '报告', job_id=job_id) == expected
+    assert _rounds(session_id) == 2
+
+
+def test_lease_blocks_second_claim_until_expired():
+    session_id = _session()
+    job_id, _ = SessionManager.create_job('submit-answers', session_id, {})
+    assert SessionManager.claim_job(job_id, 60) is not None
+    assert SessionManager.claim_job(job_id, 60) is None
+    assert job_id not in SessionManager.claimable_jobs(100)
+
+    # 租约过期（执行它的进程已退出）后可以重新领取
+    with SessionManager._connection() as conn:
+        conn.execute("UPDATE jobs SET lease_until = ? WHERE id = ?", (time.time() - 1, job_id))
+    assert job_id in SessionManager.claimable_jobs(100)
+    assert SessionManager.claim_job(job_id, 60)['attempts'] == 2
+
+
+def test_dedupe_key_returns_unfinished_job():
+    session_id = _session()
+    job_id, created = SessionManager.create_job('submit-answers', session_id, {}, dedupe_key=f'{session_id}:1')
+    assert created
+    assert SessionManager.create_job('submit-answers', session_id, {}, dedupe_key=f'{session_id}:1') == \
+        (job_id, False)
+
+
+def _queue(handler, **kwargs):
+    """不启动工作线程的任务队列，测试中直接调用 _execute"""
+    queue = JobQueue(workers=0, **kwargs)
+    queue.register('test', handler)
+    return queue
+
+
+def test_executing_succeeded_job_again_does_not_call_handler():
+    calls = []
+
+    def handler(job_id, session_id, payload, secrets):
+        calls.append(job_id)
+        SessionManager.update_session_with_answers(session_id, ANSWERS, '报告', job_id=job_id)
+
+    queue = _queue(handler)
+    session_id = _session()
+    job_id, _ = SessionManager.create_job('test', session_id, {})
+    queue._execute(job_id)
+    queue._execute(job_id)
+    assert calls == [job_id]
+    assert _rounds(session_id) == 1
+    assert queue.succeeded == 1
+
+
+def test_error_after_result_written_is_not_retried():
+    def handler(job_id, session_id, payload, secrets):
+        SessionManager.update_session_with_answers(session_id, ANSWERS, '报告', job_id=job_id)
+        raise RuntimeError('写入结果后连接断开')
+
+    queue = _queue(handler, retry_backoff=0)
+    session_id = _session()
+    job_id, _ = SessionManager.create_job('test', session_id, {})
+    queue._execute(job_id)
+    queue._execute(job_id)
+    assert _status(job_id) == 'succeeded'
+    assert _rounds(session_id) == 1
+
+
+def test_failed_attempt_retried_after_backoff():
+    calls = []
+
+    def handler(job_id, session_id, payload, secrets):
+        calls.append(job_id)
+        raise RuntimeError('上游超时')
+
+    queue = _queue(handler, max_attempts=2, retry_backoff=60)
+    job_id, _ = SessionManager.create_job('test', _session(), {})
+    queue._execute(job_id)
+    assert _status(job_id) == 'queued' and queue.retried == 1
+    # 还没到重试时间
+    queue._execute(job_id)
+    assert len(calls) == 1
+
+    with SessionManager._connection() as conn:
+        conn.execute("UPDATE jobs SET run_after = ? WHERE id = ?", (time.time() - 1, job_id))
+    queue._execute(job_id)
+    # 达到最大尝试次数后标记为失败
+    job = SessionManager.get_job(job_id)
+    assert len(calls) == 2
+    assert job['status'] == 'failed' and job['attempts'] == 2
+    assert job['error'] == {'error': '上游超时'}
+
+
+def test_job_error_not_retried():
+    def handler(job_id, session_id, payload, secrets):
+        raise JobError('会话不存在')
+
+    queue = _queue(handler, retry_backoff=0)
+    job_id, _ = SessionManager.create_job('test', _session(), {})
+    queue._execute(job_id)
+    job = SessionManager.get_job(job_id)
+    assert job['status'] == 'failed' and job['attempts'] == 1
+    assert queue.retried == 0
+
+
+def test_owned_job_claimed_only_by_live_owner():
+    owner, other = _queue(lambda *args: None), _queue(lambda *args: None)
+    job_id, _ = SessionManager.create_job('test', _session(), {'has_secrets': True}, owner=owner.instance)
+
+    assert job_id not in SessionManager.claimable_jobs(100, other.instance)
+    assert SessionManager.claim_job(job_id, 60, other.instance) is None
+    assert job_id in SessionManager.claimable_jobs(100, owner.instance)
+
+    # 所属实例退出后其他实例领取，因为没有密钥标记为失败
+    SessionManager.remove_job_worker(owner.instance)
+    other._execute(job_id)
+    job = SessionManager.get_job(job_id)
+    assert job['status'] == 'failed'
+    assert '自定义 API' in job['error']['error']
+
+
+if __name__ == '__main__':
+    setup_module()
+    tests = [(name, fn) for name, fn in sorted(globals().items()) if name.startswith('test_') and callable(fn)]
+    for name, fn in tests:
+        fn()
+        print(f"✅ {name}")
+    print(f"\n{len(tests)} 个测试通过")
@@ -1,7 +1,8 @@
 import sqlite3
-import json
 from datetime import datetime
 
+from app.models.session import SessionManager
+
 DB_PATH = "clarity_ai.db"
 
 def test_rounds_logic():
@@ -15,21 +16,16 @@ def test_rounds_logic():
     
     print(f"测试会话 ID: {session_id}")
     
-    # 获取该会话的轮次数据
-    cursor.execute("""
-        SELECT round_number, questions, answers, report, created_at 
-        FROM rounds 
-        WHERE session_id = ? 
-        ORDER BY round_number ASC
-    """, (session_id,))
+    conn.close()
     
-    rounds = cursor.fetchall()
+    # 获取该会话的轮次数据
+    rounds = SessionManager.get_rounds(session_id)
     print(f"\n轮次数量：{len(rounds)}")
     
     for round_data in rounds:
-        round_num = round_data[0]
-        questions = json.loads(round_data[1])
-        answers = json.loads(round_data[2])
+        round_num = round_data['round_number']
+        questions = round_data['questions']
+        answers = round_data['answers']
         
         print(f"\n第 {round_num} 轮:")
         print(f"  问题数量：{len(questions)}")
@@ -41,9 +37,11 @@ def test_rounds_logic():
         else:
             print(f"  ✅ 问题和答案数量匹配")
     
-    conn.close()
     return len(rounds)
 
 if __name__ == "__main__":
+    # 与应用启动时一致：建表并迁移旧版数据
+    SessionManager.init_db()
+    SessionManager.migrate_legacy_storage()
     count = test_rounds_logic()
     print(f"\n总轮次数：{count}")
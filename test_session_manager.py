@@ -6,6 +6,9 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '.'))
 
 from app.models.session import SessionManager
 
+# 建表只在应用启动时执行，单独运行脚本时需要手动初始化
+SessionManager.init_db()
+
 # 测试会话管理
 print("测试会话管理...")
 
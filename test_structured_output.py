@@ -0,0 +1,229 @@
+"""
+问题列表结构化输出的测试（app/utils/structured_output.py）：JSON 修复、问题校验和 response_format 的回退
+
+可以用 pytest 运行，也可以直接运行：python test_structured_output.py
+"""
+import os
+import sys
+import time
+
+import httpx
+import openai
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '.'))
+
+from app.utils import structured_output  # noqa: E402
+from app.utils.structured_output import (normalize_question, parse_questions, repair_json,  # noqa: E402
+                                         structured_request)
+
+
+# ---- repair_json ----
+
+def test_clean_json_is_not_repaired():
+    assert repair_json('[{"id": "q1", "text": "受众？"}]') == ([{'id': 'q1', 'text': '受众？'}], False)
+
+
+def test_markdown_fence():
+    text = '```json\n{"questions": [{"id": "q1", "text": "受众？", "type": "narrative"}]}\n```'
+    value, _ = repair_json(text)
+    assert value == {'questions': [{'id': 'q1', 'text': '受众？', 'type': 'narrative'}]}
+
+
+def test_trailing_commas():
+    value, repaired = repair_json('{"questions": [{"id": "q1", "options": ["a", "b",],},]}')
+    assert value == {'questions': [{'id': 'q1', 'options': ['a', 'b']}]}
+    assert repaired
+
+
+def test_truncated_object_drops_incomplete_element():
+    text = '[{"id": "q1", "text": "受众？"}, {"id": "q2", "text": "风格'
+    value, repaired = repair_json(text)
+    # 截断的字段被丢弃，最后一个元素只保留完整的字段（之后校验时因缺少 text 丢弃）
+    assert value == [{'id': 'q1', 'text': '受众？'}, {'id': 'q2'}]
+    assert repaired
+
+
+def test_truncated_inside_nested_array():
+    value, repaired = repair_json('{"questions": [{"id": "q1", "options": ["a", "b", "c')
+    assert value == {'questions': [{'id': 'q1', 'options': ['a', 'b']}]}
+    assert repaired
+
+
+def test_truncated_before_any_complete_value():
+    assert repair_json('{"questions": [{"id": "q') == (None, True)
+
+
+def test_prose_with_brackets_before_json():
+    text = '好的[注意]：以下是问题（见[附录]）\n[{"id": "q1", "text": "受众？"}]'
+    assert repair_json(text) == ([{'id': 'q1', 'text': '受众？'}], False)
+
+
+def test_prose_after_json_is_ignored():
+    value, _ = repair_json('{"questions": [{"id": "q1", "text": "x"}]} 以上共 [1] 个问题')
+    assert value == {'questions': [{'id': 'q1', 'text': 'x'}]}
+
+
+def test_mismatched_brackets():
+    value, repaired = repair_json('{"questions": [{"id": "q1", "text": "x"]}')
+    assert value == {'questions': [{'id': 'q1', 'text': 'x'}]}
+    assert repaired
+    assert repair_json('{"a": [1, 2}') == ({'a': [1, 2]}, True)
+
+
+def test_brackets_and_escapes_inside_strings():
+    value, repaired = repair_json('[{"id": "q1", "text": "选项 [a], {b} 和 \\"c\\""}]')
+    assert value == [{'id': 'q1', 'text': '选项 [a], {b} 和 "c"'}]
+    assert not repaired
+
+
+def test_no_json():
+    assert repair_json('抱歉，我无法生成问题') == (None, True)
+    assert repair_json('') == (None, True)
+
+
+# ---- normalize_question ----
+
+def test_type_aliases():
+    cases = {'single_choice': 'choice', 'Multiple_Choice': 'choice', '选择题': 'choice',
+             'short_answer': 'fill_blank', '填空题': 'fill_blank', 'essay': 'narrative', '叙述题': 'narrative'}
+    for alias, expected in cases.items():
+        question, fixed = normalize_question({'id': 'q1', 'text': 'x', 'type': alias, 'options': ['a', 'b']}, set())
+        assert question['type'] == expected, alias
+        assert fixed
+
+
+def test_unknown_type_inferred_from_options():
+    question, _ = normalize_question({'id': 'q1', 'text': 'x', 'type': 'rating', 'options': ['1', '2']}, set())
+    assert question == {'id': 'q1', 'text': 'x', 'type': 'choice', 'options': ['1', '2']}
+    question, _ = normalize_question({'id': 'q1', 'text': 'x', 'type': 'rating'}, set())
+    assert question == {'id': 'q1', 'text': 'x', 'type': 'narrative'}
+
+
+def test_choice_without_options_becomes_narrative():
+    question, fixed = normalize_question({'id': 'q1', 'text': 'x', 'type': 'choice', 'options': ['', None]}, set())
+    assert question == {'id': 'q1', 'text': 'x', 'type': 'narrative'}
+    assert fixed
+
+
+def test_options_cleaned():
+    question, fixed = normalize_question(
+        {'id': 'q1', 'text': 'x', 'type': 'choice', 'options': [' a ', 2, '', {'b': 1}]}, set())
+    assert question['options'] == ['a', '2']
+    assert fixed
+
+
+def test_clean_question_not_fixed():
+    item = {'id': 'q1', 'text': '受众？', 'type': 'choice', 'options': ['a', 'b']}
+    assert normalize_question(item, set()) == (item, False)
+
+
+def test_question_field_used_as_text():
+    question, fixed = normalize_question({'id': 'q1', 'question': ' 受众？ '}, set())
+    assert question == {'id': 'q1', 'text': '受众？', 'type': 'narrative'}
+    assert fixed
+
+
+def test_missing_text_dropped():
+    assert normalize_question({'id': 'q1', 'type': 'narrative'}, set()) == (None, True)
+    assert normalize_question({'id': 'q1', 'text': '   '}, set()) == (None, True)
+    assert normalize_question('受众？', set()) == (None, True)
+
+
+def test_missing_and_duplicate_ids_renumbered():
+    seen = set()
+    ids = [normalize_question(item, seen)[0]['id'] for item in
+           [{'id': 'q1', 'text': 'a'}, {'id': 'q1', 'text': 'b'}, {'text': 'c'}, {'id': 3, 'text': 'd'},
+            {'id': 'q2', 'text': 'e'}]]
+    assert ids[0] == 'q1' and ids[3] == '3'
+    assert len(set(ids)) == len(ids)
+
+
+# ---- parse_questions ----
+
+def test_parse_questions_from_json_mode_object():
+    content = '{"items": [{"id": "q1", "text": "受众？", "type": "narrative"}]}'
+    assert parse_questions(content) == [{'id': 'q1', 'text': '受众？', 'type': 'narrative'}]
+
+
+def test_parse_questions_drops_unusable_items():
+    content = '[{"id": "q1", "text": "受众？"}, {"id": "q1"}, {"id": "q1", "text": "风格？", "type": "radio", ' \
+              '"options": ["a"]}, {"id": "q4", "text": "篇'
+    questions = parse_questions(content)
+    assert [q['text'] for q in questions] == ['受众？', '风格？']
+    assert questions[1]['type'] == 'choice'
+    assert len({q['id'] for q in questions}) == 2
+
+
+def test_parse_questions_failure_recorded():
+    before = structured_output.parse_stats.failed
+    assert parse_questions('抱歉') is None
+    assert parse_questions('[{"id": "q1"}]') is None
+    assert structured_output.parse_stats.failed == before + 2
+
+
+# ---- structured_request ----
+
+def _bad_request(message, param=None):
+    request = httpx.Request('POST', 'http://mock/v1/chat/completions')
+    body = {'message': message, 'type': 'invalid_request_error', 'param': param}
+    return openai.BadRequestError(message, response=httpx.Response(400, request=request), body=body)
+
+
+def test_response_format_rejected_retried_within_remaining_time():
+    calls = []
+
+    def request(timeout, **kwargs):
+        calls.append((timeout, kwargs))
+        if kwargs:
+            time.sleep(0.05)
+            raise _bad_request('response_format is not supported')
+        return 'ok'
+
+    assert structured_request(request, 'http://a', 'model-a', 1.0) == 'ok'
+    assert len(calls) == 2 and calls[0][1] and not calls[1][1]
+    assert calls[1][0] <= 0.96
+    # 记住不支持，之后不再发送
+    calls.clear()
+    assert structured_request(request, 'http://a', 'model-a', 1.0) == 'ok'
+    assert calls == [(1.0, {})]
+
+
+def test_other_bad_request_not_retried():
+    calls = []
+
+    def request(timeout, **kwargs):
+        calls.append(kwargs)
+        raise _bad_request('Range of max_tokens should be [1, 8192]', param='max_tokens')
+
+    try:
+        structured_request(request, 'http://b', 'model-b', 1.0)
+    except openai.BadRequestError:
+        pass
+    else:
+        raise AssertionError('expected BadRequestError')
+    assert len(calls) == 1
+
+
+def test_no_retry_after_deadline():
+    calls = []
+
+    def request(timeout, **kwargs):
+        calls.append(kwargs)
+        time.sleep(0.06)
+        raise _bad_request('invalid parameter', param='response_format')
+
+    try:
+        structured_request(request, 'http://c', 'model-c', 0.05)
+    except openai.BadRequestError:
+        pass
+    else:
+        raise AssertionError('expected BadRequestError')
+    assert len(calls) == 1
+
+
+if __name__ == '__main__':
+    tests = [(name, fn) for name, fn in sorted(globals().items()) if name.startswith('test_') and callable(fn)]
+    for name, fn in tests:
+        fn()
+        print(f"✅ {name}")
+    print(f"\n{len(tests)} 个测试通过")
@@ -0,0 +1,78 @@
+"""
+token 用量汇总的测试（app/utils/token_usage.py）：记账只访问内存，当日已有用量的载入不重复计算
+
+使用临时数据库，可以用 pytest 运行，也可以直接运行：python test_token_usage.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '.'))
+
+from app.models.session import SessionManager  # noqa: E402
+from app.utils.token_usage import TokenUsageAggregator  # noqa: E402
+
+
+def setup_module():
+    SessionManager.DB_PATH = os.path.join(tempfile.mkdtemp(), 'test_token_usage.db')
+    SessionManager.init_token_usage()
+
+
+def _today_rows():
+    return {(model, endpoint): (tokens, calls) for model, endpoint, tokens, calls in
+            SessionManager.get_token_usage_breakdown(time.strftime('%Y-%m-%d'))}
+
+
+def test_record_does_not_query_database():
+    aggregator = TokenUsageAggregator(flush_interval=60)
+    original = SessionManager.get_token_usage_breakdown
+
+    def fail(date):
+        raise AssertionError('record queried the database')
+
+    SessionManager.get_token_usage_breakdown = fail
+    try:
+        aggregator.record(10, 'm', 'a')
+        assert aggregator.today()['total_tokens'] == 10
+    finally:
+        SessionManager.get_token_usage_breakdown = original
+        aggregator._stop.set()
+
+
+def test_load_merges_database_and_pending_usage_once():
+    writer = TokenUsageAggregator(flush_interval=60)
+    writer.record(100, 'load-model', 'load')
+    writer.flush()
+    writer._stop.set()
+
+    aggregator = TokenUsageAggregator(flush_interval=60)
+    # 载入前记录：一部分已经写入数据库，一部分仍未写入
+    aggregator.record(20, 'load-model', 'load')
+    aggregator.flush()
+    aggregator.record(3, 'load-model', 'load')
+    aggregator.load()
+    aggregator.load()
+    aggregator._stop.set()
+
+    assert aggregator.today()['by_endpoint']['load'] == {'tokens': 123, 'calls': 3}
+
+
+def test_zero_interval_flushed_by_background_thread():
+    aggregator = TokenUsageAggregator(flush_interval=0)
+    aggregator.record(7, 'zero-model', 'zero')
+    deadline = time.monotonic() + 5
+    while _today_rows().get(('zero-model', 'zero')) != (7, 1):
+        assert time.monotonic() < deadline, 'usage was not flushed'
+        time.sleep(0.01)
+    aggregator.close()
+    assert aggregator._thread.name == 'token-usage-flush'
+
+
+if __name__ == '__main__':
+    setup_module()
+    tests = [(name, fn) for name, fn in sorted(globals().items()) if name.startswith('test_') and callable(fn)]
+    for name, fn in tests:
+        fn()
+        print(f"✅ {name}")
+    print(f"\n{len(tests)} 个测试通过")